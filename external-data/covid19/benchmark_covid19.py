@@ -0,0 +1,375 @@
+import os
+import sys
+import time
+import json
+import shutil
+import contextlib
+import multiprocessing as mp
+import concurrent.futures as cf
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import datetime as dt
+import curate_covid19 as cc
+
+###########################################################
+# Benchmark of the curation pipeline (curate_covid19.py)  #
+#                                                         #
+#   For each size [nfips, ndays], synthetic NYT (long)    #
+#   and JHU (wide) raw files and a counties fips file     #
+#   are written to bench_dir/<nfips>x<ndays>/, and the    #
+#   pipeline (load/clean, reshape, composites, daily      #
+#   counts, cube) is run on them in a fresh process.      #
+#   The wall/cpu time, peak memory and throughput of      #
+#   each step (see profile_step) are printed and written  #
+#   to bench_report_dir, with the speed-up of running the #
+#   tasks in bench_max_workers processes over running     #
+#   them in one.  Everything is local (offline).          #
+#                                                         #
+#   e.g.,  python benchmark_covid19.py                    #
+#          python benchmark_covid19.py 3500 500           #
+#                                                         #
+###########################################################
+
+##########################
+# Parameters and Options #
+##########################
+#=== Sizes to run, [number of (regular) fips, number of days]
+#    (today's data is about 3,500 fips x 500 days; the first sizes grow
+#     the fips, and the last ones the days, as each day adds a column
+#     to the JHU files and a day of rows to the NYT file)
+bench_sizes = [[3500, 500], [7000, 500], [17500, 500], [35000, 500],
+               [3500, 1000], [3500, 2000], [7000, 2000]]
+
+#=== Injected anomalies (fraction of (fips, date) entries)
+#
+#    negative: the cumulative drops (a negative daily difference)
+#    data dump: a day with many times the usual daily count
+#
+bench_negative_rate = 0.002
+bench_data_dump_rate = 0.0005
+#    and, for each state, the rows that the correction rules drop:
+#    NYT "Unknown" (blank fips), JHU "Unassigned" (900XX) and
+#    "Out of <state>" (800XX)
+bench_unknown_rows = True
+
+#=== Random seed for the generators
+bench_seed = 0
+
+#=== Number of processes for the pipeline (see curate_covid19.max_workers)
+bench_max_workers = 4
+#    and also run each size with 1 process (every step in turn, so the
+#    steps don't share the cpu), to get the speed-up of the pool?
+bench_serial_baseline = True
+
+#=== Keep the synthetic files after each size? (they can be large)
+bench_keep_files = False
+
+#############
+# Filenames #
+#############
+bench_dir = "benchmark/"
+bench_report_dir = bench_dir + "reports/"
+
+#####################################################################
+# Synthetic data generators                                         #
+#####################################################################
+bench_first_date = dt.datetime(2020, 1, 22)
+bench_nstates = 56
+bench_ndmas = 210
+bench_max_county = 899 # (county fips above this are composite/fake fips)
+
+def make_counties(nfips, rng):
+    # A counties fips file (like UScounty_fips_dma.csv) with nfips
+    # regular counties spread over the states, each in one DMA, plus
+    # the "state" and "metro" entries
+    #
+    #    [fips_state, fips_county, fips, county_type, ccFIPS,
+    #     state, stateabb, county, countylong, dma, dmaname]
+    #
+    if (nfips > bench_nstates * bench_max_county):
+        print("***Error benchmark can't make more than",
+              bench_nstates * bench_max_county, "fips")
+        exit(0)
+    fips_state = 1 + np.arange(nfips) % bench_nstates
+    fips_county = 1 + np.arange(nfips) // bench_nstates
+    dma = rng.integers(1, bench_ndmas + 1, nfips)
+    regular = pd.DataFrame({
+        'fips_state': fips_state,
+        'fips_county': fips_county,
+        'fips': fips_state * 1000 + fips_county,
+        'county_type': "regular",
+        'ccFIPS': np.nan,
+        'state': [f"State {s:02d}" for s in fips_state],
+        'stateabb': [f"S{s:02d}" for s in fips_state],
+        'county': [f"County {c:03d}" for c in fips_county],
+        'countylong': [f"County {c:03d} County" for c in fips_county],
+        'dma': dma,
+        'dmaname': [f"DMA {d:03d}" for d in dma]})
+    states = np.unique(fips_state)
+    states_df = pd.DataFrame({
+        'fips_state': states, 'fips_county': 0, 'fips': states * 1000,
+        'county_type': "state", 'ccFIPS': np.nan,
+        'state': [f"State {s:02d}" for s in states],
+        'stateabb': [f"S{s:02d}" for s in states],
+        'county': "All",
+        'countylong': [f"State {s:02d} --- All (not a real FIPS)" for s in states],
+        'dma': -1, 'dmaname': ""})
+    dmas = np.unique(dma)
+    dmas_df = pd.DataFrame({
+        'fips_state': 99, 'fips_county': dmas, 'fips': 99000 + dmas,
+        'county_type': "metro", 'ccFIPS': np.nan, 'state': "", 'stateabb': "",
+        'county': [f"DMA {d:03d}" for d in dmas],
+        'countylong': [f"DMA {d:03d} (not a real FIPS)" for d in dmas],
+        'dma': dmas, 'dmaname': [f"DMA {d:03d}" for d in dmas]})
+    counties_df = pd.concat([regular, states_df, dmas_df], ignore_index=True)
+    return counties_df.sort_values(['fips_state', 'fips_county'])\
+                      .reset_index(drop=True)
+
+def make_cumulative(nfips, ndays, mean_daily, rng):
+    # (fips x date) cumulative counts with injected negative daily
+    # differences and data dumps, and the day of the first count
+    rate = mean_daily * rng.lognormal(0.0, 1.0, nfips)
+    daily = rng.poisson(rate[:, None], (nfips, ndays))
+    dumps = rng.random((nfips, ndays)) < bench_data_dump_rate
+    daily[dumps] += (50 * (rate[:, None] + 1) * np.ones(ndays)).astype(int)[dumps]
+    negs = rng.random((nfips, ndays)) < bench_negative_rate
+    daily[negs] = -rng.integers(1, 10, negs.sum())
+    cum = np.maximum(np.cumsum(daily, axis=1), 0)
+    first = rng.integers(0, max(1, ndays // 4), nfips)
+    cum[np.arange(ndays)[None, :] < first[:, None]] = 0
+    return [cum, first]
+
+def write_nyt_raw(filename, counties_df, cases, deaths, first):
+    # NYT-style long csv: [date, county, state, fips, cases, deaths],
+    # with one row per (fips, date) from the first count onwards, and
+    # (optionally) an "Unknown" county (blank fips) for each state
+    regular = counties_df[counties_df['county_type'] == "regular"]
+    nfips, ndays = cases.shape
+    dates = pd.date_range(bench_first_date, periods=ndays).strftime("%Y-%m-%d")
+    fips = regular['fips'].to_numpy()
+    county = regular['county'].to_numpy()
+    state = regular['state'].to_numpy()
+    if bench_unknown_rows:
+        states = regular.drop_duplicates('fips_state')
+        nunk = len(states)
+        fips = np.concatenate([fips, np.full(nunk, -1)])
+        county = np.concatenate([county, np.full(nunk, "Unknown", dtype=object)])
+        state = np.concatenate([state, states['state'].to_numpy()])
+        cases = np.vstack([cases, np.tile(np.arange(ndays), (nunk, 1))])
+        deaths = np.vstack([deaths, np.zeros((nunk, ndays), dtype=int)])
+        first = np.concatenate([first, np.zeros(nunk, dtype=int)])
+    # (date-major, as in the NYT file)
+    day, row = np.nonzero(np.arange(ndays)[:, None] >= first[None, :])
+    table = pa.table({
+        'date': pa.array(dates.to_numpy()[day]),
+        'county': pa.array(county[row].astype(str)),
+        'state': pa.array(state[row].astype(str)),
+        'fips': pa.array(fips[row], mask=(fips[row] < 0), type=pa.int32()),
+        'cases': pa.array(cases[row, day], type=pa.int64()),
+        'deaths': pa.array(deaths[row, day], type=pa.int64())})
+    pacsv.write_csv(table, filename,
+                    pacsv.WriteOptions(quoting_style="needed"))
+    return table.num_rows
+
+def write_jhu_raw(filename, counties_df, cum, deaths_file=False):
+    # JHU-style wide csv: [UID, iso2, iso3, code3, FIPS, Admin2,
+    # Province_State, Country_Region, Lat, Long_, Combined_Key,
+    # (Population, for deaths), <one column per date>], with
+    # (optionally) "Unassigned" and "Out of <state>" rows for each state
+    regular = counties_df[counties_df['county_type'] == "regular"]
+    nfips, ndays = cum.shape
+    fips = regular['fips'].to_numpy()
+    county = regular['county'].to_numpy().astype(object)
+    state = regular['state'].to_numpy().astype(object)
+    if bench_unknown_rows:
+        states = regular.drop_duplicates('fips_state')
+        sfips = states['fips_state'].to_numpy()
+        snames = states['state'].to_numpy().astype(object)
+        fips = np.concatenate([fips, 90000 + sfips, 80000 + sfips])
+        county = np.concatenate([county, np.full(len(sfips), "Unassigned", dtype=object),
+                                 "Out of " + snames])
+        state = np.concatenate([state, snames, snames])
+        extra = np.tile(np.arange(ndays), (2 * len(sfips), 1))
+        cum = np.vstack([cum, extra])
+    columns = {'UID': 84000000 + fips, 'iso2': np.full(len(fips), "US"),
+               'iso3': np.full(len(fips), "USA"), 'code3': np.full(len(fips), 840),
+               'FIPS': fips.astype(float), 'Admin2': county, 'Province_State': state,
+               'Country_Region': np.full(len(fips), "US"),
+               'Lat': np.zeros(len(fips)), 'Long_': np.zeros(len(fips)),
+               'Combined_Key': county + ", " + state + ", US"}
+    if deaths_file:
+        columns['Population'] = np.full(len(fips), 10000)
+    datecols = [f"{d.month}/{d.day}/{d.strftime('%y')}"
+                for d in pd.date_range(bench_first_date, periods=ndays)]
+    for j, c in enumerate(datecols):
+        columns[c] = cum[:, j]
+    table = pa.table({k: pa.array(v.astype(str) if v.dtype == object else v)
+                      for k, v in columns.items()})
+    pacsv.write_csv(table, filename,
+                    pacsv.WriteOptions(quoting_style="needed"))
+    return table.num_rows
+
+def make_raw_data(dirname, nfips, ndays, seed):
+    # Write the synthetic counties fips file and raw NYT/JHU files
+    # in dirname (laid out like the curation directory), and return
+    # the number of rows of each
+    rng = np.random.default_rng(seed)
+    os.makedirs(dirname + cc.raw_datadir + "nytimes/", exist_ok=True)
+    os.makedirs(dirname + cc.raw_datadir + "jhu/", exist_ok=True)
+    counties_df = make_counties(nfips, rng)
+    counties_df.to_csv(dirname + cc.outfilename_statecounty_fips, index=False)
+    cases, first = make_cumulative(nfips, ndays, 5.0, rng)
+    deaths, _ = make_cumulative(nfips, ndays, 0.1, rng)
+    return {'counties': len(counties_df),
+            'nyt': write_nyt_raw(dirname + cc.filename_nyt_raw, counties_df,
+                                 cases, deaths, first),
+            'jhu_cases': write_jhu_raw(dirname + cc.filename_jhu_cases_raw,
+                                       counties_df, cases),
+            'jhu_deaths': write_jhu_raw(dirname + cc.filename_jhu_deaths_raw,
+                                        counties_df, deaths, deaths_file=True)}
+
+#####################################################################
+# Running the pipeline                                              #
+#####################################################################
+def run_pipeline(dirname, max_workers):
+    # Run the pipeline (as in curate_covid19.main, without the stage
+    # cache) in dirname, and return its profiling records
+    os.chdir(dirname)
+    del cc.profile_records[:]
+    counties_df = pd.read_csv(cc.outfilename_statecounty_fips)
+    with cc.profile_step("fips_registry", rows_in=len(counties_df)):
+        registry = cc.build_fips_registry(counties_df)
+    tasks = {'nyt_cleaned': [cc.load_nyt_covid, [], (registry,)],
+             'jhu_cleaned': [cc.load_jhu_covid, [], (registry,)]}
+    for [name, cleaned, datatype, filename] in [
+            ['nyt_c_daily', ['nyt_cleaned', 0], 'nyt_cases', cc.nyt_c_daily_output_file],
+            ['nyt_d_daily', ['nyt_cleaned', 1], 'nyt_deaths', cc.nyt_d_daily_output_file],
+            ['jhu_c_daily', ['jhu_cleaned', 0], 'jhu_cases', cc.jhu_c_daily_output_file],
+            ['jhu_d_daily', ['jhu_cleaned', 1], 'jhu_deaths', cc.jhu_d_daily_output_file]]:
+        tasks[name] = [cc.make_daily, [cleaned], (datatype, filename, False)]
+    results = cc.run_stage_dag(tasks, max_workers)
+    cube = cc.make_cube(results['nyt_c_daily'], results['nyt_d_daily'],
+                        results['jhu_c_daily'], results['jhu_d_daily'], registry)
+    with cc.profile_step("anomalies") as prof:
+        prof['rows_out'] = len(cc.find_anomalies(cube))
+    return list(cc.profile_records)
+
+@contextlib.contextmanager
+def redirect_stdout_fd(fh):
+    # Send stdout to the file fh, also that of the pool's worker
+    # processes (which inherit the file descriptor, not sys.stdout)
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(fh.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+def bench_one_size(nfips, ndays, seed, max_workers):
+    # Make the data for one size and run the pipeline on it (in this
+    # process, with a pool of max_workers for its tasks, see
+    # run_sizes), returning
+    #
+    #    {nfips, ndays, max_workers, raw_rows, generate_s, pipeline_s,
+    #     peak_rss_mb, steps: [...]}
+    #
+    # where each step has the throughput (rows_in, or else rows_out,
+    # per second of wall time)
+    dirname = os.path.abspath(bench_dir) + f"/{nfips}x{ndays}/"
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.makedirs(dirname)
+    start = time.perf_counter()
+    raw_rows = make_raw_data(dirname, nfips, ndays, seed)
+    generate_s = round(time.perf_counter() - start, 2)
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    with open(dirname + "pipeline.log", 'w') as log:
+        with redirect_stdout_fd(log):
+            steps = run_pipeline(dirname, max_workers)
+    pipeline_s = round(time.perf_counter() - start, 3)
+    os.chdir(cwd)
+    for s in steps:
+        rows = s['rows_in'] if s['rows_in'] is not None else s['rows_out']
+        s['rows_per_s'] = (round(rows / s['wall_s']) if ( (rows is not None)
+                                                          and (s['wall_s'] > 0) )
+                           else None)
+    if not bench_keep_files:
+        shutil.rmtree(dirname)
+    return {'nfips': nfips, 'ndays': ndays, 'max_workers': max_workers,
+            'raw_rows': raw_rows, 'generate_s': generate_s,
+            'pipeline_s': pipeline_s, 'peak_rss_mb': round(cc.peak_rss_mb(), 1),
+            'steps': steps}
+
+def run_sizes(sizes):
+    # Run each size in a new (spawned) process, so that its peak
+    # memory is its own (once with 1 process for the tasks, if
+    # bench_serial_baseline, and once with bench_max_workers)
+    workers = [bench_max_workers]
+    if ( bench_serial_baseline and (bench_max_workers > 1) ):
+        workers = [1] + workers
+    runs = []
+    for nfips, ndays in sizes:
+        sizeruns = []
+        for max_workers in workers:
+            cc.msg_to_usr("benchmark", f"Running {nfips} fips x {ndays} days"
+                          f" ({max_workers} processes)")
+            with cf.ProcessPoolExecutor(max_workers=1,
+                                        mp_context=mp.get_context("spawn")) as pool:
+                run = pool.submit(bench_one_size, nfips, ndays, bench_seed,
+                                  max_workers).result()
+            print_run(run)
+            sizeruns.append(run)
+        if (len(sizeruns) > 1):
+            speedup = sizeruns[0]['pipeline_s'] / sizeruns[-1]['pipeline_s']
+            sizeruns[-1]['speedup'] = round(speedup, 2)
+            print(f"  speed-up with {bench_max_workers} processes: {speedup:.2f}x")
+        runs.extend(sizeruns)
+    return runs
+
+def print_run(run):
+    # (the peak memory is that of the main process; each task's own
+    #  peak is in its step)
+    print(f"\n{run['nfips']} fips x {run['ndays']} days, {run['max_workers']} processes"
+          f"  (NYT rows {run['raw_rows']['nyt']}, peak {run['peak_rss_mb']} MB,"
+          f" data made in {run['generate_s']} s, pipeline {run['pipeline_s']} s)")
+    print(f"  {'step':<28}{'wall_s':>10}{'cpu_s':>10}{'rows/s':>14}{'peak_mb':>10}")
+    for s in run['steps']:
+        rate = "" if s['rows_per_s'] is None else f"{s['rows_per_s']:,}"
+        print(f"  {s['step']:<28}{s['wall_s']:>10.3f}{s['cpu_s']:>10.3f}"
+              f"{rate:>14}{s['peak_rss_mb']:>10.1f}")
+
+def output_bench_report(runs):
+    os.makedirs(bench_report_dir, exist_ok=True)
+    filename = bench_report_dir + "benchmark_" \
+        + dt.datetime.now().strftime("%Y-%m-%d_%H%M%S") + ".json"
+    report = {'created': dt.datetime.now().isoformat(timespec='seconds'),
+              'options': {'bench_negative_rate': bench_negative_rate,
+                          'bench_data_dump_rate': bench_data_dump_rate,
+                          'bench_unknown_rows': bench_unknown_rows,
+                          'bench_seed': bench_seed,
+                          'bench_max_workers': bench_max_workers,
+                          'bench_serial_baseline': bench_serial_baseline,
+                          'output_format': cc.output_format},
+              'runs': runs}
+    with open(filename, 'w') as fh:
+        json.dump(report, fh, indent=1)
+    cc.msg_to_usr("benchmark", "Wrote benchmark report to " + filename)
+
+#############
+# Main Code #
+#############
+def main():
+    # (optionally, one size from the command line: nfips ndays)
+    sizes = bench_sizes
+    if (len(sys.argv) == 3):
+        sizes = [[int(sys.argv[1]), int(sys.argv[2])]]
+    output_bench_report(run_sizes(sizes))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+###########################################################
+# Memory-mapped store of the curated (fips x date) cube   #
+#                                                         #
+#   Written by curate_covid19.py at the end of each run,  #
+#   and read by any number of other jobs, which only      #
+#   touch the pages of the fips/dates they look at.       #
+#                                                         #
+#   The store is a directory with one directory for each  #
+#   version (as written), and a "current" file with the   #
+#   name of the current one.  Each version has            #
+#                                                         #
+#     values.npy:  float64 [fips, date, source, metric,   #
+#                           field]                        #
+#     present.npy: bool [fips, date, source, metric]      #
+#     index.json:  the axes and byte offsets (below)      #
+#                                                         #
+#   A new version is swapped in by replacing the current  #
+#   file (one atomic rename), so a reader always opens a  #
+#   whole version, and the version before it is kept for  #
+#   readers that are just opening it.                     #
+#                                                         #
+#   e.g.,                                                 #
+#                                                         #
+#     store = covid19_store.open_store("output/cube/")    #
+#     df = store_fips_df(store, 36901)                    #
+#     nyt_c = store_values(store, 36901)[:, 1, 0, 0]      #
+#                                                         #
+###########################################################
+store_version = 1
+
+def npy_data_offset(filename):
+    # byte offset of the array data in a .npy file
+    with open(filename, 'rb') as fh:
+        major, minor = np.lib.format.read_magic(fh)
+        if (major == 1):
+            np.lib.format.read_array_header_1_0(fh)
+        else:
+            np.lib.format.read_array_header_2_0(fh)
+        return fh.tell()
+
+def current_version(dirname):
+    # name of the current version of the store (None if there is none)
+    currentfile = dirname.rstrip("/") + "/current"
+    if not os.path.exists(currentfile):
+        return None
+    with open(currentfile) as fh:
+        return fh.read().strip()
+
+def write_store(cube, dirname, sources, metrics, fields):
+    # Write the cube (see build_cube in curate_covid19.py) as a new
+    # version of the store, and then make it the current one (see
+    # above), so readers never see a half-written store.
+    dirname = dirname.rstrip("/")
+    previous = current_version(dirname)
+    version = pd.Timestamp.now().strftime("%Y%m%d_%H%M%S_%f")
+    tmpdir = dirname + "/" + version
+    os.makedirs(tmpdir)
+    values = np.ascontiguousarray(cube['values'], dtype=np.float64)
+    np.save(tmpdir + "/values.npy", values)
+    np.save(tmpdir + "/present.npy", np.ascontiguousarray(cube['present']))
+    #=== The index of the axes
+    #
+    #   the values for (fips, date) start at byte
+    #
+    #      data_offset + row*fips_stride + day*date_stride
+    #
+    #   where row = position in 'fips' and day = days since 'first_date'
+    #
+    index = {
+        'version': store_version,
+        'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'dtype': str(values.dtype),
+        'shape': list(values.shape),
+        'fips': [int(f) for f in cube['fips']],
+        'first_date': cube['dates'][0].strftime("%Y-%m-%d"),
+        'ndates': len(cube['dates']),
+        'sources': list(sources),
+        'metrics': list(metrics),
+        'fields': list(fields),
+        'data_offset': npy_data_offset(tmpdir + "/values.npy"),
+        'fips_stride': values.strides[0],
+        'date_stride': values.strides[1]
+    }
+    with open(tmpdir + "/index.json", 'w') as fh:
+        json.dump(index, fh, indent=1)
+    #=== Swap in the new version
+    with open(dirname + "/current.tmp", 'w') as fh:
+        fh.write(version + "\n")
+    os.replace(dirname + "/current.tmp", dirname + "/current")
+    #=== and remove the versions before the previous one (and the files
+    #    of a store written before there were versions)
+    for name in os.listdir(dirname):
+        path = dirname + "/" + name
+        if name in [version, previous, "current"]:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return version
+
+def open_store(dirname):
+    # Open the current version of a store (without reading its data)
+    # as a dictionary with
+    #
+    #    index (from index.json), version (see current_version), fips,
+    #    dates, fips_row {fips: row}, values, present (read-only
+    #    memory maps)
+    #
+    version = current_version(dirname)
+    if version is None:
+        raise ValueError("no store in " + dirname)
+    dirname = dirname.rstrip("/") + "/" + version
+    with open(dirname + "/index.json") as fh:
+        index = json.load(fh)
+    if (index['version'] != store_version):
+        raise ValueError(f"store version {index['version']} is not {store_version}")
+    store = {'index': index, 'version': version,
+             'fips': np.array(index['fips']),
+             'dates': pd.date_range(index['first_date'], periods=index['ndates']),
+             'values': np.load(dirname + "/values.npy", mmap_mode='r'),
+             'present': np.load(dirname + "/present.npy", mmap_mode='r')}
+    store['fips_row'] = {f: i for i, f in enumerate(index['fips'])}
+    return store
+
+def store_fips_row(store, fips):
+    if fips not in store['fips_row']:
+        raise KeyError(f"fips {fips} not in store")
+    return store['fips_row'][fips]
+
+def store_date_col(store, date):
+    day = (pd.Timestamp(date) - store['dates'][0]).days
+    if ( (day < 0) or (day >= len(store['dates'])) ):
+        raise ValueError(f"date {date} not in store")
+    return day
+
+def store_values(store, fips):
+    # (memory-mapped) values for one fips: [date, source, metric, field]
+    return store['values'][store_fips_row(store, fips)]
+
+def store_date_values(store, date):
+    # (memory-mapped) values for one date: [fips, source, metric, field]
+    return store['values'][:, store_date_col(store, date)]
+
+def store_fips_df(store, fips):
+    # One fips as a dataframe (like the rows of all_df for it)
+    #
+    #    [date, fips, jhu_c_cum, jhu_c_daily, jhu_c_14davg, ..., nyt_d_14davg]
+    #
+    index = store['index']
+    columns = [s + "_" + m + "_" + f for s in index['sources']
+               for m in index['metrics'] for f in index['fields']]
+    values = np.asarray(store_values(store, fips))
+    df = pd.DataFrame(values.reshape(len(store['dates']), -1), columns=columns)
+    df.insert(0, 'fips', fips)
+    df.insert(0, 'date', store['dates'])
+    return df
@@ -1,36 +1,67 @@
 import copy
+import os
+import re
+import csv
+import sys
+import time
+import resource
+import contextlib
+import concurrent.futures as cf
+import json
+import hashlib
+import inspect
+import shutil
 import pandas as pd
 import numpy as np
-import geopandas as gpd
+import scipy.sparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
 import datetime as dt
+import covid19_store
 
 ##########################
 # Parameters and Options #
 ##########################
-#=== FIPS setup and definitions: Should be off in general (False)
+#=== Processing Steps (stages):
 #
-#  ---> But set to True to re-run the collection/definition of all
-#       county/DMA/state FIPS (see pars/files in function)
+#             * fips_dma: collection/definition of all county/DMA/state
+#                         FIPS (see pars/files in function)
+#             * clean: loading/cleaning
+#             * daily: transpose/daily-counts
 #
-do_fips_dma_collection = True
-#=== Processing Steps: Should be done (True) whenever data is
-#                      downloaded again.
+#       (the time of each step is in the profile report, see
+#        write_profile_report, and benchmark_covid19.py times the whole
+#        pipeline on synthetic data of any size)
 #
-#  ---> But set these to False when de-bugging, so you can skip the
+#  The final dataframe, all_df (returned by main, and left in the
+#  module when run as a script, e.g., python -i curate_covid19.py),
+#  has one row for every (fips, date) of the cube:  every fips of the
+#  counties fips file (and any others in the data) on every day, so
+#  also the rows that no source has an entry for (all nan, see
+#  cube['present']), not just the rows with JHU cases.  Its columns
+#  are views of the cube, summary and divergence (see cube_to_df).
 #
-#             * loading/cleaning (2 min)
-#             * transpose/daily-counts (10 min)
+#  Each stage is only re-run when its inputs (files and options) have
+#  changed since its outputs were made (see the manifests in the
+#  output directory), and the later stages are then re-run, too.
 #
-#       The processing (including FIPS setup, above) takes about 15min total.
+#  ---> Put a stage in this list to re-run it anyway
 #
-do_load_and_clean_nytjhu = False
-do_transpose_and_get_daily_values = False
+force_stages = [] # ["fips_dma", "clean", "daily"]
+#
+#  ---> When getting daily values, only compute the dates that are newer
+#       than those in the existing *_daily output files (if there are any),
+#       and the series whose earlier values NYT/JHU have revised (from the
+#       first revised date on; see get_daily_data)
+#
+incremental_daily_refresh = True
 #=== Delete cruise ship entries? (Probably set these to True)
 delete_jhu_cruise_entries = True
 delete_jhu_prison_entries = True
 #=== Dealing with negative daily difference counts
 #
-#  Warn on each negative?
+#  Warn on each negative? (put in the anomaly table, see anomalies_output_file)
 # (set threshold to zero to see all places where cumulative is not cumulative)
 warn_on_negative_daily_counts = False
 threshold_for_negative_daily_counts = 0
@@ -38,8 +69,16 @@ threshold_for_negative_daily_counts = 0
 #
 #  delete: just set to nan
 #  delete_and_interpolate: just set to nan and then interpolate
+#  delete_and_ffill: set to nan and then carry the last good value forward
+#  redistribute: take the negative off the days before it (lower the
+#                earlier cumulative values so the cumulative never
+#                decreases), so the total is kept (the cum column
+#                keeps the reported values)
 #
-negative_daily_counts_option = "delete_and_interpolate" # "delete"
+#  (with redistribute, a new negative changes earlier days, so the
+#   incremental daily refresh re-computes all dates)
+#
+negative_daily_counts_option = "delete_and_interpolate" # "delete", "delete_and_ffill", "redistribute"
 #=== Check for data dumps
 #
 # After running this with thresholds (10.0,10), I see that
@@ -48,18 +87,69 @@ negative_daily_counts_option = "delete_and_interpolate" # "delete"
 # But all of these are less than 15x.  So, I guess I shouldn't do
 # anything about it.
 #
-#   see the "data_dump_possibilities_10thresh_10threshfac.txt"
-#   files for details.
+#   see the anomaly table (anomalies_output_file, kind "data_dump")
+#   for details.
 #
 #
 warn_on_data_dumps = True
 threshold_factor_for_data_dump = 10.0 # above 14d average
 threshold_of_data_dump = 10 # counts
 
+#=== Number of processes for running the NYT/JHU branches and the four
+#    series (nyt/jhu cases/deaths) at the same time
+#    (1 = one at a time, in this process)
+max_workers = min(4, os.cpu_count() or 1)
+
+#=== Profiling: write a report of the wall/cpu time, peak memory and
+#    number of rows for each step of the pipeline (to profile_report_dir)
+write_profile_report = True
+
+#=== Output format for the cleaned and daily data sets
+#
+#  csv: plain csv files
+#  parquet: typed and compressed (much faster to load), partitioned by state
+#
+output_format = "parquet" # "csv"
+# also write csv copies of the parquet outputs? (for exporting)
+export_csv = False
+
+#=== Rows of the raw NYT file to read (and correct) at a time
+nyt_read_chunksize = 500000
+
+#=== Summary columns (see build_summary): the trailing n-day averages
+#    of the daily values of each series, and the NYT+JHU mean and
+#    geometric mean of the daily values and of each average
+summary_windows = [7, 14, 28]
+
+#=== NYT/JHU divergence (see build_divergence and rank_divergence)
+#
+#  Lags (in days, either way) tried when aligning the daily counts of
+#  the two sources
+divergence_max_lag = 7
+#  Only rank the places with at least this many (consensus) cumulative
+#  counts on their last day (a few counts make a large relative divergence)
+#  (and where the sources differ, so a 0% divergence is never "worst")
+divergence_min_count = 100
+#  Number of the worst places of each metric to show
+divergence_show_count = 10
+
 #############
 # Filenames #
 #############
 outfilename_statecounty_fips = "UScounty_fips_dma.csv"
+#   (for the FIPS setup: use same source for FIPS as PWPD and
+#    same source for DMAs as Google Trends)
+pwpd_dir = "../pwpd/"
+UScounty_shape_dir = "data/shapefiles/UScounties/"
+UScounty_shape_filepath = \
+    pwpd_dir + UScounty_shape_dir \
+    + "tl_2019_us_county/tl_2019_us_county.shp"
+USstate_fips_filepath = \
+    pwpd_dir + UScounty_shape_dir \
+    + "US-state_fips-codes.csv"
+trends_dir = "../trends/"
+countyDMA_filename = \
+    trends_dir + "data/dma/county_dma_sood-gaurav-harvard-dataverse_edited.csv"
 raw_datadir = "rawdata/"
 output_datadir = "output/"
 filename_nyt_raw = raw_datadir + "nytimes/us-counties.csv"
@@ -73,72 +163,215 @@ nyt_c_daily_output_file = output_datadir + "nyt_c_daily.csv"
 nyt_d_daily_output_file = output_datadir + "nyt_d_daily.csv"    
 jhu_c_daily_output_file = output_datadir + "jhu_c_daily.csv"
 jhu_d_daily_output_file = output_datadir + "jhu_d_daily.csv"    
+anomalies_output_file = output_datadir + "anomalies.csv"
+divergence_output_file = output_datadir + "divergence.csv"
+stage_manifest_dir = output_datadir + "manifests/"
+profile_report_dir = output_datadir + "profile/"
+# memory-mapped store of the final cube for other jobs (see covid19_store.py)
+cube_store_dir = output_datadir + "cube/"
+# the county attributes read from the shapefile (see read_shape_attributes)
+shape_cache_dir = output_datadir + "cache/"
 
 #####################################################################
 # Helper scripts for loading and cleaning NYT and JHU raw data sets #
 #####################################################################
 def msg_to_usr(section, msg):
     print(section + "\t" + msg)
+
+profile_records = []
+def peak_rss_mb():
+    # peak resident memory of this process so far
+    # (ru_maxrss is in kB on linux and in bytes on mac)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0**2 if (sys.platform == "darwin") else 1024.0)
+
+@contextlib.contextmanager
+def profile_step(step, rows_in=None):
+    # Record the wall time, cpu time, peak memory (and its increase)
+    # and the rows in/out of one step of the pipeline, e.g.,
+    #
+    #     with profile_step("nyt_read") as prof:
+    #         df = pd.read_csv(...)
+    #         prof['rows_out'] = len(df)
+    #
+    record = {'step': step, 'rows_in': rows_in, 'rows_out': None}
+    rss0 = peak_rss_mb()
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = round(time.perf_counter() - wall0, 4)
+        record['cpu_s'] = round(time.process_time() - cpu0, 4)
+        record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        record['peak_rss_delta_mb'] = round(max(0.0, peak_rss_mb() - rss0), 1)
+        profile_records.append(record)
+
+def output_profile_report(run_start):
+    # Write the profiling records of this run to a json file
+    #
+    #    {run_start, total_wall_s, peak_rss_mb, options, steps: [...]}
+    #
+    os.makedirs(profile_report_dir, exist_ok=True)
+    report = {
+        'run_start': run_start.isoformat(timespec='seconds'),
+        'total_wall_s': round((dt.datetime.now() - run_start).total_seconds(), 4),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'options': {'output_format': output_format,
+                    'negative_daily_counts_option': negative_daily_counts_option,
+                    'incremental_daily_refresh': incremental_daily_refresh},
+        'steps': profile_records
+    }
+    filename = profile_report_dir + "profile_" \
+        + run_start.strftime("%Y-%m-%d_%H%M%S") + ".json"
+    with open(filename, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    msg_to_usr("main", "Wrote profiling report to " + filename)
                 
-def nytjhu_change_data(df, fips=None, county=None, state=None,
-                       newfips=None, newcounty=None, newstate=None,
-                       date_begin=None, date_end=None):
-    if ( (fips is None) & (county is None) & (state is None) ):
-        print("***Error nytjhu_change_data needs at least one piece of data")
-        exit(0)
-    elif ( (fips is None) & (county is None) ):        
-        # only the state is given
-        thecondition = (df['state'] == state)
-    elif ((fips is None) & (state is None) ):
-        # only the county is given        
-        thecondition = (df['county'] == county)
-    elif ((county is None) & (state is None) ):
-        # only the FIPS is given        
-        thecondition = (df['fips'] == fips)        
-    elif (fips is None):
-        # county and state are given
-        thecondition = ( (df['state'] == state)
-                         & (df['county'] == county) )
-    if ( (date_begin is not None) & (date_end is not None) ):
-        # This will only work for the original NYT raw dataframe
-        thecondition = ( (thecondition)
-                         & (df['date'].between(date_begin, date_end)) )
-    # no need for anything else... if you have a unique FIPS no need to provide other
-    for index, row in df[thecondition].iterrows():
-            if (newfips is not None):
-                df.at[index, 'fips'] = newfips
-            if (newcounty is not None):
-                df.at[index, 'county'] = newcounty
-            if (newstate is not None):
-                df.at[index, 'state'] = newstate
-
-def nytjhu_create_composite_alls(df):
-    # give the existing "All" entries XX999 fips values
-    to_drop = []
-    for index, row in df.iterrows():
-        sfips = int(row['fips'] // 1000)
-        cfips = int(row['fips'] % 1000)
-        if (cfips == 0):
-            newfips = int(f"{sfips:02d}999")
-            to_drop.append(newfips)
-            nytjhu_change_data(df, fips=row['fips'], newfips=newfips)
-    # create new "All" entries for each state
-    tempdf = df.copy(deep=True)
-    tempdf['sfips'] = tempdf['fips'] // 1000
-    statefips = np.unique(tempdf['sfips'].to_list())
-    for s in statefips:
-        onestate_df =  tempdf[tempdf['sfips'] == s]
-        fipslist = onestate_df['fips'].to_list()
-        statename = onestate_df['state'].to_list()[0]
-        df = create_composite_entry(df, fipslist,
-                                    s*1000, "All", statename,
-                                    dropall=False)
-    # delete the old "All" entries
-    drop_by_fips(df, to_drop)
-    # return dataframe
-    return df
+def read_nyt_raw(filename, first_date, last_date):
+    # Read the raw (long) NYT file in chunks of nyt_read_chunksize rows,
+    # applying the correction rules to each chunk, and keeping only the
+    # rows with a fips in the dates [first_date:last_date], as compact
+    # types:
+    #
+    #    [day <int16 index from first_date>, fips <int32>,
+    #     county <category>, state <category>,
+    #     cases <Int32>, deaths <Int32 (some are blank)>]
+    #
+    # Returns [df, allfips], where allfips are all fips in the file
+    # (also those only outside of the dates)
+    compiled = compile_correction_rules(nyt_correction_rules, "nyt")
+    counts = np.zeros(len(compiled['rules']) + 1, dtype=int)
+    first_date = pd.Timestamp(first_date)
+    ndays = (pd.Timestamp(last_date) - first_date).days + 1
+    def as_category(col):
+        # (with object categories, so the chunks can be put together)
+        return col.cat.set_categories(col.cat.categories.astype(object)).array
+    chunks = []
+    allfips = []
+    reader = pd.read_csv(filename, chunksize=nyt_read_chunksize,
+                         usecols=['date', 'county', 'state', 'fips',
+                                  'cases', 'deaths'],
+                         dtype={'date': 'category', 'county': 'category',
+                                'state': 'category', 'fips': 'float64',
+                                'cases': 'float64', 'deaths': 'float64'})
+    for chunk in reader:
+        chunk = apply_correction_rules(chunk, compiled, "NYT-raw", counts=counts)
+        chunk = chunk[chunk['fips'].notna()]
+        allfips.append(np.unique(chunk['fips'].to_numpy().astype(np.int32)))
+        # (each date string is only parsed once)
+        dates = pd.to_datetime(chunk['date'].cat.categories, format="%Y-%m-%d")
+        day = (dates - first_date).days.to_numpy()[chunk['date'].cat.codes.to_numpy()]
+        inrange = (day >= 0) & (day < ndays)
+        chunk = chunk[inrange]
+        chunks.append(pd.DataFrame({
+            'day': day[inrange].astype(np.int16),
+            'fips': chunk['fips'].to_numpy().astype(np.int32),
+            'county': as_category(chunk['county']),
+            'state': as_category(chunk['state']),
+            'cases': chunk['cases'].astype('Int32').array,
+            'deaths': chunk['deaths'].astype('Int32').array}))
+    report_correction_rules(compiled, counts, "NYT-raw")
+    #=== Put the chunks together (with the same categories)
+    df = pd.DataFrame({'day': np.concatenate([c['day'].to_numpy() for c in chunks]),
+                       'fips': np.concatenate([c['fips'].to_numpy() for c in chunks])})
+    for col in ['county', 'state']:
+        df[col] = pd.api.types.union_categoricals([c[col] for c in chunks])
+    for col in ['cases', 'deaths']:
+        df[col] = pd.concat([c[col] for c in chunks], ignore_index=True)
+    allfips = np.unique(np.concatenate(allfips)).astype(int)
+    return [df, allfips]
+
+def read_jhu_raw(filename):
+    # Read a raw (wide) JHU file (see load_jhu_covid) as
+    #
+    #    [meta, values, datecols, dates]
+    #
+    # where meta is a dataframe of the metadata columns (everything
+    # before the first date, with FIPS/Admin2/Province_State renamed to
+    # [fips, county, state]), values the contiguous (row x date) integer
+    # matrix of the date columns, datecols their names (as in the file)
+    # and dates their (parsed once) datetimes.
+    with open(filename, newline='') as fh:
+        header = next(csv.reader(fh))
+    isdate = [(re.fullmatch(r"\d{1,2}/\d{1,2}/\d{2}", c) is not None) for c in header]
+    nmeta = isdate.index(True)
+    datecols = header[nmeta:]
+    dates = pd.to_datetime(pd.Series(datecols), format="%m/%d/%y")
+    table = pacsv.read_csv(filename, convert_options=pacsv.ConvertOptions(
+        column_types=dict([('FIPS', pa.float64())]
+                          + [(c, pa.int64()) for c in datecols])))
+    meta = table.select(header[:nmeta]).to_pandas()
+    meta = meta.rename(columns={'FIPS': 'fips', 'Admin2': 'county',
+                                'Province_State': 'state'})
+    values = np.empty((table.num_rows, len(datecols)), dtype=np.int64)
+    for j, c in enumerate(datecols):
+        values[:, j] = table.column(c).to_numpy()
+    return [meta, values, datecols, pd.DatetimeIndex(dates)]
 
-def nytjhu_create_composite_dmas(df, datatype, dmalist):
+def nyt_reshape_to_wide(df, allfips, first_date, last_date):
+    # Reshape the whole (long) NYT dataframe (see read_nyt_raw)
+    #
+    #    [day, fips, county, state, cases, deaths]
+    #
+    # into two JHU-like (wide) dataframes, one for cases and one for deaths
+    #
+    #    [fips, county, state, <day1 data>, <day2 data>, ...]
+    #
+    # with a row for each of allfips, over the dates [first_date:last_date].
+    # Missing days are filled forward from the last reported value, and days
+    # before the first report are set to zero.
+    daterng = pd.date_range(first_date, last_date)
+    rows = np.searchsorted(allfips, df['fips'].to_numpy())
+    days = df['day'].to_numpy()
+    # use the last reported county/state name for each fips
+    last = df[['day', 'fips']].sort_values('day', kind='stable')\
+        .drop_duplicates('fips', keep='last')
+    names = pd.DataFrame({'county': df['county'].astype(object).to_numpy()[last.index],
+                          'state': df['state'].astype(object).to_numpy()[last.index]},
+                         index=last['fips'].to_numpy())
+    names = names.reindex(allfips).fillna(0)
+    # use the JHU date format for the column names
+    datecols = daterng.strftime("%m/%d/%y").to_list()
+    wide_dfs = []
+    for col in ['cases', 'deaths']:
+        values = np.full((len(allfips), len(daterng)), np.nan)
+        values[rows, days] = df[col].astype('float64').to_numpy()
+        # fill nan entries
+        values = pd.DataFrame(values, index=allfips, columns=datecols)\
+                   .ffill(axis=1).fillna(0)
+        wide = pd.concat([names, values], axis=1)
+        wide.index.name = 'fips'
+        wide_dfs.append(wide.reset_index())
+    return wide_dfs
+
+def state_all_composites(df):
+    # Composite "All" entries for each state in the dataframe
+    #
+    #      * thus far, no redundant data (composite counties are
+    #        created afterwards), so we can just sum over state fips
+    #
+    #      * some "All" entries already exist with unknown data and
+    #        these are just added to the sum of all counties (and
+    #        then replaced by the new "All" entry)
+    #
+    composites = []
+    sfips = df['fips'].to_numpy().astype(int) // 1000
+    states = df['state'].to_numpy()
+    for s in np.unique(sfips):
+        statename = states[sfips == s][0]
+        composites.append({'fips': s*1000, 'county': "All", 'state': statename,
+                           'members_state': s, 'drop': [s*1000]})
+    return composites
+
+def dma_composites(datatype, dmalist, registry):
+    # Composite DMA (metro area) entries, taking into account
+    # special cases:
+    #
+    #       * states with composite counties (AK, MA, UT, NY)
+    #       * places in which cases/deaths are in "All" (PR, AS, NMI)
+    #
+    composites = []
     for d in dmalist:
         if (d in [156, 206, 36, 6, 1]):
             # use the composite counties for these places:
@@ -148,127 +381,247 @@ def nytjhu_create_composite_dmas(df, datatype, dmalist):
             #     Utah HD (dma-36), Dukes and ACK (dma-6),
             #     New York City (dma-1)
             #
-            onedma_df = \
-                counties_df[(counties_df['dma'] == d)
-                            & ( (counties_df['county_type'] == "regular")
-                                | (counties_df['county_type'] == "composite") )].copy()
+            fipslist = registry_dma_fips(registry, d, 'regular+composite')
         else:
             # otherwise just grab the regular counties
-            onedma_df = \
-                counties_df[(counties_df['dma'] == d)
-                            & (counties_df['county_type'] == "regular") ].copy()
-        dmaname = onedma_df['dmaname'].to_list()[0]
-        fipslist = onedma_df['fips'].to_list()
+            fipslist = registry_dma_fips(registry, d, 'regular')
+        dmaname = registry_fips_row(registry, fipslist[0])['dmaname']
         if ( (datatype == "cases") & (d in [500, 520]) ):
-            # For Northern Mariana and American Samoa, cases and deaths in "All"            
-            allfips = (fipslist[0] // 1000) * 1000            
-            df = create_composite_entry(df, [allfips], int(f"99{d:03d}"), dmaname, "",
-                                       dropall=False)    
+            # For Northern Mariana and American Samoa, cases and deaths in "All"
+            fipslist = [(fipslist[0] // 1000) * 1000]
         elif ( (datatype == "deaths") & (d in [500, 510, 520]) ):
             # PR deaths are also in "All" (though cases are in each county)
-            allfips = (fipslist[0] // 1000) * 1000
-            df = create_composite_entry(df, [allfips], int(f"99{d:03d}"),
-                                        dmaname, "", dropall=False)    
-        else:
-            df = create_composite_entry(df, fipslist, int(f"99{d:03d}"), dmaname, "",
-                                       dropall=False)    
-    return df
+            fipslist = [(fipslist[0] // 1000) * 1000]
+        composites.append({'fips': int(f"99{d:03d}"), 'county': dmaname, 'state': "",
+                           'members': fipslist})
+    return composites
 
-def nyt_make_fips_dicts(df, fips, first_date, last_date):
-    # Grab the subset of date-rows with this fips value
-    dfnew = df[df['fips'] == fips].copy()
-    # Grab column names
-    colnames = dfnew.columns.to_list()
-    # make the date a datetime
-    dfnew['date'] = pd.to_datetime(dfnew['date'], format="%Y-%m-%d")
-    # Extend the dates from [first_date:last_date]
-    daterng = pd.date_range(first_date, last_date)
-    dfnew = dfnew.set_index('date').reindex(daterng).reset_index()
-    # Fill Nan entries
-    dfnew.fillna(method="ffill", inplace=True)
-    dfnew.fillna(0, inplace=True)
-    # reset column names
-    dfnew.columns = colnames
-    # create dictionary entry like a JHU row
-    newdict_c = {}
-    newdict_d = {}    
-    newdict_c['fips'] = fips
-    newdict_c['county'] = dfnew['county'].to_list()[-1]
-    newdict_c['state'] = dfnew['state'].to_list()[-1]
-    newdict_d['fips'] = fips
-    newdict_d['county'] = dfnew['county'].to_list()[-1]
-    newdict_d['state'] = dfnew['state'].to_list()[-1]
-    for index, row in dfnew.iterrows():
-        # use the JHU date format
-        thedate = row['date'].strftime("%m/%d/%y")
-        newdict_c[thedate] = row['cases']
-        newdict_d[thedate] = row['deaths']        
-    return [newdict_c, newdict_d]
-
-def create_composite_entry(df, fips_list, newfips, newcounty, newstate,
-                           dropall=False):
+def build_composites(df, composites, values=None, valcols=None):
     """
     Works for both JHU and the JHU-type-adjusted NYT dataframes
+    (or, with values/valcols, a [fips, county, state] dataframe and
+    the matrix of its values with those column names)
+
+    Each composite is a dictionary with the new [fips, county, state] and
+    either 'members' (list of fips) or 'members_state' (state fips, for
+    all entries in that state).  Optionally, 'replace': True deletes the
+    member entries, and 'drop' is a list of fips whose (existing) entries
+    are deleted once the composite is made.
+
+    Composites are taken in order, and can include earlier composites.
+    Each one is worked out as a list of the original rows it sums over,
+    and then all of the new rows are made with one (sparse) matrix product
+    of this membership matrix and the values.
     """
-    target_rows = df[df['fips'].isin(fips_list)]
-    if dropall:
-        ind_to_drop = target_rows.index.to_list()
-    new_row = target_rows.sum()
-    new_row['fips'] = newfips
-    new_row['county'] = newcounty
-    new_row['state'] = newstate
-    new_row.name = df.index[-1] + 1
-    newdf = df.append([new_row])
-    if dropall:
-        newdf.drop(ind_to_drop, inplace=True)
+    if values is None:
+        valcols = [c for c in df.columns.to_list()
+                   if c not in ['fips', 'county', 'state']]
+        values = df[valcols].to_numpy()
+    base_fips = df['fips'].to_numpy().astype(int)
+    # every current entry is [fips, county, state, {original row: weight}]
+    entries = [[f, None, None, {i: 1}] for i, f in enumerate(base_fips)]
+    for c in composites:
+        if ('members_state' in c):
+            ismember = [(e[0] // 1000 == c['members_state']) for e in entries]
+        else:
+            members = set(c['members'])
+            ismember = [(e[0] in members) for e in entries]
+        weights = {}
+        for e, m in zip(entries, ismember):
+            if m:
+                for i, w in e[3].items():
+                    weights[i] = weights.get(i, 0) + w
+        if c.get('replace', False):
+            entries = [e for e, m in zip(entries, ismember) if not m]
+        if ('drop' in c):
+            entries = [e for e in entries if e[0] not in c['drop']]
+        entries.append([c['fips'], c['county'], c['state'], weights])
+    # membership matrix [entries x original rows]
+    rows = np.repeat(np.arange(len(entries)), [len(e[3]) for e in entries])
+    cols = np.array([i for e in entries for i in e[3]], dtype=int)
+    wts = np.array([w for e in entries for w in e[3].values()], dtype=int)
+    membership = scipy.sparse.csr_matrix((wts, (rows, cols)),
+                                         shape=(len(entries), len(df)))
+    newvalues = membership @ values
+    # county/state names from the original rows, or from the composite
+    isbase = np.array([(e[1] is None) for e in entries])
+    baserow = np.array([next(iter(e[3])) if (e[1] is None) else 0 for e in entries])
+    county = np.where(isbase, df['county'].to_numpy()[baserow],
+                      np.array([e[1] for e in entries], dtype=object))
+    state = np.where(isbase, df['state'].to_numpy()[baserow],
+                     np.array([e[2] for e in entries], dtype=object))
+    newdf = pd.DataFrame(newvalues, columns=valcols)
+    newdf.insert(0, 'fips', np.array([e[0] for e in entries]).astype(df['fips'].dtype))
+    newdf.insert(1, 'county', county)
+    newdf.insert(2, 'state', state)
     return newdf
 
-def jhu_drop_out_of_state(df):
-    ind_to_drop = []
-    for index, row in df.iterrows():
-        # The Puerto Rico entry has fips 72888, all others are 80XXX
-        if ( ((row.fips // 1000) == 80)
-             | (row.fips == 72888) ):
-            ind_to_drop.append(index)
-    df.drop(ind_to_drop, inplace=True)
-
-def jhu_drop_unassigned(df):
-    ind_to_drop = []
-    for index, row in df.iterrows():
-        # The Puerto Rico entry has fips 72999, all others are 80XXX
-        if ( ((row.fips // 1000) == 90)
-             | (row.fips == 72999) ):
-            ind_to_drop.append(index)
-    df.drop(ind_to_drop, inplace=True)
-
-def drop_by_fips(df, fips_list):
-    target_rows = df[df['fips'].isin(fips_list)]
-    ind_to_drop = target_rows.index.to_list()
-    df.drop(ind_to_drop, inplace=True)
+def compile_correction_rules(rules, dataname):
+    # Collect the rules for one dataframe (see the correction rules,
+    # below) into lookup tables, one for each set of matched columns:
+    #
+    #    {(matched columns): [<matched values>..., rule, date_begin, date_end]}
+    #
+    # The rule number is the position in the (kept) list of rules, so
+    # lower numbers take precedence.
+    kept = []
+    for r in rules:
+        if (dataname not in r['data']):
+            continue
+        if ( ('option' in r) and (not globals()[r['option']]) ):
+            continue
+        if (len(r['match']) == 0):
+            print("***Error correction rule needs at least one piece of data:",
+                  r['msg'])
+            exit(0)
+        kept.append(r)
+    tables = {}
+    for i, r in enumerate(kept):
+        keycols = tuple(sorted(r['match']))
+        entry = dict(r['match'])
+        entry['rule'] = i
+        entry['date_begin'], entry['date_end'] = r.get('dates', [None, None])
+        tables.setdefault(keycols, []).append(entry)
+    tables = {k: pd.DataFrame(v) for k, v in tables.items()}
+    return {'rules': kept, 'tables': tables}
+
+def report_correction_rules(compiled, counts, section):
+    # report the number of rows for each rule
+    for i, r in enumerate(compiled['rules']):
+        msg_to_usr(section, r['msg'] + f" ({counts[i]} rows)")
+
+def apply_correction_rules(df, compiled, section, counts=None):
+    # Apply all compiled correction rules to a dataframe with
+    # [fips, county, state] (and [date] for the raw NYT) columns
+    # in one pass: find the first rule matched by each row, and
+    # then change/drop all rows at once.
+    #
+    # The number of rows for each rule is reported, or added to
+    # counts if given (for data read in chunks).
+    rules = compiled['rules']
+    norule = len(rules)
+    keys = df[['fips', 'county', 'state']].reset_index(drop=True)
+    keys['fips'] = keys['fips'].astype(float)
+    keys['fips_state'] = keys['fips'] // 1000
+    keys['row'] = np.arange(len(keys))
+    ruleidx = np.full(len(keys), norule)
+    for keycols, table in compiled['tables'].items():
+        table = table.copy()
+        for col in ['fips', 'fips_state']:
+            if col in keycols:
+                table[col] = table[col].astype(float)
+        hits = keys[list(keycols) + ['row']].merge(table, on=list(keycols))
+        # only keep the date-window matches
+        windowed = hits['date_begin'].notna().to_numpy()
+        if windowed.any():
+            w = hits[windowed]
+            dates = df['date'].to_numpy()[w['row'].to_numpy()]
+            outside = np.zeros(len(hits), dtype=bool)
+            outside[windowed] = ( (dates < w['date_begin'].to_numpy())
+                                  | (dates > w['date_end'].to_numpy()) )
+            hits = hits[~outside]
+        np.minimum.at(ruleidx, hits['row'].to_numpy(), hits['rule'].to_numpy())
+    if counts is None:
+        report_correction_rules(compiled, np.bincount(ruleidx, minlength=norule+1),
+                                section)
+    else:
+        counts += np.bincount(ruleidx, minlength=norule+1)
+    # change values
+    df = df.copy()
+    for col in ['fips', 'county', 'state']:
+        newvals = np.array([r.get('change', {}).get(col) for r in rules] + [None],
+                           dtype=object)
+        tochange = np.array([(v is not None) for v in newvals])[ruleidx]
+        if tochange.any():
+            vals = newvals[ruleidx[tochange]]
+            if (col == 'fips'):
+                vals = vals.astype(float)
+            elif isinstance(df[col].dtype, pd.CategoricalDtype):
+                newcats = pd.Index(np.unique(vals)).difference(df[col].cat.categories)
+                df[col] = df[col].cat.add_categories(newcats)
+            df.loc[tochange, col] = vals
+    # drop rows
+    todrop = np.array([r.get('drop', False) for r in rules] + [False])[ruleidx]
+    return df[~todrop]
 
 ##################################################################
 # Collect and output the County/State FIPS, and DMA (Metro) data #
 ##################################################################
+def report_unmatched_fips(counties_df, unmatched, msg):
+    # Print a table of the counties that were not matched in a join
+    if unmatched.any():
+        print("***Error " + msg + " for " + str(unmatched.sum()) + " counties:")
+        print(counties_df.loc[unmatched, ['fips', 'county', 'fips_state']]\
+              .to_string(index=False))
+
+def read_dbf_fields(filename, fields, encoding):
+    # Read the given (character) fields of all records of a dBASE
+    # table (the attribute table of a shapefile, *.dbf) as strings,
+    # without reading the shapes:
+    #
+    #    header: number of records (bytes 4-7), header length (8-9),
+    #            record length (10-11), then a 32-byte descriptor for
+    #            each field [name (0-10), type (11), length (16)], up
+    #            to a 0x0D byte
+    #    records: fixed length, after the header, each starting with
+    #             a deletion flag ("*" for deleted records)
+    #
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    nrecords = int.from_bytes(data[4:8], 'little')
+    headerlen = int.from_bytes(data[8:10], 'little')
+    recordlen = int.from_bytes(data[10:12], 'little')
+    offsets = {}
+    offset = 1
+    for i in range(32, headerlen - 1, 32):
+        if (data[i] == 0x0D):
+            break
+        name = data[i:i+11].split(b'\0')[0].decode('ascii')
+        length = data[i+16]
+        offsets[name] = [offset, length]
+        offset += length
+    for f in fields:
+        if f not in offsets:
+            print("***Error field", f, "not in", filename)
+            exit(0)
+    records = np.frombuffer(data, dtype=np.uint8, offset=headerlen,
+                            count=nrecords*recordlen).reshape(nrecords, recordlen)
+    keep = records[:, 0] != ord("*")
+    columns = {}
+    for f in fields:
+        start, length = offsets[f]
+        raw = np.ascontiguousarray(records[keep, start:start+length])\
+                .view(f"S{length}").ravel()
+        columns[f] = [v.decode(encoding).strip() for v in raw]
+    return pd.DataFrame(columns)
+
+def read_shape_attributes(shapefile, fields):
+    # The fields of a shapefile's attribute table (see read_dbf_fields),
+    # cached in shape_cache_dir under the checksum of the .dbf file, so
+    # they are only read again when the shapefile changes
+    stem = shapefile[:-len(".shp")]
+    checksum = path_sha256(stem + ".dbf")
+    cachefile = shape_cache_dir + os.path.basename(stem) + "_" \
+        + checksum[:16] + "_" + "-".join(fields) + ".csv"
+    if os.path.exists(cachefile):
+        return pd.read_csv(cachefile, dtype=str, keep_default_na=False)
+    # (the .cpg file names the encoding of the text fields)
+    encoding = "latin-1"
+    if os.path.exists(stem + ".cpg"):
+        with open(stem + ".cpg") as fh:
+            encoding = fh.read().strip() or encoding
+    df = read_dbf_fields(stem + ".dbf", fields, encoding)
+    os.makedirs(shape_cache_dir, exist_ok=True)
+    df.to_csv(cachefile, index=False)
+    return df
+
 def output_fips_dma_file():
-    #=== File paths and output file name
-    #       Use same source for FIPS as PWPD and
-    #       same source for DMAs as Google Trends
-    pwpd_dir = "../pwpd/"
-    UScounty_shape_dir = "data/shapefiles/UScounties/"
-    UScounty_shape_filepath = \
-        pwpd_dir + UScounty_shape_dir \
-        + "tl_2019_us_county/tl_2019_us_county.shp"
-    USstate_fips_filepath = \
-        pwpd_dir + UScounty_shape_dir \
-        + "US-state_fips-codes.csv"
-    trends_dir = "../trends/"
-    countyDMA_filename = \
-        trends_dir + "data/dma/county_dma_sood-gaurav-harvard-dataverse_edited.csv"
-    #=== Load the shapes file and keep only FIPS information
+    #=== Load the attribute table of the shapes file (not the shapes),
+    #    and keep only FIPS information
     #    (these code snippets mostly taken from pwpd.py)
-    msg_to_usr("FIPS-collection", "Loading shapefile...")
-    counties_df = gpd.read_file(UScounty_shape_filepath)
-    counties_df = counties_df[['STATEFP', 'COUNTYFP', 'NAME', 'NAMELSAD']]
+    msg_to_usr("FIPS-collection", "Loading shapefile attributes...")
+    counties_df = read_shape_attributes(UScounty_shape_filepath,
+                                        ['STATEFP', 'COUNTYFP', 'NAME', 'NAMELSAD'])
     counties_df.columns = \
         ['fips_state', 'fips_county', 'county', 'countylong']
     #=== Make FIPS codes integer-valued
@@ -282,85 +635,52 @@ def output_fips_dma_file():
     #=== Add the state name and abbreviation for each county
     #    using the file of US state FIPS codes
     msg_to_usr("FIPS-collection", "Getting state names...")
-    counties_df['state'] = ""
-    counties_df['stateabb'] = ""
     statefips_df = pd.read_csv(USstate_fips_filepath)
     statefips_df['fips'] = statefips_df['fips'].astype(int)
-    for index,row in counties_df.iterrows():
-        fips = row.fips_state
-        thestate = (statefips_df['fips'] == fips)
-        counties_df.at[index,'state'] = \
-            statefips_df[thestate]['name'].to_list()[0]
-        counties_df.at[index,'stateabb'] = \
-            statefips_df[thestate]['abb'].to_list()[0]
+    statefips_df = statefips_df.drop_duplicates('fips')[['fips', 'name', 'abb']]
+    statefips_df.columns = ['fips_state', 'state', 'stateabb']
+    counties_df = counties_df.merge(statefips_df, how='left', on='fips_state')
+    report_unmatched_fips(counties_df, counties_df['state'].isna(),
+                          "no state found in " + USstate_fips_filepath)
+    counties_df[['state', 'stateabb']] = \
+        counties_df[['state', 'stateabb']].fillna("")
     #=== Add metro area
-    #    (code copied mostly from get-trends-by-county.py)
+    #    (one DMA for each county, keyed on state and county FIPS;
+    #     the first one listed if the crosswalk has more than one)
     msg_to_usr("FIPS-collection", "Getting Metro Areas...")
-    counties_df['dma'] = 0
-    counties_df['dmaname'] = ""
     DMA_df = pd.read_csv(countyDMA_filename)
-    for index, row in counties_df.iterrows():
-        #--- get fips data 
-        sfips = row.fips_state
-        cfips = row.fips_county
-        name = row.county + "," + row.stateabb
-        #print(sfips, cfips, name)
-        #--- select out dma entry for that county
-        cdma = DMA_df[(DMA_df.STATEFP == sfips)
-                      & (DMA_df.CNTYFP == cfips)]
-        if (cdma.size == 0):
-            print(   "***Error not found***")
-            dma = -1
-            sabb = ''
-        else:
-            # find the DMA value
-            dma = cdma['DMAINDEX'].to_numpy()[0]
-            dmaname = cdma['shortDMA'].to_numpy()[0]
-        #--- place into dataframe
-        counties_df.at[index,'dma'] = dma
-        counties_df.at[index,'dmaname'] = dmaname
+    DMA_df = DMA_df[['STATEFP', 'CNTYFP', 'DMAINDEX', 'shortDMA']]\
+        .drop_duplicates(['STATEFP', 'CNTYFP'])
+    DMA_df.columns = ['fips_state', 'fips_county', 'dma', 'dmaname']
+    counties_df = counties_df.merge(DMA_df, how='left',
+                                    on=['fips_state', 'fips_county'])
+    notfound = counties_df['dma'].isna()
+    report_unmatched_fips(counties_df, notfound,
+                          "no DMA found in " + countyDMA_filename)
+    counties_df['dma'] = counties_df['dma'].fillna(-1).astype(int)
+    counties_df['dmaname'] = counties_df['dmaname'].fillna("")
     #=== Add entries for each DMA
-    DMA_fips = np.unique(counties_df['dma'].to_list())
-    newfipdicts = []
-    for d in DMA_fips:
-        dmaname = counties_df[counties_df['dma'] == d]\
-            ['dmaname'].to_list()[0]
-        newentry = {
-            'fips_state': 99,
-            'fips_county': d,
-            'fips': int(f"99{d:03d}"),
-            'state': "",
-            'stateabb': "",
-            'county': dmaname,
-            'countylong': dmaname + " --- DMA (not a real FIPS)",
-            'dma': d,
-            'dmaname': dmaname
-        }
-        newfipdicts.append(newentry)
-    counties_df = counties_df.append(newfipdicts, ignore_index=True, sort=False)        
+    #    (named after the first county found in each)
+    dmas_df = counties_df[~notfound].groupby('dma', as_index=False)\
+        ['dmaname'].first()
+    dmas_df['fips_state'] = 99
+    dmas_df['fips_county'] = dmas_df['dma']
+    dmas_df['fips'] = 99000 + dmas_df['dma']
+    dmas_df['state'] = ""
+    dmas_df['stateabb'] = ""
+    dmas_df['county'] = dmas_df['dmaname']
+    dmas_df['countylong'] = dmas_df['dmaname'] + " --- DMA (not a real FIPS)"
     #=== Add entries for each state
-    states_fips = np.unique(counties_df['fips_state'].to_list())
-    # remove the DMA "state"
-    states_fips = np.delete(states_fips, np.where(states_fips == 99))
-    newfipdicts = []
-    for s in states_fips:
-        statename = counties_df[counties_df['fips_state'] == s]\
-            ['state'].to_list()[0]
-        stateabb =  counties_df[counties_df['fips_state'] == s]\
-            ['stateabb'].to_list()[0]
-        newentry = {
-            'fips_state': s,
-            'fips_county': 0,
-            'fips': s*1000,
-            'state': statename,
-            'stateabb': stateabb,
-            'county': 'All',
-            'countylong': statename + " --- All (not a real FIPS)",
-            'dma': -1,
-            'dmaname': ""
-        }
-        newfipdicts.append(newentry)
-    counties_df = counties_df.append(newfipdicts, ignore_index=True, sort=False)
+    states_df = counties_df.groupby('fips_state', as_index=False)\
+        [['state', 'stateabb']].first()
+    states_df['fips_county'] = 0
+    states_df['fips'] = states_df['fips_state']*1000
+    states_df['county'] = 'All'
+    states_df['countylong'] = states_df['state'] + " --- All (not a real FIPS)"
+    states_df['dma'] = -1
+    states_df['dmaname'] = ""
+    counties_df = pd.concat([counties_df, dmas_df, states_df],
+                            ignore_index=True, sort=False)
     #=== Delete the Valdez-Cordova (AK) entry.  Will be replaced below with Chugach+Copper River
     counties_df = counties_df[counties_df['fips'] != 2261]
     #=== Add a "county-type" variable
@@ -630,101 +950,141 @@ def output_fips_dma_file():
             'dmaname': None
         }
     ]
-    counties_df = counties_df.append(newfipdicts, ignore_index=True, sort=False)
+    counties_df = pd.concat([counties_df, pd.DataFrame(newfipdicts)],
+                            ignore_index=True, sort=False)
     #=== Sort and output
     counties_df = counties_df.sort_values(['fips_state', 'fips_county'])
     counties_df.to_csv(outfilename_statecounty_fips, index=False)
     #=== Return the counties dataframe
     return counties_df
 
+###########################################################
+# FIPS registry                                           #
+#                                                         #
+#   The counties fips file, indexed once, so that lookups #
+#   in the loops below are dictionary lookups instead of  #
+#   scans of counties_df:                                 #
+#                                                         #
+#     df:        counties_df                              #
+#     row:       {fips: row in df}                        #
+#     by_state:  {fips_state: [fips]}                     #
+#     by_dma:    {dma: [fips]}                            #
+#     by_type:   {county_type: [fips]}                    #
+#     by_ccfips: {composite fips: [part-of-composite]}    #
+#     dmas:      sorted dma numbers (as get_dmalist)      #
+#     coverings: {name: {'fips', 'by_state', 'by_dma'}}   #
+#                                                         #
+#   where the coverings are the sets of entries that      #
+#   cover the country once (see output_fips_dma_file):    #
+#                                                         #
+#     'regular+composite', 'regular+part-of-composite',   #
+#     'regular', 'metro', 'state'                         #
+#                                                         #
+###########################################################
+fips_coverings = {'regular+composite': ["regular", "composite"],
+                  'regular+part-of-composite': ["regular", "part-of-composite"],
+                  'regular': ["regular"],
+                  'metro': ["metro"],
+                  'state': ["state"]}
+
+def group_fips(fips, keys):
+    # {key: [fips]} (in the order of fips)
+    groups = {}
+    for f, k in zip(fips, keys):
+        groups.setdefault(k, []).append(f)
+    return groups
+
+def build_fips_registry(counties_df):
+    counties_df = counties_df.reset_index(drop=True)
+    fips = counties_df['fips'].to_numpy().astype(int).tolist()
+    fips_state = counties_df['fips_state'].to_numpy().astype(int).tolist()
+    dma = counties_df['dma'].fillna(-1).to_numpy().astype(int).tolist()
+    county_type = counties_df['county_type'].to_list()
+    ccfips = counties_df['ccFIPS'].to_numpy()
+    incc = ~np.isnan(ccfips)
+    registry = {'df': counties_df,
+                'row': {f: i for i, f in enumerate(fips)},
+                'by_state': group_fips(fips, fips_state),
+                'by_dma': group_fips(fips, dma),
+                'by_type': group_fips(fips, county_type),
+                'by_ccfips': group_fips(np.array(fips)[incc].tolist(),
+                                        ccfips[incc].astype(int).tolist()),
+                'dmas': sorted(d for d in set(dma) if d >= 0)}
+    registry['coverings'] = {}
+    for name, types in fips_coverings.items():
+        incovering = [(t in types) for t in county_type]
+        keep = lambda vals: [v for v, i in zip(vals, incovering) if i]
+        registry['coverings'][name] = {
+            'fips': keep(fips),
+            'by_state': group_fips(keep(fips), keep(fips_state)),
+            'by_dma': group_fips(keep(fips), keep(dma))}
+    return registry
+
+def registry_fips_row(registry, fips):
+    # the counties_df row (as a series) for one fips
+    return registry['df'].iloc[registry['row'][int(fips)]]
+
+def registry_dma_fips(registry, dma, covering):
+    # the fips of one dma in a covering (e.g., 'regular')
+    return registry['coverings'][covering]['by_dma'].get(dma, [])
+
 ##################################################################
-#  Load and arrange NYT and JHU Covid19 Cases and Deaths         #
-#                                                                #
-#     Basic principles:                                          #
-#                                                                #
-#       * For counties that are combined in JHU/NYTimes, e.g.,   #
-#             - New York City (NYT)                              #
-#             - two pairs of counties in Alaska (one pair JHU)   #
-#             - Utah Health Districts (JHU)                      #
-#         create multi-county entries for both, but retain       #
-#         county data if it exists in one source, and delete     #
-#         county data if it is zero in one source.               #
-#                                                                #
-#       * When making new fake FIPS codes, start at county fips  #
-#         901.  And delete fake fips codes from NYT/JHU          #
+#  Geographic corrections for the raw NYT and JHU data           #
 #                                                                #
-#       * Move multi-county cities to single county (i.e., in    #
-#         NYT, move Joplin, MO to Jasper County and KC, MO to    #
-#         Jackson County; and delete the city                    #
+#     Each rule is a dictionary with:                            #
 #                                                                #
-#       * Generally delete "unknown" (NYT) or "out of <state>"   #
-#         and "unassigned" data (JHU) entries, unless they are   #
-#         both a large number/fraction of cases/deaths AND       #
-#         they represent a true cumulative count.  In that case  #
-#         move them to an "all" county with 000 county fips.     #
-#                                                                #
-#       * Create all multi-county DMAs in each data set          #
+#       'data'   : list of dataframes the rule applies to:       #
+#                    "nyt"        - raw (long) NYT data          #
+#                    "nyt_deaths" - wide NYT deaths data         #
+#                    "jhu_cases", "jhu_deaths" - raw JHU data    #
+#       'match'  : {column: value} that must all be equal, with  #
+#                  columns from [fips, county, state,            #
+#                  fips_state] (where fips_state = fips // 1000) #
+#       'dates'  : (optional) [date_begin, date_end] (NYT only)  #
+#       'change' : {column: new value} for [fips, county, state] #
+#                  (an empty dict just keeps the row as-is)      #
+#         or                                                     #
+#       'drop'   : True to delete the matched rows               #
+#       'option' : (optional) name of a True/False option above  #
+#                  that turns the rule on                        #
+#       'msg'    : message to the user                           #
 #                                                                #
-#       * Give FIPS to those that are missing (e.g., Guam in     #
-#         NYT)                                                   #              
+#     The rules are applied all at once: each row gets the FIRST #
+#     rule (in list order) that it matches, so specific rules    #
+#     must come before general ones (e.g., Guam, whose county is #
+#     "Unknown", before dropping all of the "Unknown" entries).  #
 #                                                                #
 ##################################################################
-def load_nyt_jhu_covid():
-    # Filenames of raw data
-    #
-    #     * NYTimes is cumulative [cases,deaths] with the form:
-    #           [date, county <name>, state <name>,
-    #            fips <5-digit>, cases <cum>, deaths <cum>]
-    #
-    #          https://github.com/nytimes/covid-19-data
-    #
-    #     * JHU is cumulative cases and deaths in separate files,
-    #       each with form:
-    #
-    #           [UID, iso2, iso3, code3, FIPS <5-digit>,
-    #            Admin2 <county name>, Province_State <state name>,
-    #            Country_Region, Lat, Long_, Combined_Key <full name>,
-    #            1/22/20, ... <all dates> ..., today]
-    #
-    #          https://github.com/CSSEGISandData/COVID-19
-    #          https://doi.org/10.1016/S1473-3099(20)30120-1
-    #
-    # - Need to deal with the oddball entries of each.
-    #   See "Geographic Exceptions" on their github page
-    #
-    #
-    # Output form:
-    #
-    #   [fips, county, state, <cases/deaths on date1>, <... date2>, ...]
-    #
-    
-    #===============================
-    #==== Read in NYTimes data =====
-    #===============================
-    nytraw_df = pd.read_csv(filename_nyt_raw)
+nyt_correction_rules = [
     #=========================================================
     #==== Assign (temporary) fake-FIPS for KC and Joplin =====
     #=========================================================
     # these will be removed later when added into their respective counties
-    msg_to_usr("NYT-raw", "Assigning temporary fake-FIPS to Kansas City")
-    nytjhu_change_data(nytraw_df, county="Kansas City", state="Missouri",
-                       newfips=29998)
-    msg_to_usr("NYT-raw", "Assigning temporary fake-FIPS to Joplin")
-    nytjhu_change_data(nytraw_df, county="Joplin", state="Missouri",
-                       newfips=29999)
+    {'data': ["nyt"],
+     'match': {'county': "Kansas City", 'state': "Missouri"},
+     'change': {'fips': 29998},
+     'msg': "Assigning temporary fake-FIPS to Kansas City"},
+    {'data': ["nyt"],
+     'match': {'county': "Joplin", 'state': "Missouri"},
+     'change': {'fips': 29999},
+     'msg': "Assigning temporary fake-FIPS to Joplin"},
     #==================================================
     #==== Assign fake-FIPS for composite counties =====
     #==================================================
     #=== Deal with the NYC entries
     #      NYTimes lists all five boroughs under "New York City" with no FIPS
     # ---> Create new FIPS 36901
-    msg_to_usr("NYT-raw", "Assigning fake-FIPS to NYC")
-    nytjhu_change_data(nytraw_df, county="New York City", newfips=36901)
+    {'data': ["nyt"],
+     'match': {'county': "New York City"},
+     'change': {'fips': 36901},
+     'msg': "Assigning fake-FIPS to NYC"},
     #=== Deal with the Guam entries
     #    NYTimes lists the county for Guam as "Unknown" with no FIPS
     # ---> Change county to "Guam" and FIPS to its only one: 66010
-    msg_to_usr("NYT-raw", "Asigning FIPS to Guam")
-    nytjhu_change_data(nytraw_df, state="Guam", newcounty="Guam", newfips=66010)
+    {'data': ["nyt"],
+     'match': {'state': "Guam"},
+     'change': {'county': "Guam", 'fips': 66010},
+     'msg': "Asigning FIPS to Guam"},
     #=== Deal with Alaska combined-county entries
     #    NYTimes combines the following counties and gives them
     #    fake FIPS codes:
@@ -736,10 +1096,18 @@ def load_nyt_jhu_covid():
     #    than the new/correct (in 2019) Chugach (2063) and Copper River (2066)
     #      * Valdez-Cordova (2261) --> Chugach + Copper River (2903)
     # ---> Create new FIPS entries 2901 and 2902, respectively
-    msg_to_usr("NYT-raw", "Re-assigning fake-FIPS for two Alaska county pairs")
-    nytjhu_change_data(nytraw_df, fips=2997, newfips=2901)
-    nytjhu_change_data(nytraw_df, fips=2998, newfips=2902)
-    nytjhu_change_data(nytraw_df, fips=2261, newfips=2903)    
+    {'data': ["nyt"],
+     'match': {'fips': 2997},
+     'change': {'fips': 2901},
+     'msg': "Re-assigning fake-FIPS for Bristol Bay plus Lake and Peninsula (AK)"},
+    {'data': ["nyt"],
+     'match': {'fips': 2998},
+     'change': {'fips': 2902},
+     'msg': "Re-assigning fake-FIPS for Yakutat plus Hoonah-Angoon (AK)"},
+    {'data': ["nyt"],
+     'match': {'fips': 2261},
+     'change': {'fips': 2903},
+     'msg': "Re-assigning fake-FIPS for Valdez-Cordova (AK)"},
     #=====================================================
     #=== Deal with the other "Unknown" county entries ====
     #=====================================================
@@ -807,10 +1175,11 @@ def load_nyt_jhu_covid():
     #        and remove other entries
     #        ---> Change "Unknown" to "Saipan" for entries prior to 2020-07-14
     #        ---> Drop "Unknown" entries after 2020-07-14
-    msg_to_usr("NYT-raw", "Putting early unknown for MP into Saipan")    
-    nytjhu_change_data(nytraw_df, state="Northern Mariana Islands",
-                    county="Unknown", newcounty="Saipan", newfips=69110,
-                    date_begin="2020-01-01", date_end="2020-07-13")
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Northern Mariana Islands"},
+     'dates': ["2020-01-01", "2020-07-13"],
+     'change': {'county': "Saipan", 'fips': 69110},
+     'msg': "Putting early unknown for MP into Saipan"},
     #    PR: 100% of deaths are Unknown, and increase monotonically,
     #              as expected (these *are* cumulative numbers)
     #        100% of cases prior to 2020-05-05 are Unknown, then dropping
@@ -818,236 +1187,106 @@ def load_nyt_jhu_covid():
     #        3% of cases are Unknown, but do not increase monotonically
     #        ---> Change "Unknown" to "All" with county FIPS 000
     #        ---> delete all puerto rico counties in "deaths" files (below)
-    msg_to_usr("NYT-raw", "Moving unknown cases and deaths in PR to \"All\"")
-    nytjhu_change_data(nytraw_df, county="Unknown", state="Puerto Rico",
-                    newfips=72000, newcounty="All")
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Puerto Rico"},
+     'change': {'county': "All", 'fips': 72000},
+     'msg': "Moving unknown cases and deaths in PR to \"All\""},
     #    RI: 100% of cases and deaths are Unknown before 2020-03-25. A
     #        significant fraction (50-100%) of deaths remain Unknown through
     #        2020-05-02.  Then the percentage drops to 10% through the end of
     #        June2020, and is 1-5% after that ... no idea what is going on.
     #        ---> Before 2020-05-03: Change "Unknown" to "All" with county FIPS 000
     #        ---> Otherwise: Unfixable, drop "Unknown" entries
-    msg_to_usr("NYT-raw", "Moving early unknown cases and deaths in RI to \"All\"")    
-    nytjhu_change_data(nytraw_df, state="Rhode Island",
-                    county="Unknown", newcounty="All", newfips=44000,
-                    date_begin="2020-01-01", date_end="2020-05-02")
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Rhode Island"},
+     'dates': ["2020-01-01", "2020-05-02"],
+     'change': {'county': "All", 'fips': 44000},
+     'msg': "Moving early unknown cases and deaths in RI to \"All\""},
     #    TN: Couple high percentages in early days, 1% later
     #        ---> Unfixable, drop "Unknown" entries
     #
     #    UT: High percentages 2020-03-27 through 2020-04-15, then drop off
     #        to 3-6% until 2020-07-16, then approx zero percent unknown
     #        ---> Before 2020-04-16: Change "Unknown" to "All" with county FIPS 000
-    #        ---> Otherwise: Unfixable, drop "Unknown" entries    
-    msg_to_usr("NYT-raw", "Moving early unknown cases and deaths in UT to \"All\"")
-    nytjhu_change_data(nytraw_df, state="Utah",
-                    county="Unknown", newcounty="All", newfips=49000,
-                    date_begin="2020-01-01", date_end="2020-04-15")
+    #        ---> Otherwise: Unfixable, drop "Unknown" entries
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Utah"},
+     'dates': ["2020-01-01", "2020-04-15"],
+     'change': {'county': "All", 'fips': 49000},
+     'msg': "Moving early unknown cases and deaths in UT to \"All\""},
     #    VT: High percentages before 2020-04-08, then death percentage unknown
     #        drops to zero (cases at 0.5%).
     #        ---> Before 2020-04-08: Change "Unknown" to "All" with county FIPS 000
     #        ---> Otherwise: Unfixable, drop "Unknown" entries
-    msg_to_usr("NYT-raw", "Moving early unknown cases and deaths in VT to \"All\"")
-    nytjhu_change_data(nytraw_df, state="Vermont",
-                    county="Unknown", newcounty="All", newfips=50000,
-                    date_begin="2020-01-01", date_end="2020-04-07")
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Vermont"},
+     'dates': ["2020-01-01", "2020-04-07"],
+     'change': {'county': "All", 'fips': 50000},
+     'msg': "Moving early unknown cases and deaths in VT to \"All\""},
     #    VI: All Virgin Islands deaths are listed under "Unknown" before 2020-07-23,
     #        then everything is properly assigned them to the correct "county". There
     #        are four more "Unknown" entries from random days in 2021.
     #        ---> Before 2020-07-23: Change "Unknown" to "All" with county FIPS 000
     #        ---> Otherwise: do same... there's only 4 other entries with 1 case/death
-    msg_to_usr("NYT-raw", "Moving early unknown cases and deaths in VI to \"All\"")
-    nytjhu_change_data(nytraw_df, state="Virgin Islands",
-                    county="Unknown", newcounty="All", newfips=78000)
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Virgin Islands"},
+     'change': {'county': "All", 'fips': 78000},
+     'msg': "Moving early unknown cases and deaths in VI to \"All\""},
     #
     #   VA: Unknown deaths make up significant percentage before 2020-04-21, then
     #       basically zero.
     #        ---> Before 2020-04-08: Change "Unknown" to "All" with county FIPS 000
     #        ---> Otherwise: Unfixable, drop "Unknown" entries
-    msg_to_usr("NYT-raw", "Moving early unknown cases and deaths in VA to \"All\"")    
-    nytjhu_change_data(nytraw_df, state="Virginia",
-                    county="Unknown", newcounty="All", newfips=51000,
-                    date_begin="2020-01-01", date_end="2020-04-07")
+    {'data': ["nyt"],
+     'match': {'county': "Unknown", 'state': "Virginia"},
+     'dates': ["2020-01-01", "2020-04-07"],
+     'change': {'county': "All", 'fips': 51000},
+     'msg': "Moving early unknown cases and deaths in VA to \"All\""},
     #   WI: 6-8% of cases from 2020-06-10 to 2020-09-03 are Unknown, but less than
     #       1% of deaths
     #        ---> Unfixable, drop "Unknown" entries
     #
     # Dropping all Unknown entries...
-    msg_to_usr("NYT-raw", "Dropping all other \"Unknown\" cases and deaths")    
-    nytraw_df = nytraw_df[(nytraw_df['county'] != 'Unknown')] # delete all unknown
-
-    #================================================
-    #==== Read in JHU data to get the date range ====
-    #================================================
-    #
-    # JHU columns:
-    #    [UID, iso2, iso3, code3, FIPS <5-digit>,
-    #     Admin2 <county name>, Province_State <state name>,
-    #     Country_Region, Lat, Long_, Combined_Key <full name>,
-    #     1/22/20, ... <all dates> ..., <download date>]
-    #
-    jhuraw_c_df = pd.read_csv(filename_jhu_cases_raw)
-    jhuraw_d_df = pd.read_csv(filename_jhu_deaths_raw)
-    # Use JHU dataframe to determine range of dates for both it and NYT
-    first_date = dt.datetime.strptime(jhuraw_c_df.columns.to_list()[11], "%m/%d/%y")
-    last_date = dt.datetime.strptime(jhuraw_c_df.columns.to_list()[-1], "%m/%d/%y")
-
-    #===========================================
-    #==== Rearrange NYT data to be like JHU ====
-    #===========================================    
-    msg_to_usr("NYT-raw", "Re-arranging NYTimes data to look like JHU (takes few minutes)")
-    allfips = np.unique(nytraw_df['fips'].to_list()).astype(int)
-    # make two dictionary entries (cases and deaths) for each fip
-    #   {fips: XXXXX, 1/22/2020: X, 1/23/2020: X, ..., <last_date>: X}
-    fip_dicts_c = []
-    fip_dicts_d = []
-    for f in allfips:
-        fd_c, fd_d = nyt_make_fips_dicts(nytraw_df, f, first_date, last_date)
-        fip_dicts_c.append(fd_c)
-        fip_dicts_d.append(fd_d)        
-    # create new dataframe from list of dictionary entries
-    # (one for cases one for deaths)
-    nyt_c_df = pd.DataFrame(fip_dicts_c)
-    nyt_d_df = pd.DataFrame(fip_dicts_d)    
-        
-    #================================================================
-    #==== Moving the Kansas City and Joplin values into counties ====
-    #================================================================
-    #=== Deal with the Kansas City entries
-    #      NYTimes lists Kansas City, MO separately with no FIPS
-    #
-    # --> Move to Jackson County (29095)
-    #      (Northern parts in Platte and Clay, but oh well) 
-    msg_to_usr("NYT-raw", "Moving Kansas City to Jackson County")
-    nyt_c_df = create_composite_entry(nyt_c_df, [29998,29095], 29095, "Jackson", "Missori",
-                                      dropall=True)
-    nyt_d_df = create_composite_entry(nyt_d_df, [29998,29095], 29095, "Jackson", "Missori",
-                                      dropall=True)
-    #=== Deal with the Joplin entries
-    #      NYTimes lists Joplin, MO separately with no FIPS (starting 2020-06-25)
-    # Move to Jasper County (29097) (southern part of Joplin in Newton, but oh well)
-    msg_to_usr("NYT-raw", "Moving Joplin to Jasper County")
-    nyt_c_df = create_composite_entry(nyt_c_df, [29999,29097], 29097, "Jasper", "Missori",
-                                      dropall=True)
-    nyt_d_df = create_composite_entry(nyt_d_df, [29999,29097], 29097, "Jasper", "Missori",
-                                      dropall=True)
+    {'data': ["nyt"],
+     'match': {'county': "Unknown"},
+     'drop': True,
+     'msg': "Dropping all other \"Unknown\" cases and deaths"},
     #===============================================================
     #==== Delete the Puerto Rico Counties from deaths dataframe ====
     #===============================================================
-    msg_to_usr("NYT-raw", "Dropping all other PR counties from deaths" )            
-    ind_to_drop = []
-    for index, row in \
-        nyt_d_df[nyt_d_df['state'] == "Puerto Rico"].iterrows():
-        if (row['county'] != "All"):
-            ind_to_drop.append(index)
-    nyt_d_df.drop(ind_to_drop, inplace=True)
-    #====================================================================
-    #==== Create "All" composite-county entries for each state (NYT) ====
-    #====================================================================
-    #
-    #      * thus far, no redundant data (we'll make some below with
-    #        composite counties), so we can just sum over state fips
-    #
-    #      * I have some "All" entries already with unknown data and
-    #        these will just be added to the sum of all counties
-    #
-    #      * Must delete the previous "All" entries (i.e., PR-deaths,
-    #        VI, AS, NMI, and  IL, IN, TN, MA) so give them a fake fips
-    #        ahead of time, and then delete that afterwards
-    #
-    msg_to_usr("NYT-raw", "Creating composite \"All\" entries for each state")
-    nyt_c_df = nytjhu_create_composite_alls(nyt_c_df)
-    nyt_d_df = nytjhu_create_composite_alls(nyt_d_df)
-    #=======================================================
-    #==== Create a few composite-county entries for NYT ====
-    #=======================================================
-    #=== Utah Health Districts
-    msg_to_usr("NYT-raw", "Creating the Utah HD: Bear River")
-    nyt_c_df = create_composite_entry(nyt_c_df, [49003, 49005, 49033],
-                                      49901, "Bear River", "Utah", dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [49003, 49005, 49033],
-                                      49901, "Bear River", "Utah", dropall=False)
-    msg_to_usr("NYT-raw", "Creating the Utah HD: Central Utah")
-    nyt_c_df = create_composite_entry(nyt_c_df, [49023, 49027, 49031, 49039, 49041, 49055], 
-                                     49902, "Central Utah", "Utah", dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [49023, 49027, 49031, 49039, 49041, 49055],
-                                      49902, "Central Utah", "Utah", dropall=False)
-    msg_to_usr("NYT-raw", "Creating the Utah HD: Southeast Utah")
-    nyt_c_df = create_composite_entry(nyt_c_df, [49007, 49015, 49019],
-                                      49903, "Southeast Utah", "Utah", dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [49007, 49015, 49019],
-                                      49903, "Southeast Utah", "Utah", dropall=False)
-    msg_to_usr("NYT-raw", "Creating the Utah HD: Southwest Utah")
-    nyt_c_df = create_composite_entry(nyt_c_df, [49001, 49017, 49021, 49025, 49053],
-                                      49904, "Southwest", "Utah", dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [49001, 49017, 49021, 49025, 49053],
-                                      49904, "Bear River", "Utah", dropall=False)
-    msg_to_usr("NYT-raw", "Creating the Utah HD: TriCounty")
-    nyt_c_df = create_composite_entry(nyt_c_df, [49009, 49013, 49047],
-                                      49905, "TriCounty", "Utah", dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [49009, 49013, 49047],
-                                      49905, "TriCounty", "Utah", dropall=False)
-    msg_to_usr("NYT-raw", "Creating the Utah HD: Weber-Morgan")
-    nyt_c_df = create_composite_entry(nyt_c_df, [49029, 49057],
-                                      49906, "Weber-Morgan", "Utah", dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [49029, 49057],
-                                      49906, "Weber-Morgan", "Utah", dropall=False)
-    #=== Dukes and Nantucket
-    msg_to_usr("NYT-raw", "Creating the composite Dukes + Nantucket (MA)")
-    nyt_c_df = create_composite_entry(nyt_c_df, [25007, 25019],
-                                      25901, "Dukes and Nantucket", "Massachusetts",
-                                      dropall=False)
-    nyt_d_df = create_composite_entry(nyt_d_df, [25007, 25019],
-                                      25901, "Dukes and Nantucket", "Massachusetts",
-                                      dropall=False)
-    #=================================================================
-    #=== Create composite DMA (metro area) entries for each state ====
-    #=================================================================
-    #
-    # get the list of dmas from the counties FIPS file
-    #    (as a global, will be used in below subroutine)
-    dmalist = np.unique(counties_df['dma'].to_list()).astype(int)
-    # remove the state entry (not a dma)
-    # and the blanks (gives some weird -9223372036854775808 value)
-    dmalist = np.delete(dmalist, np.where(dmalist < 0))
-    msg_to_usr("NYT-raw", "Creating composite DMA (Metro Area) entries")
-    nyt_c_df = nytjhu_create_composite_dmas(nyt_c_df, "cases", dmalist)
-    nyt_d_df = nytjhu_create_composite_dmas(nyt_d_df, "deaths", dmalist)
-    # NYTimes has no American Samoa
-    #    --> drop that DMA
-    drop_by_fips(nyt_c_df, [99500])
-    drop_by_fips(nyt_d_df, [99500])    
-    
-    #=================================
-    #==== Output NYT data to file ====
-    #=================================
-    nyt_c_df.to_csv(nyt_c_cleaned_output_file, index=False)
-    nyt_d_df.to_csv(nyt_d_cleaned_output_file, index=False)    
-    
-    #===================================
-    #==== Continue parsing JHU data ====
-    #===================================
-    # Give column names for main columns that match NYT
-    newcols = jhuraw_c_df.columns.values
-    newcols[4:7] = ['fips', 'county', 'state']
-    jhuraw_c_df.columns = newcols
-    newcols = jhuraw_d_df.columns.values
-    newcols[4:7] = ['fips', 'county', 'state']
-    jhuraw_d_df.columns = newcols
+    #    (applied to the wide NYT deaths, after the re-arrangement)
+    {'data': ["nyt_deaths"],
+     'match': {'county': "All", 'state': "Puerto Rico"},
+     'change': {},
+     'msg': "Keeping the PR \"All\" deaths"},
+    {'data': ["nyt_deaths"],
+     'match': {'state': "Puerto Rico"},
+     'drop': True,
+     'msg': "Dropping all other PR counties from deaths"},
+]
+
+jhu_correction_rules = [
     #=====================================================
     #==== Delete "Out of [state]" entries in JHU data ====
     #=====================================================
     #       JHU has "Out of [state]" entries for every state.  These don't seem
     #       to be reliably cumulative.  They have 80XXX FIPS codes
+    #       (The Puerto Rico entry has fips 72888)
     # ---> Just delete them all
-    msg_to_usr("JHU-raw", "Dropping \"Out of <state>\" entries" )
-    jhu_drop_out_of_state(jhuraw_c_df)
-    jhu_drop_out_of_state(jhuraw_d_df)
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips_state': 80},
+     'drop': True,
+     'msg': "Dropping \"Out of <state>\" entries"},
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips': 72888},
+     'drop': True,
+     'msg': "Dropping \"Out of PR\" entry"},
     #============================================================
     #==== Deal with "Unassigned [state]" entries in JHU data ====
     #============================================================
-    #       JHU has "Unassigned" county entries for every state. 
+    #       JHU has "Unassigned" county entries for every state.
     #       These don't seem to be reliably cumulative.
-    #       They have 90XXX FIPS codes
+    #       They have 90XXX FIPS codes (Puerto Rico has 72999)
     #
     #    Exceptions:
     #       - all of PR deaths are in Unassigned
@@ -1058,68 +1297,72 @@ def load_nyt_jhu_covid():
     #
     # ---> Change Puerto Rico "Unassigned" deaths to "All" (72000)
     # ---> Delete Puerto Rico counties for deaths
-    msg_to_usr("JHU-raw", "Saving PR \"Unassigned\" deaths to \"All\"" )
-    nytjhu_change_data(jhuraw_d_df, state="Puerto Rico",
-                       county="Unassigned", newfips=72000, newcounty="All")
-    msg_to_usr("JHU-raw", "Dropping all other PR counties from deaths" )            
-    ind_to_drop = []
-    for index, row in \
-        jhuraw_d_df[jhuraw_d_df['state'] == "Puerto Rico"].iterrows():
-        if (row['county'] != "All"):
-            ind_to_drop.append(index)
-    jhuraw_d_df.drop(ind_to_drop, inplace=True)
+    {'data': ["jhu_deaths"],
+     'match': {'county': "Unassigned", 'state': "Puerto Rico"},
+     'change': {'county': "All", 'fips': 72000},
+     'msg': "Saving PR \"Unassigned\" deaths to \"All\""},
+    {'data': ["jhu_deaths"],
+     'match': {'state': "Puerto Rico"},
+     'drop': True,
+     'msg': "Dropping all other PR counties from deaths"},
     # ---> Save IL, IN, TN Unassigned deaths as an "All" county
-    msg_to_usr("JHU-raw", "Moving IL, IN, and TN \"Unassigned\" deaths to \"All\"" )
-    nytjhu_change_data(jhuraw_d_df, state="Illinois",
-                       county="Unassigned", newfips=17000, newcounty="All")
-    nytjhu_change_data(jhuraw_d_df, state="Indiana",
-                       county="Unassigned", newfips=18000, newcounty="All")
-    nytjhu_change_data(jhuraw_d_df, state="Tennessee",
-                       county="Unassigned", newfips=47000, newcounty="All")
-    # ---> Save MA Unassigned cases as an "All" county    
-    msg_to_usr("JHU-raw", "Moving MA \"Unassigned\" cases to \"All\"" )
-    nytjhu_change_data(jhuraw_c_df, state="Massachusetts",
-                       county="Unassigned", newfips=25000, newcounty="All")
+    {'data': ["jhu_deaths"],
+     'match': {'county': "Unassigned", 'state': "Illinois"},
+     'change': {'county': "All", 'fips': 17000},
+     'msg': "Moving IL \"Unassigned\" deaths to \"All\""},
+    {'data': ["jhu_deaths"],
+     'match': {'county': "Unassigned", 'state': "Indiana"},
+     'change': {'county': "All", 'fips': 18000},
+     'msg': "Moving IN \"Unassigned\" deaths to \"All\""},
+    {'data': ["jhu_deaths"],
+     'match': {'county': "Unassigned", 'state': "Tennessee"},
+     'change': {'county': "All", 'fips': 47000},
+     'msg': "Moving TN \"Unassigned\" deaths to \"All\""},
+    # ---> Save MA Unassigned cases as an "All" county
+    {'data': ["jhu_cases"],
+     'match': {'county': "Unassigned", 'state': "Massachusetts"},
+     'change': {'county': "All", 'fips': 25000},
+     'msg': "Moving MA \"Unassigned\" cases to \"All\""},
     # ---> Delete all other "Unassigned" entries
-    msg_to_usr("JHU-raw", "Dropping all other \"Unassigned\" cases and deaths" )
-    jhu_drop_unassigned(jhuraw_c_df)
-    jhu_drop_unassigned(jhuraw_d_df)    
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips_state': 90},
+     'drop': True,
+     'msg': "Dropping all other \"Unassigned\" cases and deaths"},
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips': 72999},
+     'drop': True,
+     'msg': "Dropping \"Unassigned\" PR cases"},
     #========================================================
     #==== Deal with some mis-labeled entries in JHU data ====
     #========================================================
     #=== Deal with American Samoa entry
     #      JHU lists AS as single entry with a "60" fips
-    #
     # ---> Changing to fake-FIPS: 60000 (American Samoa -- All)
-    msg_to_usr("JHU-raw", "Moving American Samoa data into \"All\"")
-    nytjhu_change_data(jhuraw_c_df, state="American Samoa", newcounty="All",
-                       newfips=60000)
-    nytjhu_change_data(jhuraw_d_df, state="American Samoa", newcounty="All",
-                       newfips=60000)
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'state': "American Samoa"},
+     'change': {'county': "All", 'fips': 60000},
+     'msg': "Moving American Samoa data into \"All\""},
     #=== Deal with Guam entry
     #      JHU lists Guam as single entry but with fips="66"
     # Give it the Guam FIPS: 66010
-    msg_to_usr("JHU-raw", "Giving Guam its proper FIPS number")
-    nytjhu_change_data(jhuraw_c_df, state="Guam", newcounty="Guam",
-                       newfips=66010)
-    nytjhu_change_data(jhuraw_d_df, state="Guam", newcounty="Guam",
-                       newfips=66010)
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'state': "Guam"},
+     'change': {'county': "Guam", 'fips': 66010},
+     'msg': "Giving Guam its proper FIPS number"},
     #=== Deal with Northern Mariana Islands entry
     #      JHU lists NMI as single entry but without a fips
     # ---> Create new FIPS: 69000 (NMI -- All)
-    msg_to_usr("JHU-raw", "Putting Northern Mariana Islands data in \"All\"")
-    nytjhu_change_data(jhuraw_c_df, state="Northern Mariana Islands",
-                       newfips=69000, newcounty="All")
-    nytjhu_change_data(jhuraw_d_df, state="Northern Mariana Islands",
-                       newfips=69000, newcounty="All")    
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'state': "Northern Mariana Islands"},
+     'change': {'county': "All", 'fips': 69000},
+     'msg': "Putting Northern Mariana Islands data in \"All\""},
     #=== Deal with Virgin Islands entry
     #      JHU lists VI as single entry but without a fips
-    # ---> Create new FIPS: 78000 (VI -- All)    
-    msg_to_usr("JHU-raw", "Moving Virgin Islands cases and deaths to \"All\"")
-    nytjhu_change_data(jhuraw_c_df, state="Virgin Islands",
-                       newcounty="All", newfips=78000)
-    nytjhu_change_data(jhuraw_d_df, state="Virgin Islands",
-                       newcounty="All", newfips=78000)
+    # ---> Create new FIPS: 78000 (VI -- All)
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'state': "Virgin Islands"},
+     'change': {'county': "All", 'fips': 78000},
+     'msg': "Moving Virgin Islands cases and deaths to \"All\""},
     #==============================================
     #==== Deal with cruise-ship/prison entries ====
     #==============================================
@@ -1127,32 +1370,42 @@ def load_nyt_jhu_covid():
     #      JHU lists "Diamond Princess" and "Grand Princess"
     #      as individual (no FIPS) entries.
     # ---> delete these rows
-    if delete_jhu_cruise_entries:
-        msg_to_usr("JHU-raw", "Deleting cruise ship entries")
-        jhuraw_c_df = jhuraw_c_df[jhuraw_c_df['state'] != "Grand Princess"]
-        jhuraw_c_df = jhuraw_c_df[jhuraw_c_df['state'] != "Diamond Princess"]    
-        jhuraw_d_df = jhuraw_d_df[jhuraw_d_df['state'] != "Grand Princess"]
-        jhuraw_d_df = jhuraw_d_df[jhuraw_d_df['state'] != "Diamond Princess"]    
-    #=== Deal with Michigan prisons 
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'state': "Grand Princess"},
+     'drop': True,
+     'option': "delete_jhu_cruise_entries",
+     'msg': "Deleting Grand Princess cruise ship entries"},
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'state': "Diamond Princess"},
+     'drop': True,
+     'option': "delete_jhu_cruise_entries",
+     'msg': "Deleting Diamond Princess cruise ship entries"},
+    #=== Deal with Michigan prisons
     #      JHU has (no fips) entries for:
     #          "Federal Correctional Institution (FCI)" (michigan)
     #          "Michigan Department of Corrections (MDOC)"
-    # ---> Create new FIPS for MDOC: 26901   (there are 31 prisons all over the state)
-    # ---> Create new FIPS for FCI (in Washtenaw): 26902 
-    msg_to_usr("JHU-raw", "Moving Michigan Prisons into fake FIPS entries")
-    nytjhu_change_data(jhuraw_c_df, county="Michigan Department of Corrections (MDOC)",
-                       newfips=26901)
-    nytjhu_change_data(jhuraw_d_df, county="Michigan Department of Corrections (MDOC)",
-                       newfips=26901)
-    nytjhu_change_data(jhuraw_c_df, county="Federal Correctional Institution (FCI)",
-                       newfips=26902)
-    nytjhu_change_data(jhuraw_d_df, county="Federal Correctional Institution (FCI)",
-                       newfips=26902)
-    if delete_jhu_prison_entries:
-        # But probably just drop them
-        msg_to_usr("JHU-raw", "Deleting Michigan prison entries")
-        drop_by_fips(jhuraw_c_df, [26901,26902])
-        drop_by_fips(jhuraw_d_df, [26901,26902])        
+    # ---> But probably just drop them
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Michigan Department of Corrections (MDOC)"},
+     'drop': True,
+     'option': "delete_jhu_prison_entries",
+     'msg': "Deleting Michigan prison entry (MDOC)"},
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Federal Correctional Institution (FCI)"},
+     'drop': True,
+     'option': "delete_jhu_prison_entries",
+     'msg': "Deleting Michigan prison entry (FCI)"},
+    # ---> Otherwise, create new FIPS for MDOC: 26901
+    #      (there are 31 prisons all over the state)
+    # ---> Create new FIPS for FCI (in Washtenaw): 26902
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Michigan Department of Corrections (MDOC)"},
+     'change': {'fips': 26901},
+     'msg': "Moving Michigan prison (MDOC) into fake FIPS entry"},
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Federal Correctional Institution (FCI)"},
+     'change': {'fips': 26902},
+     'msg': "Moving Michigan prison (FCI) into fake FIPS entry"},
     #=============================================================
     #==== Deal with some composite-county entries in JHU data ====
     #=============================================================
@@ -1169,378 +1422,1576 @@ def load_nyt_jhu_covid():
     #      + Hoonah-Angoon (2105) == 2902
     # ---> Create a combined entry for Chugach (2063)
     #      + Hoonah-Angoon (2066) == 2903
-    msg_to_usr("JHU-raw", "Adjusting Bristol Bay Alaska")
-    nytjhu_change_data(jhuraw_c_df, county="Bristol Bay plus Lake and Peninsula",
-                       newfips=2901)
-    nytjhu_change_data(jhuraw_d_df, county="Bristol Bay plus Lake and Peninsula",
-                       newfips=2901)
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Bristol Bay plus Lake and Peninsula"},
+     'change': {'fips': 2901},
+     'msg': "Adjusting Bristol Bay Alaska"},
     # delete the bristol bay entries (lake and peninsula don't have entries)
-    jhuraw_c_df = jhuraw_c_df[jhuraw_c_df['county'] != "Bristol Bay"]
-    jhuraw_d_df = jhuraw_d_df[jhuraw_d_df['county'] != "Bristol Bay"]        
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Bristol Bay"},
+     'drop': True,
+     'msg': "Deleting the (empty) Bristol Bay entry"},
     #=== Deal with Dukes and Nantucket entry
     #      JHU combines these two MA counties (entry w/o fips)
     #      and then has blank entries for them individually (w/ fips)
     #
     # ---> Create new FIPS 25901
-    msg_to_usr("JHU-raw", "Giving \"Dukes and Nantucket\" a fake-FIPS")
-    nytjhu_change_data(jhuraw_c_df, county="Dukes and Nantucket", newfips=25901)
-    nytjhu_change_data(jhuraw_d_df, county="Dukes and Nantucket", newfips=25901)
-    # ---> Delete individual counties of Dukes and Nantucket 
-    msg_to_usr("JHU-raw", "Deleting the individual counties of Dukes and Nantucket")
-    jhuraw_c_df = jhuraw_c_df[jhuraw_c_df['fips'] != 25007]
-    jhuraw_c_df = jhuraw_c_df[jhuraw_c_df['fips'] != 25019]    
-    jhuraw_d_df = jhuraw_d_df[jhuraw_d_df['fips'] != 25007]
-    jhuraw_d_df = jhuraw_d_df[jhuraw_d_df['fips'] != 25019]    
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Dukes and Nantucket"},
+     'change': {'fips': 25901},
+     'msg': "Giving \"Dukes and Nantucket\" a fake-FIPS"},
+    # ---> Delete individual counties of Dukes and Nantucket
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips': 25007},
+     'drop': True,
+     'msg': "Deleting the individual county of Dukes"},
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips': 25019},
+     'drop': True,
+     'msg': "Deleting the individual county of Nantucket"},
+] + [
     # *** For all Utah Health Departments ***
     #    - JHU gives health department entries (see below), and has
     #      blank entries for each county contained in those
     #    - all of Utah is in same DMA: metro area SLC
     #
     #    ---> delete entries for counties contained in health departments
-    counties_to_delete = [49001, 49003, 49005, 49007, 49009, 49013,
-                          49015, 49017, 49019, 49021, 49023, 49025,
-                          49027, 49029, 49031, 49033, 49039, 49041,
-                          49047, 49053, 49055, 49057]
-    drop_by_fips(jhuraw_c_df, counties_to_delete)
-    drop_by_fips(jhuraw_d_df, counties_to_delete)
-    #=== Deal with Bear River Utah entry 
-    #      JHU has a single entry for this health region (w/o fips),
-    #      which incorporates the counties:
-    #        Box Elder, Cache, Rich
-    #      all of which have their own entries (w/ fips) which are zeros
-    #          (actually Cache has some data in the first couple months...
-    #           then all zeros???!)
-    # *** For all Utah Health Departments ***
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'fips': f},
+     'drop': True,
+     'msg': f"Deleting Utah county {f} (part of a health district)"}
+    for f in [49001, 49003, 49005, 49007, 49009, 49013,
+              49015, 49017, 49019, 49021, 49023, 49025,
+              49027, 49029, 49031, 49033, 49039, 49041,
+              49047, 49053, 49055, 49057]
+] + [
+    #=== Deal with the Utah health districts
+    #      JHU has a single entry for each health region (w/o fips),
+    #      all of whose counties have their own entries (w/ fips) which
+    #      are zeros (actually Cache, Washington, and Duchesne have
+    #      some data in the first couple months... then all zeros???!)
+    #
+    #         Bear River:   Box Elder, Cache, Rich
+    #         Central Utah: Juab, Millard, Piute, Sanpete, Sevier, Wayne
+    #         Southeast:    Grand, Emery, Carbon
+    #         Southwest:    Beaver, Garfield, Iron, Kane, Washington
+    #         TriCounty:    Uintah, Duchesne, Daggett
+    #         Weber-Morgan: Weber, Morgan
+    #
     #    - leave them as separate entries (JHU will give health dept, NYT county)
     #    - all of Utah is in same DMA: metro area SLC
-    # ---> Create new FIPS: 49901 
-    msg_to_usr("JHU-raw", "Giving fake-FIPS to Bear River Utah HD")
-    nytjhu_change_data(jhuraw_c_df, county="Bear River", newfips=49901)
-    nytjhu_change_data(jhuraw_d_df, county="Bear River", newfips=49901)    
-    #=== Deal with Central Utah entry
-    #      JHU has a single entry for this health region (w/o fips),
-    #      which incorporates the counties:
-    #        Juab, Millard, Piute, Sanpete, Sevier, Wayne
-    #      all of which have their own entries (w/ fips) which are zeros
-    # ---> Create new FIPS: 49902    
-    msg_to_usr("JHU-raw", "Giving fake-FIPS to Central Utah HD")
-    nytjhu_change_data(jhuraw_c_df, county="Central Utah", newfips=49902)
-    nytjhu_change_data(jhuraw_d_df, county="Central Utah", newfips=49902)    
-    #=== Deal with Southeast Utah entry
-    #      JHU has a single entry for this health region (w/o fips),
-    #      which incorporates the counties:
-    #        Grand, Emery, Carbon
-    #      all of which have their own entries (w/ fips) which are zeros
-    # ---> Create new FIPS: 49903
-    msg_to_usr("JHU-raw", "Giving fake-FIPS to Southeast Utah HD")
-    nytjhu_change_data(jhuraw_c_df, county="Southeast Utah", newfips=49903)
-    nytjhu_change_data(jhuraw_d_df, county="Southeast Utah", newfips=49903)
-    #=== Deal with Southwest Utah entry
-    #      JHU has a single entry for this health region (w/o fips),
-    #      which incorporates the counties:
-    #        Beaver, Garfield, Iron, Kane, Washington
-    #      all of which have their own entries (w/ fips) which are zeros
-    #          (actually Washington has some data in the first couple months...
-    #           then all zeros???!)
-    # ---> Create new FIPS: 49904    
-    msg_to_usr("JHU-raw", "Giving fake-FIPS to Southwest Utah HD")
-    nytjhu_change_data(jhuraw_c_df, county="Southwest Utah", newfips=49904)
-    nytjhu_change_data(jhuraw_d_df, county="Southwest Utah", newfips=49904)
-    #=== Deal with TriCounty Utah entry
-    #      JHU has a single entry for this health region (w/o fips),
-    #      which incorporates the counties:
-    #         Uintah, Duchesne, Daggett
-    #      all of which have their own entries (w/ fips) which are zeros
-    #          (actually Duchesne has some data in the first couple months...
-    #           then all zeros???!)
-    # ---> Create new FIPS: 49905
-    msg_to_usr("JHU-raw", "Giving fake-FIPS to TriCounty Utah HD")
-    nytjhu_change_data(jhuraw_c_df, county="TriCounty", newfips=49905)
-    nytjhu_change_data(jhuraw_d_df, county="TriCounty", newfips=49905)
-    #=== Deal with Weber-Morgan Utah entry
-    #      JHU has a single entry for this health region (w/o fips),
-    #      which incorporates the counties:
-    #          Weber, Morgan
-    #      both of which have their own entries (w/ fips) which are zeros
-    # ---> Create new FIPS: 49906    
-    msg_to_usr("JHU-raw", "Giving fake-FIPS to Weber-Morgan Utah HD")
-    nytjhu_change_data(jhuraw_c_df, county="Weber-Morgan", newfips=49906)
-    nytjhu_change_data(jhuraw_d_df, county="Weber-Morgan", newfips=49906)
-    #=================================================
-    #==== Keep only important columns in JHU data ====
-    #=================================================
-    #=== Delete unnecessary columns, keeping only:
-    #         [fips, county, state, <dates>]
-    jhuraw_c_df.drop(['UID', 'iso2', 'iso3', 'code3', 'Country_Region',
-                      'Lat', 'Long_', 'Combined_Key'], axis=1, inplace=True)
-    # (one extra column in the "deaths" file)
-    jhuraw_d_df.drop(['UID', 'iso2', 'iso3', 'code3', 'Country_Region', 'Population',
-                      'Lat', 'Long_', 'Combined_Key'], axis=1, inplace=True)
+    # ---> Create new FIPS: 49901 - 49906
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': hd},
+     'change': {'fips': newfips},
+     'msg': f"Giving fake-FIPS to {hd} Utah HD"}
+    for hd, newfips in [["Bear River", 49901], ["Central Utah", 49902],
+                        ["Southeast Utah", 49903], ["Southwest Utah", 49904],
+                        ["TriCounty", 49905], ["Weber-Morgan", 49906]]
+] + [
     #======================================================
     #==== Move Kansas City into Jackson County for JHU ====
     #======================================================
     #=== Deal with the Kansas City entry
     #      JHU lists Kansas City, MO separately with no FIPS
+    #    ---> Give KC a (temporary) fake-FIPS, as with NYT, and
+    #         move into Jackson County below
+    {'data': ["jhu_cases", "jhu_deaths"],
+     'match': {'county': "Kansas City", 'state': "Missouri"},
+     'change': {'fips': 29998},
+     'msg': "Assigning temporary fake-FIPS to Kansas City"},
+]
+
+##################################################################
+#  Load and arrange NYT and JHU Covid19 Cases and Deaths         #
+#                                                                #
+#     Basic principles:                                          #
+#                                                                #
+#       * For counties that are combined in JHU/NYTimes, e.g.,   #
+#             - New York City (NYT)                              #
+#             - two pairs of counties in Alaska (one pair JHU)   #
+#             - Utah Health Districts (JHU)                      #
+#         create multi-county entries for both, but retain       #
+#         county data if it exists in one source, and delete     #
+#         county data if it is zero in one source.               #
+#                                                                #
+#       * When making new fake FIPS codes, start at county fips  #
+#         901.  And delete fake fips codes from NYT/JHU          #
+#                                                                #
+#       * Move multi-county cities to single county (i.e., in    #
+#         NYT, move Joplin, MO to Jasper County and KC, MO to    #
+#         Jackson County; and delete the city                    #
+#                                                                #
+#       * Generally delete "unknown" (NYT) or "out of <state>"   #
+#         and "unassigned" data (JHU) entries, unless they are   #
+#         both a large number/fraction of cases/deaths AND       #
+#         they represent a true cumulative count.  In that case  #
+#         move them to an "all" county with 000 county fips.     #
+#                                                                #
+#       * Create all multi-county DMAs in each data set          #
+#                                                                #
+#       * Give FIPS to those that are missing (e.g., Guam in     #
+#         NYT)                                                   #              
+#                                                                #
+##################################################################
+def get_date_range():
+    # Use the JHU cases file (just its header) to determine the range
+    # of dates for both it and NYT
+    #
+    # JHU columns:
+    #    [UID, iso2, iso3, code3, FIPS <5-digit>,
+    #     Admin2 <county name>, Province_State <state name>,
+    #     Country_Region, Lat, Long_, Combined_Key <full name>,
+    #     1/22/20, ... <all dates> ..., <download date>]
+    #
+    cols = pd.read_csv(filename_jhu_cases_raw, nrows=0).columns.to_list()
+    first_date = dt.datetime.strptime(cols[11], "%m/%d/%y")
+    last_date = dt.datetime.strptime(cols[-1], "%m/%d/%y")
+    return [first_date, last_date]
+
+def load_nyt_covid(registry):
+    # Load and clean the NYT data (see below), and output the
+    # cleaned cases and deaths dataframes
+    #
+    #   returns [nyt_c_df, nyt_d_df]
+    #
+    # Filenames of raw data
+    #
+    #     * NYTimes is cumulative [cases,deaths] with the form:
+    #           [date, county <name>, state <name>,
+    #            fips <5-digit>, cases <cum>, deaths <cum>]
+    #
+    #          https://github.com/nytimes/covid-19-data
+    #
+    #     * JHU is cumulative cases and deaths in separate files,
+    #       each with form:
+    #
+    #           [UID, iso2, iso3, code3, FIPS <5-digit>,
+    #            Admin2 <county name>, Province_State <state name>,
+    #            Country_Region, Lat, Long_, Combined_Key <full name>,
+    #            1/22/20, ... <all dates> ..., today]
+    #
+    #          https://github.com/CSSEGISandData/COVID-19
+    #          https://doi.org/10.1016/S1473-3099(20)30120-1
+    #
+    # - Need to deal with the oddball entries of each.
+    #   See "Geographic Exceptions" on their github page
+    #
+    #
+    # Output form:
+    #
+    #   [fips, county, state, <cases/deaths on date1>, <... date2>, ...]
+    #
+    
+    #===============================
+    #==== Read in NYTimes data =====
+    #===============================
+    #   (in chunks, applying the geographic corrections to each,
+    #    see the rules above, and keeping only the JHU date range)
+    first_date, last_date = get_date_range()
+    with profile_step("nyt_read") as prof:
+        nytraw_df, nyt_allfips = read_nyt_raw(filename_nyt_raw,
+                                              first_date, last_date)
+        prof['rows_out'] = len(nytraw_df)
+
+    #===========================================
+    #==== Rearrange NYT data to be like JHU ====
+    #===========================================    
+    msg_to_usr("NYT-raw", "Re-arranging NYTimes data to look like JHU")
+    # one row per fips (cases and deaths in separate dataframes)
+    #   [fips, county, state, 1/22/2020: X, 1/23/2020: X, ..., <last_date>: X]
+    with profile_step("nyt_reshape", rows_in=len(nytraw_df)) as prof:
+        nyt_c_df, nyt_d_df = nyt_reshape_to_wide(nytraw_df, nyt_allfips,
+                                                 first_date, last_date)
+        prof['rows_out'] = len(nyt_c_df) + len(nyt_d_df)
+        
+    #===============================================================
+    #==== Delete the Puerto Rico Counties from deaths dataframe ====
+    #===============================================================
+    with profile_step("nyt_deaths_rules", rows_in=len(nyt_d_df)) as prof:
+        nyt_d_df = apply_correction_rules(
+            nyt_d_df, compile_correction_rules(nyt_correction_rules, "nyt_deaths"),
+            "NYT-raw")
+        prof['rows_out'] = len(nyt_d_df)
+    #=======================================================
+    #==== Create all composite entries for NYT at once =====
+    #=======================================================
+    #
+    #   (see build_composites; taken in the order below)
+    #
+    #================================================================
+    #==== Moving the Kansas City and Joplin values into counties ====
+    #================================================================
+    #=== Deal with the Kansas City entries
+    #      NYTimes lists Kansas City, MO separately with no FIPS
+    #
+    # --> Move to Jackson County (29095)
+    #      (Northern parts in Platte and Clay, but oh well) 
+    #=== Deal with the Joplin entries
+    #      NYTimes lists Joplin, MO separately with no FIPS (starting 2020-06-25)
+    # Move to Jasper County (29097) (southern part of Joplin in Newton, but oh well)
+    nyt_kc_joplin = [
+        {'fips': 29095, 'county': "Jackson", 'state': "Missori",
+         'members': [29998, 29095], 'replace': True},
+        {'fips': 29097, 'county': "Jasper", 'state': "Missori",
+         'members': [29999, 29097], 'replace': True}
+    ]
+    #====================================================================
+    #==== Create "All" composite-county entries for each state (NYT) ====
+    #====================================================================
+    #      (see state_all_composites)
+    #
+    #=======================================================
+    #==== Create a few composite-county entries for NYT ====
+    #=======================================================
+    #=== Utah Health Districts and Dukes + Nantucket (MA)
+    nyt_county_composites = [
+        {'fips': 49901, 'county': "Bear River", 'state': "Utah",
+         'members': [49003, 49005, 49033]},
+        {'fips': 49902, 'county': "Central Utah", 'state': "Utah",
+         'members': [49023, 49027, 49031, 49039, 49041, 49055]},
+        {'fips': 49903, 'county': "Southeast Utah", 'state': "Utah",
+         'members': [49007, 49015, 49019]},
+        {'fips': 49904, 'county': "Southwest", 'state': "Utah",
+         'members': [49001, 49017, 49021, 49025, 49053]},
+        {'fips': 49905, 'county': "TriCounty", 'state': "Utah",
+         'members': [49009, 49013, 49047]},
+        {'fips': 49906, 'county': "Weber-Morgan", 'state': "Utah",
+         'members': [49029, 49057]},
+        {'fips': 25901, 'county': "Dukes and Nantucket", 'state': "Massachusetts",
+         'members': [25007, 25019]}
+    ]
+    #=================================================================
+    #=== Create composite DMA (metro area) entries for each state ====
+    #=================================================================
+    #      (see dma_composites)
+    #
+    # NYTimes has no American Samoa
+    #    --> skip that DMA
+    nyt_dmalist = [d for d in registry['dmas'] if (d != 500)]
+    msg_to_usr("NYT-raw", "Creating composite county, \"All\", and DMA entries")
+    with profile_step("nyt_composites",
+                      rows_in=len(nyt_c_df) + len(nyt_d_df)) as prof:
+        nyt_c_df = build_composites(nyt_c_df,
+                                    nyt_kc_joplin
+                                    + state_all_composites(nyt_c_df)
+                                    + nyt_county_composites
+                                    + dma_composites("cases", nyt_dmalist, registry))
+        nyt_d_df = build_composites(nyt_d_df,
+                                    nyt_kc_joplin
+                                    + state_all_composites(nyt_d_df)
+                                    + nyt_county_composites
+                                    + dma_composites("deaths", nyt_dmalist, registry))
+        prof['rows_out'] = len(nyt_c_df) + len(nyt_d_df)
+    
+    #=================================
+    #==== Output NYT data to file ====
+    #=================================
+    with profile_step("nyt_write", rows_in=len(nyt_c_df) + len(nyt_d_df)):
+        write_dataset(nyt_c_df, nyt_c_cleaned_output_file, "cleaned")
+        write_dataset(nyt_d_df, nyt_d_cleaned_output_file, "cleaned")
+    return [nyt_c_df, nyt_d_df]
+
+def load_jhu_covid(registry):
+    # Load and clean the JHU data (see load_nyt_covid), and output the
+    # cleaned cases and deaths dataframes
+    #
+    #   returns [jhu_c_df, jhu_d_df]
+    #
+    #================================
+    #==== Read in the JHU data ======
+    #================================
+    #   (the metadata, with column names for main columns that match NYT,
+    #    and the matrix of values for all dates; see read_jhu_raw)
+    with profile_step("jhu_read") as prof:
+        jhuraw_c_df, jhu_c_values, jhu_c_datecols, _ = \
+            read_jhu_raw(filename_jhu_cases_raw)
+        jhuraw_d_df, jhu_d_values, jhu_d_datecols, _ = \
+            read_jhu_raw(filename_jhu_deaths_raw)
+        prof['rows_out'] = len(jhuraw_c_df) + len(jhuraw_d_df)
+    #==========================================================
+    #==== Apply the geographic corrections (see rules above) ===
+    #==========================================================
+    with profile_step("jhu_rules",
+                      rows_in=len(jhuraw_c_df) + len(jhuraw_d_df)) as prof:
+        jhuraw_c_df = apply_correction_rules(
+            jhuraw_c_df, compile_correction_rules(jhu_correction_rules, "jhu_cases"),
+            "JHU-raw")
+        jhuraw_d_df = apply_correction_rules(
+            jhuraw_d_df, compile_correction_rules(jhu_correction_rules, "jhu_deaths"),
+            "JHU-raw")
+        #=================================================
+        #==== Keep only important columns in JHU data ====
+        #=================================================
+        #=== Keep only the values of the remaining rows, and the
+        #    metadata columns [fips, county, state]
+        #         (the row index is still the row in the file)
+        jhu_c_values = jhu_c_values[jhuraw_c_df.index.to_numpy()]
+        jhu_d_values = jhu_d_values[jhuraw_d_df.index.to_numpy()]
+        jhuraw_c_df = jhuraw_c_df[['fips', 'county', 'state']].reset_index(drop=True)
+        jhuraw_d_df = jhuraw_d_df[['fips', 'county', 'state']].reset_index(drop=True)
+        prof['rows_out'] = len(jhuraw_c_df) + len(jhuraw_d_df)
+    #=======================================================
+    #==== Create all composite entries for JHU at once =====
+    #=======================================================
+    #
+    #   (see build_composites; taken in the order below)
+    #
+    #======================================================
+    #==== Move Kansas City into Jackson County for JHU ====
+    #======================================================
+    #=== Deal with the Kansas City entry
+    #      JHU lists Kansas City, MO separately with no FIPS
+    #      (given a temporary fake-FIPS in the correction rules)
     #    ---> Move into Jackson County
-    msg_to_usr("JHU-raw", "Moving Kansas City into Jackson County")
-    # give KC a fake fips
-    kc_ind = jhuraw_c_df.index[jhuraw_c_df['county'] == "Kansas City"].to_list()[0]
-    jhuraw_c_df.at[kc_ind, 'fips'] = 99999
-    # merge KC and Jackson County entries into new Jackson entry
-    jhuraw_c_df = create_composite_entry(jhuraw_c_df, [99999, 29095],
-                                         29095, "Jackson", "Missouri", dropall=True)
-    # give KC a fake fips
-    kc_ind = jhuraw_d_df.index[jhuraw_d_df['county'] == "Kansas City"].to_list()[0]
-    jhuraw_d_df.at[kc_ind, 'fips'] = 99999
-    # merge KC and Jackson County entries into new Jackson entry
-    jhuraw_d_df = create_composite_entry(jhuraw_d_df, [99999, 29095],
-                                         29095, "Jackson", "Missouri", dropall=True)
+    jhu_kc = [
+        {'fips': 29095, 'county': "Jackson", 'state': "Missouri",
+         'members': [29998, 29095], 'replace': True}
+    ]
     #======================================================
     #=== Create composite "All" entries for each state ====
     #======================================================
+    #      (see state_all_composites)
     #
-    #      * thus far, no redundant data (we'll make some below with
-    #        composite counties), so we can just sum over state fips
-    #
-    #      * I have some "All" entries already with unknown data and
-    #        these will just be added to the sum of all counties
-    #
-    #      * Must delete the previous "All" entries (i.e., PR-deaths,
-    #        VI, AS, NMI, and  IL, IN, TN, MA) so give them a fake fips
-    #        ahead of time, and then delete that afterwards
-    #
-    msg_to_usr("JHU-raw", "Creating composite \"All\" entries for each state")
-    jhuraw_c_df = nytjhu_create_composite_alls(jhuraw_c_df)
-    jhuraw_d_df = nytjhu_create_composite_alls(jhuraw_d_df)
     #===============================================================================
     #=== Create two composite counties to match NYTimes: 2 Alaska pairs and NYC ====
     #===============================================================================
     #=== Create composite Yakutat (2282) + Hoonah-Angoon (2105) (AK) entry    
     #      JHU lists these counties separately, but NYT has them joined
     #    ---> create the fake-fips 2902 for their combination
-    msg_to_usr("JHU-raw", "Creating composite Yakutat + Hoonah (AK) entry")
-    jhuraw_c_df = create_composite_entry(jhuraw_c_df, [2282, 2105],
-                                         2902, "Yakutat plus Hoonah-Angoon",
-                                         "Alaska", dropall=False)    
-    jhuraw_d_df = create_composite_entry(jhuraw_d_df, [2282, 2105],
-                                         2902, "Yakutat plus Hoonah-Angoon",
-                                         "Alaska", dropall=False)
     #=== Create composite Chugach (2063) + Copper River (2066) (AK) entry    
     #      JHU lists these counties separately, but NYT has them joined
     #      as the former Valdez-Cordova (2261)
     #    ---> create the fake-fips 2903 for their combination
-    msg_to_usr("JHU-raw", "Creating composite Chugach + Copper River (AK) entry")
-    jhuraw_c_df = create_composite_entry(jhuraw_c_df, [2063, 2066],
-                                         2903, "Chugach plus Copper River",
-                                         "Alaska", dropall=False)    
-    jhuraw_d_df = create_composite_entry(jhuraw_d_df, [2063, 2066],
-                                         2903, "Chugach plus Copper River",
-                                         "Alaska", dropall=False)
     #=== Create composite NYC entry
     #      JHU lists the five borough counties separately with their FIPS
     # ---> Leave them (can display just JHU data),
     # ---> but also create a new 'New York City' entry (36901) of their sum
-    msg_to_usr("JHU-raw", "Creating composite \"New York City\" entry")
-    nyc_fips = [36047, 36081, 36005, 36085, 36061]
-    jhuraw_c_df = create_composite_entry(jhuraw_c_df, nyc_fips,
-                                         36901, "New York City",
-                                         "New York", dropall=False)    
-    jhuraw_d_df = create_composite_entry(jhuraw_d_df, nyc_fips,
-                                         36901, "New York City",
-                                         "New York", dropall=False)    
+    jhu_county_composites = [
+        {'fips': 2902, 'county': "Yakutat plus Hoonah-Angoon", 'state': "Alaska",
+         'members': [2282, 2105]},
+        {'fips': 2903, 'county': "Chugach plus Copper River", 'state': "Alaska",
+         'members': [2063, 2066]},
+        {'fips': 36901, 'county': "New York City", 'state': "New York",
+         'members': [36047, 36081, 36005, 36085, 36061]}
+    ]
     #=================================================================
     #=== Create composite DMA (metro area) entries for each state ====
     #=================================================================
-    # create composite entries for each dma
-    #
-    #   take into account special cases:
-    #       * states with composite counties (AK, MA, UT, NY)
-    #       * places in which cases/deaths are in "All" (PR, AS, NMI)
-    #
-    msg_to_usr("JHU-raw", "Creating composite DMA (Metro Area) entries")
-    jhuraw_c_df = nytjhu_create_composite_dmas(jhuraw_c_df, "cases", dmalist)
-    jhuraw_d_df = nytjhu_create_composite_dmas(jhuraw_d_df, "deaths", dmalist)    
+    #      (see dma_composites)
+    dmalist = registry['dmas']
+    msg_to_usr("JHU-raw", "Creating composite county, \"All\", and DMA entries")
+    with profile_step("jhu_composites",
+                      rows_in=len(jhuraw_c_df) + len(jhuraw_d_df)) as prof:
+        jhuraw_c_df = build_composites(jhuraw_c_df,
+                                       jhu_kc
+                                       + state_all_composites(jhuraw_c_df)
+                                       + jhu_county_composites
+                                       + dma_composites("cases", dmalist, registry),
+                                       jhu_c_values, jhu_c_datecols)
+        jhuraw_d_df = build_composites(jhuraw_d_df,
+                                       jhu_kc
+                                       + state_all_composites(jhuraw_d_df)
+                                       + jhu_county_composites
+                                       + dma_composites("deaths", dmalist, registry),
+                                       jhu_d_values, jhu_d_datecols)
+        prof['rows_out'] = len(jhuraw_c_df) + len(jhuraw_d_df)
     #===============================
     #=== Output the JHU dataset ====
     #===============================
     # Create final dataframes
-    jhu_c_df = jhuraw_c_df.copy(deep=True)
-    jhu_d_df = jhuraw_d_df.copy(deep=True)
+    jhu_c_df = jhuraw_c_df
+    jhu_d_df = jhuraw_d_df
     # output to csv
-    jhu_c_df.to_csv(jhu_c_cleaned_output_file, index=False)
-    jhu_d_df.to_csv(jhu_d_cleaned_output_file, index=False)
-    # return all cleaned dataframes
-    return [nyt_c_df, nyt_d_df, jhu_c_df, jhu_d_df]
+    with profile_step("jhu_write", rows_in=len(jhu_c_df) + len(jhu_d_df)):
+        write_dataset(jhu_c_df, jhu_c_cleaned_output_file, "cleaned")
+        write_dataset(jhu_d_df, jhu_d_cleaned_output_file, "cleaned")
+    return [jhu_c_df, jhu_d_df]
 
-def get_daily_data(dfin, datatype):
+def get_daily_data(dfin, datatype, prev_df=None):
     # Input dataframe is
     # 
     #   [fips, county, state, <day1 data>, <day2 data>, ...]
     #
-    # get rid of [county, state]
-    df = dfin.drop(['county', 'state'], axis=1).copy()
-    # Transpose dataframes into:
-    #
-    #        [date, fips, <data>]
-    #
-    # set fips as index
-    df.set_index('fips', inplace=True)
-    # transpose date into row label, and then "stack"
-    # to get fips as additional column
-    df = pd.DataFrame(df.transpose().stack())
-    # reset index to usual
-    df = df.reset_index()
-    # rename columns
-    df.columns = ['date', 'fips', 'cum']
-    # set date as a date
-    df['date'] = pd.to_datetime(df['date'], format="%m/%d/%y")
-    # ensure fips is an integer
-    df['fips'] = df['fips'].astype(int)
-    # sort by fips, date
-    df = df.sort_values(['fips','date'])
-    #=== Check if data is cumulative
-    # create a new daily cases/deaths column
-    df['daily'] = 0
-    allfips = np.unique(df['fips'].to_list()).astype(int)
-    msg_to_usr(datatype + "_daily-counts", "Checking for negative daily counts and data dumps")
+    # Output dataframe is (sorted by fips, then date)
+    #
+    #   [date, fips, cum, daily, 14davg]
+    #
+    # All FIPS are handled together as a single (fips x date) matrix, so
+    # each step (diff, cleaning, interpolation, rolling average) is one
+    # vectorized operation over every series rather than a loop over FIPS.
+    #
+    # If the previous output (prev_df) is given, then only the new dates
+    # and the revised ones are computed for the FIPS that are already in
+    # it:  each series is re-computed from the first date on which its
+    # cumulative values differ from the stored ones (see
+    # first_revised_dates), or else from the first new date, seeded with
+    # the stored series before that, and the stored rows before it are
+    # kept.  The composite entries (state "All", DMAs, Utah HDs, NYC,
+    # ...) are rows of dfin (sums of their members, see
+    # build_composites), so a revised county also marks each of them
+    # whose sum it changed, from the same date.  If nothing has changed,
+    # prev_df itself is returned.
+    fips, dates, cum = get_cum_matrix(dfin)
     if (negative_daily_counts_option == "delete_and_interpolate"):
         msg_to_usr(datatype + "_daily-counts", "Interpolating across negative daily counts")
+    elif (negative_daily_counts_option == "delete_and_ffill"):
+        msg_to_usr(datatype + "_daily-counts", "Forward-filling across negative daily counts")
+    elif (negative_daily_counts_option == "redistribute"):
+        msg_to_usr(datatype + "_daily-counts", "Redistributing negative daily counts to earlier days")
     elif (negative_daily_counts_option == "delete"):
         msg_to_usr(datatype  + "_daily-counts", "Setting negative daily counts to nan")      
-    df['14davg'] = 0.0
-    for f in allfips:
-        #print(f)
-        # print the location
-        thecounty = (counties_df['fips'] == f)
-        sabb = counties_df[thecounty]['stateabb'].to_list()[0]
-        county = counties_df[thecounty]['countylong'].to_list()[0]
-        #print("\t", county, sabb)
-        # get restriction to one fips
-        onefips = (df['fips'] == f)
-        df.loc[onefips, 'daily'] = df[onefips]['cum'].diff()
+    if ( (prev_df is not None) and (negative_daily_counts_option == "redistribute") ):
+        msg_to_usr(datatype + "_daily-counts",
+                   "Redistributing can change earlier dates, re-computing all")
+        prev_df = None
+    #=== Without previous output, compute everything
+    if prev_df is None:
+        daily, avg14 = get_daily_matrices(cum)
+        return daily_matrices_to_df(fips, dates, cum, daily, avg14)
+    #=== Otherwise, put the previous output back into (fips x date) matrices
+    prev_cum = prev_df.pivot(index='fips', columns='date', values='cum')
+    prev_daily = prev_df.pivot(index='fips', columns='date', values='daily')
+    prev_fips = prev_cum.index.to_numpy().astype(int)
+    prev_dates = prev_cum.columns.to_numpy()
+    nprev = len(prev_dates)
+    if ( (nprev > len(dates))
+         or (not np.array_equal(prev_dates, dates[:nprev])) ):
+        msg_to_usr(datatype + "_daily-counts",
+                   "Previous daily output has different dates, re-computing all")
+        return get_daily_data(dfin, datatype)
+    inprev = np.isin(fips, prev_fips)
+    old = np.nonzero(inprev)[0]
+    new = np.nonzero(~inprev)[0]
+    prevrow = np.searchsorted(prev_fips, fips[old])
+    prev_cum = prev_cum.to_numpy().astype(float)[prevrow]
+    prev_daily = prev_daily.to_numpy()[prevrow]
+    #=== Find the revised series (see first_revised_dates)
+    revised = first_revised_dates(cum[old, :nprev], prev_cum)
+    nrevised = int((revised < nprev).sum())
+    if ( (nprev == len(dates)) and (nrevised == 0) and (len(new) == 0)
+         and (len(old) == len(prev_fips)) ):
+        msg_to_usr(datatype + "_daily-counts", "No new dates or revisions,"
+                   + " keeping previous daily output")
+        return prev_df
+    if (nrevised > 0):
+        msg_to_usr(datatype + "_daily-counts",
+                   f"Re-computing {nrevised} FIPS with revised values (from "
+                   + pd.Timestamp(dates[revised.min()]).strftime("%Y-%m-%d") + " on)")
+    if (len(dates) > nprev):
+        msg_to_usr(datatype + "_daily-counts",
+                   f"Computing {len(dates) - nprev} new dates")
+    #=== Find the first day to (re)compute for each FIPS:  the first new
+    #    or revised date, or the start of a run of nans at the end of the
+    #    stored series (these can now be interpolated across)
+    restart = np.minimum(revised, nprev)
+    if (negative_daily_counts_option in ["delete_and_interpolate", "delete_and_ffill"]):
+        valid = ~np.isnan(prev_daily)
+        lastvalid = np.where(valid.any(axis=1),
+                             nprev - 1 - np.argmax(valid[:, ::-1], axis=1), -1)
+        # (a revision inside a gap that was filled re-fills the whole gap,
+        #  from the last good daily count before it)
+        rawdaily = np.full(prev_cum.shape, np.nan)
+        rawdaily[:, 1:] = np.diff(prev_cum, axis=1)
+        with np.errstate(invalid='ignore'):
+            good = rawdaily >= 0
+        lastgood = np.maximum.accumulate(np.where(good, np.arange(nprev), -1), axis=1)
+        ingap = np.nonzero( (revised > 0) & (revised < nprev) )[0]
+        revised[ingap] = lastgood[ingap, revised[ingap] - 1] + 1
+        restart = np.minimum(revised, lastvalid + 1)
+    prev_avg = prev_df.pivot(index='fips', columns='date',
+                             values='14davg').to_numpy()[prevrow]
+    def recompute(rows):
+        # the stored rows before the restart of each of these rows (of
+        # old), and the new rows after it, where only the last 14 days
+        # before the earliest restart are needed to seed the diff, the
+        # gap filling and the 14d-average
+        j0 = max(0, restart[rows].min() - 14)
+        seedcum = cum[old[rows], j0:].copy()
+        seeddaily = np.full(seedcum.shape, np.nan)
+        seeded = (np.arange(j0, len(dates))[None, :] < restart[rows, None])
+        seedcum[:, :nprev-j0][seeded[:, :nprev-j0]] = \
+            prev_cum[rows, j0:][seeded[:, :nprev-j0]]
+        seeddaily[:, :nprev-j0][seeded[:, :nprev-j0]] = \
+            prev_daily[rows, j0:][seeded[:, :nprev-j0]]
+        daily, avg14 = get_daily_matrices(seedcum, seed_daily=seeddaily, seeded=seeded)
+        prevkeep = np.arange(nprev)[None, :] < restart[rows, None]
+        return [daily_matrices_to_df(fips[old[rows]], dates[:nprev], prev_cum[rows],
+                                     prev_daily[rows], prev_avg[rows], keep=prevkeep),
+                daily_matrices_to_df(fips[old[rows]], dates[j0:], cum[old[rows], j0:],
+                                     daily, avg14, keep=~seeded)]
+    # (the revised series separately, so that the others are only
+    #  computed over their last few weeks)
+    isrevised = (revised < nprev)
+    dfs = []
+    for rows in [np.nonzero(isrevised)[0], np.nonzero(~isrevised)[0]]:
+        if (len(rows) > 0):
+            dfs.extend(recompute(rows))
+    #=== Any new FIPS get their full history
+    if (len(new) > 0):
+        msg_to_usr(datatype + "_daily-counts",
+                   f"Computing all dates for {len(new)} new FIPS")
+        daily, avg14 = get_daily_matrices(cum[new])
+        dfs.append(daily_matrices_to_df(fips[new], dates, cum[new], daily, avg14))
+    df = pd.concat(dfs, ignore_index=True)
+    return df.sort_values(['fips', 'date']).reset_index(drop=True)
+
+def first_revised_dates(cum, prev_cum):
+    # For each row of the (fips x date) cumulative matrix, the position
+    # of the first date on which it differs from the previous one (of
+    # the same shape), i.e., the first date that the source revised, or
+    # the number of dates if there is none (nan is equal to nan)
+    cum = cum.astype(float)
+    changed = (cum != prev_cum) & ~(np.isnan(cum) & np.isnan(prev_cum))
+    return np.where(changed.any(axis=1), np.argmax(changed, axis=1), cum.shape[1])
+
+def get_cum_matrix(dfin):
+    # [fips, dates, (fips x date) matrix of cumulative values] from
+    # a wide dataframe [fips, county, state, <day1 data>, ...]
+    # (sorted by fips and date)
+    datecols = [c for c in dfin.columns.to_list()
+                if c not in ['fips', 'county', 'state']]
+    dates = pd.to_datetime(pd.Series(datecols), format="%m/%d/%y").to_numpy()
+    fips = dfin['fips'].to_numpy().astype(int)
+    rowsort = np.argsort(fips, kind='stable')
+    colsort = np.argsort(dates, kind='stable')
+    cum = dfin[datecols].to_numpy()[rowsort][:, colsort]
+    return [fips[rowsort], dates[colsort], cum]
+
+def get_daily_matrices(cum, seed_daily=None, seeded=None):
+    # Daily values and 14-day averages from the (fips x date) matrix of
+    # cumulative values.  Entries marked in "seeded" are taken as-is
+    # from seed_daily (already cleaned), rather than computed.
+    #
+    # (negative daily counts and data dumps are found afterwards, for
+    #  all series at once; see find_anomalies)
+    #
+    cum = cum.astype(float)
+    if (negative_daily_counts_option == "redistribute"):
+        cum = redistribute_negatives(cum)
+    #=== Daily values are the difference of the cumulative
+    #    (first day of each series is nan, as with diff())
+    daily = np.full(cum.shape, np.nan)
+    daily[:, 1:] = np.diff(cum, axis=1)
+    if seeded is None:
+        seeded = np.zeros(cum.shape, dtype=bool)
+    else:
+        daily[seeded] = seed_daily[seeded]
+    #=== Clean the negative daily values
+    if (negative_daily_counts_option in ["delete", "delete_and_interpolate",
+                                         "delete_and_ffill"]):
+        # set negative values to nan
+        with np.errstate(invalid='ignore'):
+            daily[daily < 0] = np.nan
+    if (negative_daily_counts_option == "delete_and_interpolate"):
+        daily = fill_gaps(daily, "linear")
+    elif (negative_daily_counts_option == "delete_and_ffill"):
+        daily = fill_gaps(daily, "ffill")
+    #=== Calculate the 14d-average (nan if any day in window is nan)
+    avg14 = trailing_means(daily, [14])[0]
+    return [daily, avg14]
+
+def fill_gaps(daily, method):
+    # Fill the runs of nan values that lie between two good values in
+    # every row of the (fips x date) matrix at once, leaving leading/
+    # trailing nans in place:
+    #
+    #    linear: interpolate between the good values on either side
+    #    ffill:  carry the good value before the run forward
+    #
+    # (each entry just needs the positions of the good values before
+    #  and after it, which are running max/min's along the dates)
+    ndates = daily.shape[1]
+    good = ~np.isnan(daily)
+    days = np.arange(ndates)
+    before = np.maximum.accumulate(np.where(good, days, -1), axis=1)
+    after = np.minimum.accumulate(np.where(good, days, ndates)[:, ::-1],
+                                  axis=1)[:, ::-1]
+    gap = (~good) & (before >= 0) & (after < ndates)
+    rows, cols = np.nonzero(gap)
+    j0, j1 = before[gap], after[gap]
+    filled = daily.copy()
+    if (method == "linear"):
+        y0, y1 = daily[rows, j0], daily[rows, j1]
+        filled[rows, cols] = y0 + (cols - j0) * ((y1 - y0) / (j1 - j0))
+    elif (method == "ffill"):
+        filled[rows, cols] = daily[rows, j0]
+    else:
+        print("***Error unknown gap filling method", method)
+        exit(0)
+    return filled
+
+def redistribute_negatives(cum):
+    # Lower the earlier values of each (fips x date) cumulative series
+    # so that it never decreases, i.e., each day is the minimum of it
+    # and all later days (a reverse running minimum), which takes each
+    # negative daily count off the days before it (nan are kept)
+    lowered = np.fmin.accumulate(cum[:, ::-1], axis=1)[:, ::-1]
+    return np.where(np.isnan(cum), np.nan, lowered)
+
+def trailing_means(daily, windows, axis=1):
+    # Trailing n-day means along the date axis for each n in windows
+    # (nan if any day in the window is nan, or if there aren't n days
+    # yet, as with rolling(n).mean()).  The running sums are taken once,
+    # so each window is just a difference of them:
+    #
+    #     mean[t] = (sum[t] - sum[t-n]) / n
+    #
+    # and a window of all zeros is exactly zero (not a rounding error).
+    daily = np.moveaxis(daily, axis, -1)
+    isnan = np.isnan(daily)
+    def running(x):
+        # sums over the first t days, for t = 0 ... ndates
+        sums = np.zeros(x.shape[:-1] + (x.shape[-1] + 1,))
+        np.cumsum(x, axis=-1, out=sums[..., 1:])
+        return sums
+    sums = running(np.where(isnan, 0.0, daily))
+    nnan = running(isnan)
+    nnonzero = running(daily != 0)
+    ndates = daily.shape[-1]
+    means = []
+    for n in windows:
+        mean = np.full(daily.shape, np.nan)
+        if (n <= ndates):
+            window = (sums[..., n:] - sums[..., :-n]) / n
+            window[(nnonzero[..., n:] - nnonzero[..., :-n]) == 0] = 0.0
+            window[(nnan[..., n:] - nnan[..., :-n]) > 0] = np.nan
+            mean[..., n-1:] = window
+        means.append(np.moveaxis(mean, -1, axis))
+    return means
+
+def daily_matrices_to_df(fips, dates, cum, daily, avg14, keep=None):
+    # Flatten the (fips x date) matrices into the long form
+    #
+    #    [date, fips, cum, daily, 14davg]
+    #
+    # (optionally keeping only the entries marked in "keep")
+    nfips, ndates = cum.shape
+    df = pd.DataFrame({'date': np.tile(dates, nfips),
+                       'fips': np.repeat(fips, ndates),
+                       'cum': cum.ravel(),
+                       'daily': daily.ravel(),
+                       '14davg': avg14.ravel()})
+    if keep is not None:
+        df = df[keep.ravel()].reset_index(drop=True)
+    return df
+
+def read_daily_output(filename):
+    # Previously output daily data [date, fips, cum, daily, 14davg]
+    # (or None if there is none)
+    if not dataset_exists(filename):
+        return None
+    return read_dataset(filename, "daily")
+
+###########################################################
+# Reading and writing the cleaned and daily data sets     #
+#                                                         #
+#     * csv: plain csv files                              #
+#     * parquet: typed, compressed parquet data sets      #
+#       (a directory for each file), partitioned by       #
+#       fips_state, so one state can be read alone        #
+#                                                         #
+#           cleaned: [fips (int32), county, state,        #
+#                     <day1 data (int32)>, ...]           #
+#           daily:   [date (date32), fips (int32),        #
+#                     cum (int32), daily (float64),       #
+#                     14davg (float64)]                   #
+#                                                         #
+#       The daily data are sorted by date within each     #
+#       state, so a date range only reads the row groups  #
+#       that it needs.                                    #
+###########################################################
+def dataset_path(filename):
+    # The parquet data set (directory) for an output csv filename
+    if (output_format == "parquet"):
+        return filename[:-len(".csv")] + ".parquet"
+    return filename
+
+def write_dataset(df, filename, kind):
+    # Write a "cleaned", "daily", "anomalies" or "divergence" dataframe in the output
+    # format (and as csv, too, if asked for)
+    if ( (output_format == "csv") or export_csv ):
+        df.to_csv(filename, index=False)
+    if (output_format != "parquet"):
+        return
+    df = df.copy()
+    df['fips_state'] = df['fips'].astype(int) // 1000
+    if (kind == "daily"):
+        df = df.sort_values(['date', 'fips'])
+        schema = pa.schema([('date', pa.date32()), ('fips', pa.int32()),
+                            ('cum', pa.int32()), ('daily', pa.float64()),
+                            ('14davg', pa.float64()), ('fips_state', pa.int8())])
+    elif (kind == "anomalies"):
+        df = df.sort_values(['date', 'fips'])
+        schema = pa.schema([('source', pa.string()), ('metric', pa.string()),
+                            ('fips', pa.int32()), ('date', pa.date32()),
+                            ('cum', pa.float64()), ('daily', pa.float64()),
+                            ('14davg', pa.float64()), ('ratio', pa.float64()),
+                            ('kind', pa.string()), ('fips_state', pa.int8())])
+    elif (kind == "divergence"):
+        for col in ['stateabb', 'county']:
+            df[col] = [(v if isinstance(v, str) else None) for v in df[col]]
+        schema = pa.schema([('metric', pa.string()), ('rank', pa.float64()),
+                            ('fips', pa.int32()), ('date', pa.date32()),
+                            ('stateabb', pa.string()), ('county', pa.string())]
+                           + [(c, pa.float64()) for c in df.columns.to_list()
+                              if c not in ['metric', 'rank', 'fips', 'date',
+                                           'stateabb', 'county', 'fips_state']]
+                           + [('fips_state', pa.int8())])
+    else:
+        for col in ['county', 'state']:
+            df[col] = [(v if isinstance(v, str) else None) for v in df[col]]
+        datecols = [c for c in df.columns.to_list()
+                    if c not in ['fips', 'county', 'state', 'fips_state']]
+        schema = pa.schema([('fips', pa.int32()), ('county', pa.string()),
+                            ('state', pa.string())]
+                           + [(c, pa.int32()) for c in datecols]
+                           + [('fips_state', pa.int8())])
+    table = pa.Table.from_pandas(df[schema.names], schema=schema,
+                                 preserve_index=False)
+    path = dataset_path(filename)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    pq.write_to_dataset(table, path, partition_cols=['fips_state'],
+                        row_group_size=8192)
+
+def read_dataset(filename, kind, fips_state=None, date_range=None):
+    # Read a "cleaned", "daily", "anomalies" or "divergence" dataframe written by write_dataset,
+    # optionally for just one state (fips_state) and/or the dates
+    # date_range = [first_date, last_date]
+    if (output_format == "parquet"):
+        path = dataset_path(filename)
+        filters = []
+        if fips_state is not None:
+            filters.append(('fips_state', '=', fips_state))
+        columns = None
+        if ( (date_range is not None) & (kind != "cleaned") ):
+            filters.append(('date', '>=', pd.Timestamp(date_range[0]).date()))
+            filters.append(('date', '<=', pd.Timestamp(date_range[1]).date()))
+        elif (date_range is not None):
+            # (for the cleaned data, just read the columns in range)
+            allcols = pq.ParquetDataset(path).schema.names
+            columns = [c for c in allcols if c in ['fips', 'county', 'state']]\
+                + [c for c in allcols if ( (c not in ['fips', 'county', 'state', 'fips_state'])
+                                           and (pd.Timestamp(date_range[0])
+                                                <= pd.to_datetime(c, format="%m/%d/%y")
+                                                <= pd.Timestamp(date_range[1])) )]
+        table = pq.read_table(path, columns=columns,
+                              filters=(filters if filters else None))
+        df = table.to_pandas(date_as_object=False)
+        if 'fips_state' in df.columns:
+            df = df.drop(columns='fips_state')
+        if (kind != "cleaned"):
+            df['date'] = df['date'].astype('datetime64[ns]')
+    else:
+        df = pd.read_csv(filename)
+        if (kind != "cleaned"):
+            df['date'] = pd.to_datetime(df['date'])
+        if fips_state is not None:
+            df = df[df['fips'] // 1000 == fips_state]
+        if ( (date_range is not None) & (kind != "cleaned") ):
+            df = df[df['date'].between(pd.Timestamp(date_range[0]),
+                                       pd.Timestamp(date_range[1]))]
+        elif (date_range is not None):
+            df = df[[c for c in df.columns.to_list()
+                     if ( (c in ['fips', 'county', 'state'])
+                          or (pd.Timestamp(date_range[0])
+                              <= pd.to_datetime(c, format="%m/%d/%y")
+                              <= pd.Timestamp(date_range[1])) )]]
+    # put back into (fips, date) order
+    if (kind == "daily"):
+        df = df.sort_values(['fips', 'date'])
+    elif (kind == "anomalies"):
+        df = df.sort_values(['source', 'metric', 'fips', 'date'])
+    elif (kind == "divergence"):
+        df = df.sort_values(['metric', 'rank', 'fips'])
+    else:
+        df = df.sort_values('fips', kind='stable')
+    return df.reset_index(drop=True)
+
+def dataset_exists(filename):
+    return os.path.exists(dataset_path(filename))
+
+###########################################################
+# Stage cache                                             #
+#                                                         #
+#   Each stage (fips_dma, clean, daily) has a key, the    #
+#   sha256 of its input files and options, and of the     #
+#   code of every function that makes its outputs (see    #
+#   called_functions).  After a stage runs, a manifest is #
+#   written to stage_manifest_dir:                        #
+#                                                         #
+#     {stage, key, created, inputs: {file: sha256},       #
+#      options: {option: value}, outputs: {file: sha256}} #
+#                                                         #
+#   and the stage is skipped on the next run if the key   #
+#   is the same and the outputs are unchanged.  (if its   #
+#   input files are missing, its existing outputs are     #
+#   used, and it is an error if they are missing, too)    #
+###########################################################
+def path_sha256(path):
+    # sha256 of a file, or of all files in a directory (parquet data set)
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(os.path.join(d, f)
+                       for d, _, fs in os.walk(path) for f in fs)
+    else:
+        files = [path]
+    for f in files:
+        h.update(os.path.relpath(f, path).encode())
+        with open(f, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def code_sha256(*objs):
+    # sha256 of the source code/values of the objects that make a stage
+    h = hashlib.sha256()
+    for obj in objs:
+        h.update((inspect.getsource(obj) if callable(obj) else repr(obj)).encode())
+    return h.hexdigest()
+
+def called_functions(*funcs):
+    # funcs and all of the functions of this module that they call
+    # (directly, or through each other), by name, so that the code of a
+    # stage is all of the code that makes its outputs
+    found = {}
+    todo = list(funcs)
+    while todo:
+        func = inspect.unwrap(todo.pop())
+        if func.__name__ in found:
+            continue
+        found[func.__name__] = func
+        codes = [func.__code__]
+        while codes:
+            code = codes.pop()
+            # (including nested functions, lambdas and comprehensions)
+            codes.extend(c for c in code.co_consts if inspect.iscode(c))
+            for name in code.co_names:
+                obj = globals().get(name)
+                if ( inspect.isfunction(obj) and (obj.__module__ == __name__) ):
+                    todo.append(obj)
+    return [found[name] for name in sorted(found)]
+
+def stage_inputs(stage):
+    # Input files and options for each stage, where the input of a
+    # later stage includes the key of the stage before it
+    if (stage == "fips_dma"):
+        # (only the attribute table of the shapefile is read)
+        shapefile_stem = UScounty_shape_filepath[:-len(".shp")]
+        files = [shapefile_stem + ".dbf"] \
+            + [USstate_fips_filepath, countyDMA_filename]
+        options = {'code': code_sha256(*called_functions(output_fips_dma_file))}
+    elif (stage == "clean"):
+        files = [outfilename_statecounty_fips, filename_nyt_raw,
+                 filename_jhu_cases_raw, filename_jhu_deaths_raw]
+        options = {'delete_jhu_cruise_entries': delete_jhu_cruise_entries,
+                   'delete_jhu_prison_entries': delete_jhu_prison_entries,
+                   'output_format': output_format,
+                   'code': code_sha256(nyt_correction_rules,
+                                       jhu_correction_rules, fips_coverings,
+                                       *called_functions(load_nyt_covid,
+                                                         load_jhu_covid,
+                                                         build_fips_registry))}
+    elif (stage == "daily"):
+        files = []
+        options = {'clean_key': stage_key("clean")[0],
+                   'negative_daily_counts_option': negative_daily_counts_option,
+                   'output_format': output_format,
+                   'code': code_sha256(*called_functions(make_daily))}
+    return [files, options]
+
+def stage_outputs(stage):
+    if (stage == "fips_dma"):
+        return [outfilename_statecounty_fips]
+    elif (stage == "clean"):
+        files = [nyt_c_cleaned_output_file, nyt_d_cleaned_output_file,
+                 jhu_c_cleaned_output_file, jhu_d_cleaned_output_file]
+    elif (stage == "daily"):
+        files = [nyt_c_daily_output_file, nyt_d_daily_output_file,
+                 jhu_c_daily_output_file, jhu_d_daily_output_file]
+    return [dataset_path(f) for f in files]
+
+stage_keys = {}
+def stage_key(stage):
+    # [key, {file: sha256}, options] for a stage (computed once per run,
+    # and with sha256 = None for missing files)
+    if stage not in stage_keys:
+        [files, options] = stage_inputs(stage)
+        inputs = {f: (path_sha256(f) if os.path.exists(f) else None)
+                  for f in files}
+        key = hashlib.sha256(json.dumps([inputs, options],
+                                        sort_keys=True).encode()).hexdigest()
+        stage_keys[stage] = [key, inputs, options]
+    return stage_keys[stage]
+
+def manifest_filename(stage):
+    return stage_manifest_dir + stage + ".json"
+
+def read_stage_manifest(stage):
+    if not os.path.exists(manifest_filename(stage)):
+        return None
+    with open(manifest_filename(stage)) as fh:
+        return json.load(fh)
+
+def stage_is_current(stage):
+    # Can the outputs of a stage be re-used?
+    if stage in force_stages:
+        return False
+    missing = [f for f, sha in stage_key(stage)[1].items() if sha is None]
+    if missing:
+        # (can't re-run it, so use the outputs that are there, e.g. the
+        #  committed UScounty_fips_dma.csv without ../pwpd and ../trends)
+        if not all(os.path.exists(f) for f in stage_outputs(stage)):
+            print("***Error input files for stage", stage, "not found:", missing)
+            exit(0)
+        msg_to_usr("main", "Input files for stage " + stage + " not found,"
+                   + " so using its existing outputs")
+        return True
+    manifest = read_stage_manifest(stage)
+    if manifest is None:
+        return False
+    if (manifest['key'] != stage_key(stage)[0]):
+        return False
+    for f, sha in manifest['outputs'].items():
+        if ( (not os.path.exists(f)) or (path_sha256(f) != sha) ):
+            return False
+    return True
+
+def write_stage_manifest(stage):
+    [key, inputs, options] = stage_key(stage)
+    manifest = {'stage': stage, 'key': key,
+                'created': dt.datetime.now().isoformat(timespec='seconds'),
+                'inputs': inputs, 'options': options,
+                'outputs': {f: path_sha256(f) for f in stage_outputs(stage)}}
+    os.makedirs(stage_manifest_dir, exist_ok=True)
+    with open(manifest_filename(stage), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+
+###########################################################
+# Combined (fips x date) data cube                        #
+#                                                         #
+#   All cleaned daily series in one dense array           #
+#                                                         #
+#     cube['values'][fips, date, source, metric, field]   #
+#                                                         #
+#   with axes                                             #
+#                                                         #
+#     fips:   cube['fips'] (all of counties_df, plus any  #
+#             others in the data), sorted                 #
+#     date:   cube['dates'] (every day)                   #
+#     source: cube_sources                                #
+#     metric: cube_metrics                                #
+#     field:  cube_fields                                 #
+#                                                         #
+#   and cube['present'][fips, date, source, metric] set   #
+#   where a series has an entry (values are nan where it  #
+#   doesn't).  The (source, metric, field) axes are last, #
+#   so the cube is also a (fips*date x 12) table.         #
+###########################################################
+cube_sources = ['jhu', 'nyt']
+cube_metrics = ['c', 'd']
+cube_fields = ['cum', 'daily', '14davg']
+
+def cube_columns():
+    # the all_df column names for the (source, metric, field) axes
+    return [s + "_" + m + "_" + f
+            for s in cube_sources for m in cube_metrics for f in cube_fields]
+
+def cube_fips_rows(cube, fips):
+    # row on the fips axis for each fips (which must be in the cube)
+    return np.searchsorted(cube['fips'], np.asarray(fips).astype(int))
+
+def cube_date_cols(cube, dates):
+    # column on the date axis for each date
+    return (pd.DatetimeIndex(dates) - cube['dates'][0]).days.to_numpy()
+
+def build_cube(series, counties_df):
+    # Make the cube from the daily dataframes
+    #
+    #    series = {(source, metric): [date, fips, cum, daily, 14davg]}
+    #
+    allfips = [counties_df['fips'].to_numpy()] \
+        + [df['fips'].to_numpy() for df in series.values()]
+    fips = np.unique(np.concatenate(allfips).astype(int))
+    first = min(df['date'].min() for df in series.values())
+    last = max(df['date'].max() for df in series.values())
+    cube = {'fips': fips, 'dates': pd.date_range(first, last)}
+    cube['values'] = np.full((len(fips), len(cube['dates']), len(cube_sources),
+                              len(cube_metrics), len(cube_fields)), np.nan)
+    cube['present'] = np.zeros(cube['values'].shape[:4], dtype=bool)
+    for (source, metric), df in series.items():
+        s = cube_sources.index(source)
+        m = cube_metrics.index(metric)
+        rows = cube_fips_rows(cube, df['fips'])
+        cols = cube_date_cols(cube, df['date'])
+        cube['values'][rows, cols, s, m, :] = df[cube_fields].to_numpy()
+        cube['present'][rows, cols, s, m] = True
+    return cube
+
+def find_anomalies(cube):
+    # Find the negative daily counts (before cleaning) and the data
+    # dumps (daily count above threshold_factor_for_data_dump times the
+    # 14d average, and above threshold_of_data_dump) of all series at
+    # once, as a table (sorted by source, metric, fips, date)
+    #
+    #   [source, metric, fips, date, cum, daily, 14davg, ratio, kind]
+    #
+    # where kind is "negative" (daily is the raw difference of the
+    # cumulative, ratio is nan) or "data_dump" (ratio = daily/14davg)
+    c = cube_fields.index('cum')
+    d = cube_fields.index('daily')
+    a = cube_fields.index('14davg')
+    values = cube['values']
+    # [fips, date, source, metric] arrays, with date moved to the end
+    # so each (fips, source, metric) series is contiguous
+    cum = np.moveaxis(values[..., c], 1, -1)
+    daily = np.moveaxis(values[..., d], 1, -1)
+    avg14 = np.moveaxis(values[..., a], 1, -1)
+    rawdaily = np.full(cum.shape, np.nan)
+    rawdaily[..., 1:] = np.diff(cum, axis=-1)
+    kinds = []
+    with np.errstate(invalid='ignore', divide='ignore'):
         if warn_on_negative_daily_counts:
-            # check for negative daily values
-            for index, row in \
-                df[onefips
-                   & (df['daily'] < threshold_for_negative_daily_counts)].iterrows():
-                print(datatype, row['date'].strftime("%Y-%m-%d"), "\t",
-                      f"{int(row['cum']):<10}", "\t",
-                      f"{int(row['daily']):<10}", "\t",
-                      county, sabb, row['fips'])
-        if (negative_daily_counts_option == "delete_and_interpolate"):
-            # set negative values to nan
-            df.loc[onefips & (df['daily'] < 0), 'daily'] = np.nan
-            # then interpolate across nan values
-            df.loc[onefips, 'daily'] = \
-                df[onefips]['daily'].interpolate(method='polynomial', order=1)
-        elif (negative_daily_counts_option == "delete"):
-            # set negative values to nan
-            df.loc[onefips & (df['daily'] < 0), 'daily'] = np.nan
-        # calculate the 14d-average
-        df.loc[onefips, '14davg'] \
-            = df[onefips]['daily'].rolling(14).mean()
+            kinds.append(["negative", rawdaily < threshold_for_negative_daily_counts,
+                          rawdaily, np.full(cum.shape, np.nan)])
         if warn_on_data_dumps:
-            for index, row in \
-                df[onefips &
-                   (df['daily'] > ( threshold_factor_for_data_dump
-                                       * df['14davg'] ))
-                   & (df['daily'] > threshold_of_data_dump)].iterrows():
-                print(datatype + "_data-dump",
-                      row['date'].strftime("%Y-%m-%d"), "\t",
-                      f"{row['14davg']:<6.3f}", "\t",
-                      f"{int(row['daily']):<6}", "\t",
-                      f"{row['daily']/row['14davg']:<6.1f}", "\t",
-                      county, sabb, row['fips'])
+            kinds.append(["data_dump",
+                          ( (daily > threshold_factor_for_data_dump * avg14)
+                            & (daily > threshold_of_data_dump) ),
+                          daily, daily / avg14])
+    tables = []
+    for kind, hits, dailyvals, ratio in kinds:
+        f, s, m, t = np.nonzero(hits)
+        tables.append(pd.DataFrame({
+            'source': np.array(cube_sources)[s],
+            'metric': np.array(cube_metrics)[m],
+            'fips': cube['fips'][f].astype(np.int32),
+            'date': cube['dates'][t],
+            'cum': cum[f, s, m, t],
+            'daily': dailyvals[f, s, m, t],
+            '14davg': avg14[f, s, m, t],
+            'ratio': ratio[f, s, m, t],
+            'kind': kind}))
+    if not tables:
+        return pd.DataFrame(columns=['source', 'metric', 'fips', 'date', 'cum',
+                                     'daily', '14davg', 'ratio', 'kind'])
+    df = pd.concat(tables, ignore_index=True)
+    return df.sort_values(['source', 'metric', 'fips', 'date'], kind='stable')\
+             .reset_index(drop=True)
+
+def summary_new_windows():
+    # positions in summary_windows of the averages not already in the
+    # cube (i.e., not 14davg)
+    return [i for i, n in enumerate(summary_windows)
+            if f"{n}davg" not in cube_fields]
+
+def summary_columns():
+    # the all_df column names of the summary (see build_summary)
+    avgs = [f"{n}davg" for n in summary_windows]
+    return [s + "_" + m + "_" + avgs[i] for s in cube_sources
+            for m in cube_metrics for i in summary_new_windows()] \
+        + [stat + "_" + m + "_" + f for stat in ['mean', 'geomean']
+           for m in cube_metrics for f in ['daily'] + avgs]
+
+def build_summary(cube):
+    # The summary columns for every (fips, date), as
+    #
+    #    summary['values'][fips, date, column]   (columns: summary_columns)
+    #
+    # with the same fips/date axes as the cube:
+    #
+    #    <source>_<metric>_<n>davg: trailing n-day average of the daily
+    #        values (see trailing_means), for each n in summary_windows
+    #        (except 14, which is already in the cube)
+    #    mean_<metric>_<field>, geomean_<metric>_<field>: the mean and
+    #        geometric mean over the sources with an entry (so where NYT
+    #        has no row, they're the JHU value), of the daily values and
+    #        of each average.  The geometric mean is the n-th root of the
+    #        product (zero if any source is zero), and nan if any value
+    #        is negative.
+    daily = cube['values'][..., cube_fields.index('daily')]
+    # [fips, date, source, metric, window]
+    avgs = np.stack(trailing_means(daily, summary_windows), axis=-1)
+    # [fips, date, source, metric, daily + windows]
+    fields = np.concatenate([daily[..., None], avgs], axis=-1)
+    present = cube['present'][..., None] & ~np.isnan(fields)
+    nsources = present.sum(axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(present, fields, 0.0).sum(axis=2) / nsources
+        product = np.where(present, fields, 1.0).prod(axis=2)
+        geomean = product ** (1.0 / nsources)
+    geomean[(present & (fields < 0)).any(axis=2) | (nsources == 0)] = np.nan
+    nfips, ndates = daily.shape[:2]
+    # (in the order of summary_columns)
+    values = np.concatenate([avgs[..., summary_new_windows()].reshape(nfips, ndates, -1),
+                             mean.reshape(nfips, ndates, -1),
+                             geomean.reshape(nfips, ndates, -1)], axis=-1)
+    return {'fips': cube['fips'], 'dates': cube['dates'], 'values': values}
+
+def divergence_columns():
+    # the all_df column names of the divergence (see build_divergence)
+    return [stat + "_" + m + "_" + f
+            for stat, f in [('consensus', 'cum'), ('absdiv', 'cum'), ('reldiv', 'cum'),
+                            ('absdiv', 'daily'), ('reldiv', 'daily')]
+            for m in cube_metrics]
+
+def source_pair(cube, field):
+    # [jhu, nyt, both] arrays [fips, date, metric] of one field, where
+    # both is set where both sources have a (non-nan) value
+    f = cube_fields.index(field)
+    jhu = cube['values'][:, :, cube_sources.index('jhu'), :, f]
+    nyt = cube['values'][:, :, cube_sources.index('nyt'), :, f]
+    both = ( cube['present'][:, :, cube_sources.index('jhu')]
+             & cube['present'][:, :, cube_sources.index('nyt')]
+             & ~np.isnan(jhu) & ~np.isnan(nyt) )
+    return [jhu, nyt, both]
+
+def build_divergence(cube):
+    # How far apart NYT and JHU are for every (fips, date), as
+    #
+    #    divergence['values'][fips, date, column]   (columns: divergence_columns)
+    #
+    # with the same fips/date axes as the cube:
+    #
+    #    consensus_<metric>_cum: the mean of the cumulative counts over
+    #        the sources with an entry (the daily consensus is the
+    #        summary's mean_<metric>_daily, see build_summary)
+    #    absdiv_<metric>_<field>: |JHU - NYT|, of the cumulative and of
+    #        the (cleaned) daily counts
+    #    reldiv_<metric>_<field>: |JHU - NYT| / mean(|JHU|, |NYT|), from
+    #        0 (the same) to 2 (one of them is zero), and 0 if both are
+    #
+    # (the divergences are nan unless both sources have a value)
+    cum = cube['values'][..., cube_fields.index('cum')]
+    present = cube['present'] & ~np.isnan(cum)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        consensus = np.where(present, cum, 0.0).sum(axis=2) / present.sum(axis=2)
+    columns = [consensus]
+    for field in ['cum', 'daily']:
+        jhu, nyt, both = source_pair(cube, field)
+        absdiv = np.where(both, np.abs(jhu - nyt), np.nan)
+        scale = (np.abs(jhu) + np.abs(nyt)) / 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reldiv = np.where(scale > 0, absdiv / scale, 0.0)
+        reldiv[~both] = np.nan
+        columns.extend([absdiv, reldiv])
+    # (in the order of divergence_columns)
+    return {'fips': cube['fips'], 'dates': cube['dates'],
+            'values': np.concatenate(columns, axis=-1)}
+
+def lag_alignment(jhu, nyt, both, max_lag):
+    # The lag (in days) that best lines up the two [fips, date, metric]
+    # series of each (fips, metric), i.e., with the smallest mean of
+    # |jhu[t] - nyt[t + lag]| over the dates that both have, for lags
+    # from -max_lag to max_lag (positive when NYT is later), as
+    #
+    #    [lag, mean difference at that lag, mean difference at lag 0]
+    #
+    # (ties go to the smaller lag, and all are nan without common dates)
+    ndates = jhu.shape[1]
+    lags = [0] + [l for k in range(1, max_lag + 1) for l in [-k, k]]
+    lags = [l for l in lags if (abs(l) < ndates)]
+    mads = []
+    for lag in lags:
+        a = slice(max(0, -lag), ndates - max(0, lag))
+        b = slice(max(0, lag), ndates - max(0, -lag))
+        common = both[:, a] & both[:, b]
+        diff = np.where(common, np.abs(jhu[:, a] - nyt[:, b]), 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mads.append(diff.sum(axis=1) / common.sum(axis=1))
+    mads = np.stack(mads)
+    best = np.argmin(np.where(np.isnan(mads), np.inf, mads), axis=0)
+    bestmad = np.take_along_axis(mads, best[None], axis=0)[0]
+    lag = np.where(np.isnan(bestmad), np.nan, np.array(lags, dtype=float)[best])
+    return [lag, bestmad, mads[0]]
+
+def rank_divergence(cube, divergence, registry):
+    # The places where NYT and JHU disagree the most, as a table with a
+    # row for each (metric, fips) that both sources have
+    #
+    #    [metric, rank, fips, date, stateabb, county, jhu_cum, nyt_cum,
+    #     absdiv_cum, reldiv_cum, mean_reldiv_daily, lag, lag_mad, mad,
+    #     lag_score]
+    #
+    # where date is the last date that both have (and the cumulative
+    # values are on it), mean_reldiv_daily the mean relative divergence
+    # of the daily counts, lag/lag_mad/mad are from lag_alignment (of the
+    # daily counts) and lag_score = 1 - lag_mad/mad is how much of the
+    # difference the lag explains.  The places with at least
+    # divergence_min_count cumulative counts, where the sources differ
+    # (reldiv_cum > 0), are ranked (1 = worst) by reldiv_cum (then
+    # absdiv_cum), with the same (lowest) rank for ties; the others have
+    # a rank of nan.
+    jhu, nyt, both = source_pair(cube, 'cum')
+    daily_jhu, daily_nyt, daily_both = source_pair(cube, 'daily')
+    lag, lag_mad, mad = lag_alignment(daily_jhu, daily_nyt, daily_both,
+                                      divergence_max_lag)
+    columns = divergence_columns()
+    ndates = len(cube['dates'])
+    names = registry['df'].set_index('fips')[['stateabb', 'countylong']]\
+        .reindex(cube['fips']).fillna("")
+    tables = []
+    for m, metric in enumerate(cube_metrics):
+        has = both[:, :, m].any(axis=1)
+        f = np.nonzero(has)[0]
+        last = ndates - 1 - np.argmax(both[f, ::-1, m], axis=1)
+        values = divergence['values'][f, last]
+        reldiv_daily = divergence['values'][f, :, columns.index(f"reldiv_{metric}_daily")]
+        hasdaily = ~np.isnan(reldiv_daily)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_reldiv_daily = np.where(hasdaily, reldiv_daily, 0.0).sum(axis=1) \
+                / hasdaily.sum(axis=1)
+            score = np.where(mad[f, m] > 0, 1 - lag_mad[f, m] / mad[f, m], 0.0)
+        df = pd.DataFrame({
+            'metric': metric,
+            'fips': cube['fips'][f].astype(np.int32),
+            'date': cube['dates'][last],
+            'stateabb': names['stateabb'].to_numpy()[f],
+            'county': names['countylong'].to_numpy()[f],
+            'jhu_cum': jhu[f, last, m],
+            'nyt_cum': nyt[f, last, m],
+            'absdiv_cum': values[:, columns.index(f"absdiv_{metric}_cum")],
+            'reldiv_cum': values[:, columns.index(f"reldiv_{metric}_cum")],
+            'mean_reldiv_daily': mean_reldiv_daily,
+            'lag': lag[f, m],
+            'lag_mad': lag_mad[f, m],
+            'mad': mad[f, m],
+            'lag_score': np.where(np.isnan(mad[f, m]), np.nan, score)})
+        ranked = ( (values[:, columns.index(f"consensus_{metric}_cum")]
+                    >= divergence_min_count)
+                   & (df['reldiv_cum'].to_numpy() > 0) )
+        order = df[ranked].sort_values(['reldiv_cum', 'absdiv_cum'],
+                                       ascending=False, kind='stable')
+        key = order[['reldiv_cum', 'absdiv_cum']].to_numpy()
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (key[1:] != key[:-1]).any(axis=1)
+        df['rank'] = np.nan
+        df.loc[order.index, 'rank'] = np.maximum.accumulate(
+            np.where(first, np.arange(1, len(order) + 1), 0))
+        tables.append(df)
+    df = pd.concat(tables, ignore_index=True)
+    df.insert(1, 'rank', df.pop('rank'))
+    return df.sort_values(['metric', 'rank', 'fips'], kind='stable').reset_index(drop=True)
+
+def cube_to_df(cube, keep=None, summary=None, divergence=None):
+    # All series as one dataframe
+    #
+    #    [date, fips, jhu_c_cum, jhu_c_daily, jhu_c_14davg, jhu_d_cum, ...,
+    #     nyt_c_cum, ..., nyt_d_14davg, <summary columns>...,
+    #     <divergence columns>...]
+    #
+    # sorted by fips, then date (the summary/divergence columns only if
+    # they are given, see build_summary and build_divergence).  Without
+    # keep, every (fips, date), with each column a view of the cube (or
+    # of the summary/divergence), not a copy.  With keep (a [fips, date]
+    # boolean array), only those rows (a copy).
+    nfips, ndates = cube['values'].shape[:2]
+    tables = [[cube_columns(), cube['values'].reshape(nfips*ndates, -1)]]
+    if summary is not None:
+        tables.append([summary_columns(), summary['values'].reshape(nfips*ndates, -1)])
+    if divergence is not None:
+        tables.append([divergence_columns(),
+                       divergence['values'].reshape(nfips*ndates, -1)])
+    fips = np.repeat(cube['fips'], ndates)
+    dates = np.tile(cube['dates'].to_numpy(), nfips)
+    if keep is not None:
+        keep = keep.reshape(-1)
+        tables = [[columns, table[keep]] for columns, table in tables]
+        fips = fips[keep]
+        dates = dates[keep]
+    # (one column for each column of the tables, so they aren't copied
+    #  into one block)
+    data = {'date': dates, 'fips': fips}
+    for columns, table in tables:
+        data.update({c: table[:, j] for j, c in enumerate(columns)})
+    return pd.DataFrame(data, copy=False)
+
+###########################################################
+# Stage scheduler                                         #
+#                                                         #
+#   The pipeline is a set of tasks, each with the tasks   #
+#   it depends on:                                        #
+#                                                         #
+#      {name: [function, [dependencies], (other args)]}   #
+#                                                         #
+#   where each task is run (in a process pool, as soon as #
+#   its dependencies are done) as                         #
+#                                                         #
+#      function(<dependency results>..., <other args>...) #
+#                                                         #
+#   and a dependency is either the name of a task, or     #
+#   [name, i] for the i-th element of its result.         #
+###########################################################
+def run_stage_task(name, func, args):
+    # Run one task (in a worker process, or in this one), and return
+    # its result and the profiling records made while running it
+    # (taken back out of profile_records; run_stage_dag adds them)
+    start = len(profile_records)
+    with profile_step(name):
+        result = func(*args)
+    records = profile_records[start:]
+    del profile_records[start:]
+    for record in records:
+        record['task'] = name
+        record['pid'] = os.getpid()
+    return [result, records]
+
+def run_stage_dag(tasks, max_workers, results=None):
+    # Run all tasks (see above) and return {name: result}
+    results = {} if results is None else dict(results)
+    def task_args(name):
+        [func, deps, args] = tasks[name]
+        depresults = [(results[d] if isinstance(d, str) else results[d[0]][d[1]])
+                      for d in deps]
+        return depresults + list(args)
+    def is_ready(name):
+        return all(((d if isinstance(d, str) else d[0]) in results)
+                   for d in tasks[name][1])
+    todo = [name for name in tasks if name not in results]
+    records = []
+    if (max_workers <= 1):
+        #=== Run the tasks one at a time, in this process
+        while todo:
+            ready = [name for name in todo if is_ready(name)]
+            if not ready:
+                print("***Error stage tasks can't be run (missing dependencies?):", todo)
+                exit(0)
+            name = ready[0]
+            results[name], taskrecords = \
+                run_stage_task(name, tasks[name][0], task_args(name))
+            records.extend(taskrecords)
+            todo.remove(name)
+    else:
+        #=== Run each task in the pool as soon as its dependencies are done
+        with cf.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            running = {}
+            while (todo or running):
+                for name in [name for name in todo if is_ready(name)]:
+                    fut = pool.submit(run_stage_task, name,
+                                      tasks[name][0], task_args(name))
+                    running[fut] = name
+                    todo.remove(name)
+                if not running:
+                    print("***Error stage tasks can't be run (missing dependencies?):", todo)
+                    exit(0)
+                done, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                for fut in done:
+                    name = running.pop(fut)
+                    results[name], taskrecords = fut.result()
+                    records.extend(taskrecords)
+    profile_records.extend(records)
+    return results
+
+##################################################
+# Tasks of the pipeline (see main, below)        #
+##################################################
+def read_cleaned(cases_file, deaths_file):
+    # Already cleaned [cases, deaths] dataframes
+    nyt_or_jhu = os.path.basename(cases_file)[:3].upper()
+    df = read_dataset(cases_file, "cleaned")
+    msg_to_usr("main", "Loading already cleaned " + nyt_or_jhu + " data files..."
+               + " last date is: " + df.columns.to_list()[-1])
+    return [df, read_dataset(deaths_file, "cleaned")]
+
+def make_daily(dfin, datatype, filename, use_prev):
+    # Transpose a cleaned dataframe to get the daily values, form:
+    #
+    #     [date, fips, cum, daily, 14davg]
+    #
+    # and output it to file (with use_prev, only compute the dates
+    # that are newer than those in the previous output, and the ones
+    # that have been revised; see get_daily_data)
+    prev_df = read_daily_output(filename) if use_prev else None
+    msg_to_usr("main", "Transposing and getting daily values for " + datatype)
+    with profile_step("daily_" + datatype, rows_in=len(dfin)) as prof:
+        df = get_daily_data(dfin, datatype, prev_df)
+        prof['rows_out'] = len(df)
+    if ( (prev_df is not None) and (df is prev_df) ):
+        # (nothing has changed, so the output is already there)
+        return df
+    with profile_step("daily_write_" + datatype, rows_in=len(df)):
+        write_dataset(df, filename, "daily")
     return df
 
+def read_daily(filename):
+    # Already daily-diffed dataframe
+    df = read_dataset(filename, "daily")
+    msg_to_usr("main", "Loading already daily-diffed data file "
+               + dataset_path(filename) + "... last date is: " + df.date.max().strftime("%Y-%m-%d"))
+    return df
+
+def make_cube(nyt_c_df, nyt_d_df, jhu_c_df, jhu_d_df, registry):
+    # Combine NYT and JHU data into the (fips x date) cube (see build_cube)
+    msg_to_usr("main", "Combining dataframes into single (fips x date) cube")
+    with profile_step("cube_build", rows_in=len(jhu_c_df) + len(jhu_d_df)
+                      + len(nyt_c_df) + len(nyt_d_df)) as prof:
+        cube = build_cube({('nyt', 'c'): nyt_c_df, ('nyt', 'd'): nyt_d_df,
+                           ('jhu', 'c'): jhu_c_df, ('jhu', 'd'): jhu_d_df},
+                          registry['df'])
+        prof['rows_out'] = int(cube['present'].any(axis=(2, 3)).sum())
+    return cube
+
 #############
 # Main Code # 
 #############
+def main():
+    run_start = dt.datetime.now()
 
-# Create the basic county FIPS and DMA file, or read it in from file
-if do_fips_dma_collection:
-    counties_df = output_fips_dma_file()
-else:
-    msg_to_usr("main", "Loading the counties fips file")
+    # Create the basic county FIPS and DMA file, or read it in from file
+    if not stage_is_current("fips_dma"):
+        with profile_step("fips_registry") as prof:
+            counties_df = output_fips_dma_file()
+            prof['rows_out'] = len(counties_df)
+        write_stage_manifest("fips_dma")
+    else:
+        msg_to_usr("main", "Loading the counties fips file")
+        #
+        # columns are:
+        #
+        #    [fips_state, fips_county, fips, county_type,
+        #     state, stateabb, county, countylong, dma, dmaname]
+        #
+        counties_df = pd.read_csv(outfilename_statecounty_fips)
+    # and index it (see build_fips_registry)
+    fips_registry = build_fips_registry(counties_df)
+
+    # The rest of the pipeline, as tasks (see run_stage_dag), where
+    # the NYT and JHU branches (and each of the four series) can be
+    # run at the same time:
     #
-    # columns are:
+    #     nyt_cleaned --> nyt_c_daily, nyt_d_daily --\
+    #                                                  --> cube
+    #     jhu_cleaned --> jhu_c_daily, jhu_d_daily --/
     #
-    #    [fips_state, fips_county, fips, county_type,
-    #     state, stateabb, county, countylong, dma, dmaname]
+    #  (the cube is then made in this process, as its join of the four
+    #   series is the last step, and it would otherwise be pickled back
+    #   from a worker)
     #
-    counties_df = pd.read_csv(outfilename_statecounty_fips)
-
-# Load the NYTimes and JHU cases and deaths files and clean the data
-#
-#   output is:
-#
-#              [fips, county, state,
-#               <cases/deaths on date1>, <cases/deaths on date2>, ... ]
-#
-#   includes:
-#
-#        * individual counties (if data was given)
-#        * composite counties (if either NYT/JHU used them)
-#        * full-state "All" (w/ county fips 000)
-#        * full-DMA metro areas (w/ state fips 99, county fips = DMA)
-#
-if do_load_and_clean_nytjhu:
-    [nyt_c_df, nyt_d_df, jhu_c_df, jhu_d_df] = load_nyt_jhu_covid()
-else:
-    nyt_c_df = pd.read_csv(nyt_c_cleaned_output_file)
-    nyt_d_df = pd.read_csv(nyt_d_cleaned_output_file)
-    jhu_c_df = pd.read_csv(jhu_c_cleaned_output_file)
-    jhu_d_df = pd.read_csv(jhu_d_cleaned_output_file)
-    lastdate = nyt_c_df.columns.to_list()[-1]
-    msg_to_usr("main", "Loading already cleaned data files..." + 
-               " last date is: " + lastdate)
+    tasks = {}
+    run_clean = not stage_is_current("clean")
+    run_daily = not stage_is_current("daily")
 
+    # Load the NYTimes and JHU cases and deaths files and clean the data
+    #
+    #   output is:
+    #
+    #              [fips, county, state,
+    #               <cases/deaths on date1>, <cases/deaths on date2>, ... ]
+    #
+    #   includes:
+    #
+    #        * individual counties (if data was given)
+    #        * composite counties (if either NYT/JHU used them)
+    #        * full-state "All" (w/ county fips 000)
+    #        * full-DMA metro areas (w/ state fips 99, county fips = DMA)
+    #
+    if run_clean:
+        tasks['nyt_cleaned'] = [load_nyt_covid, [], (fips_registry,)]
+        tasks['jhu_cleaned'] = [load_jhu_covid, [], (fips_registry,)]
+    elif run_daily:
+        tasks['nyt_cleaned'] = [read_cleaned, [], (nyt_c_cleaned_output_file,
+                                                   nyt_d_cleaned_output_file)]
+        tasks['jhu_cleaned'] = [read_cleaned, [], (jhu_c_cleaned_output_file,
+                                                   jhu_d_cleaned_output_file)]
 
-if do_transpose_and_get_daily_values:
-    #=== Transpose each dataframe to get form:
+    # Transpose each dataframe to get form:
     #
     #     [date, fips, cases/deaths]
     #
-    msg_to_usr("main", "Transposing and getting daily values for NYT cases")
-    nyt_c_df = get_daily_data(nyt_c_df, 'nyt_cases')
-    msg_to_usr("main", "Transposing and getting daily values for NYT deaths")
-    nyt_d_df = get_daily_data(nyt_d_df, 'nyt_deaths')
-    msg_to_usr("main", "Transposing and getting daily values for JHU cases")
-    jhu_c_df = get_daily_data(jhu_c_df, 'jhu_cases')
-    msg_to_usr("main", "Transposing and getting daily values for JHU deaths")
-    jhu_d_df = get_daily_data(jhu_d_df, 'jhu_deaths')
-
-    #==== Output dataframes to csv
-    nyt_c_df.to_csv(nyt_c_daily_output_file, index=False)
-    nyt_d_df.to_csv(nyt_d_daily_output_file, index=False)    
-    jhu_c_df.to_csv(jhu_c_daily_output_file, index=False)
-    jhu_d_df.to_csv(jhu_d_daily_output_file, index=False)
-else:
-    #=== Otherwise, load the dataframes from file
-    nyt_c_df = pd.read_csv(nyt_c_daily_output_file)
-    nyt_d_df = pd.read_csv(nyt_d_daily_output_file)
-    jhu_c_df = pd.read_csv(jhu_c_daily_output_file)
-    jhu_d_df = pd.read_csv(jhu_d_daily_output_file)
-    lastdate = nyt_c_df.date.max()
-    msg_to_usr("main", "Loading already daily-diffed data files..."
-               +  " last date is: " + lastdate)
-
-# Combine NYT and JHU data into single dataframe:
-#
-#    * combine into single dataframe
-#
-#           [date, fips, jhu_cases, nyt_cases, jhu_deaths, nyt_deaths]
-#
-#    * calculate columns for mean and geometric mean
-#
-#    * calculate 14-day averages 
-#
-msg_to_usr("main", "Merging dataframes into single dataframe")
-all_df = pd.merge(jhu_c_df, jhu_d_df, how='left', on=['date', 'fips'])
-all_df = pd.merge(all_df, nyt_c_df, how='left', on=['date', 'fips'])
-all_df = pd.merge(all_df, nyt_d_df, how='left', on=['date', 'fips'])
-all_df.columns = ['date', 'fips', 'jhu_c_cum', 'jhu_c_daily', 'jhu_c_14davg',
-                  'jhu_d_cum', 'jhu_d_daily', 'jhu_d_14davg',
-                  'nyt_c_cum', 'nyt_c_daily', 'nyt_c_14davg',
-                  'nyt_d_cum', 'nyt_d_daily', 'nyt_d_14davg']
-all_df[all_df['fips'] == 36091].to_csv("junk.csv", index=False)
+    #  (and with an incremental refresh, use the previous output
+    #   to only compute the new dates, as long as it was made with
+    #   the same options)
+    #
+    series = [['nyt_c_daily', ['nyt_cleaned', 0], 'nyt_cases', nyt_c_daily_output_file],
+              ['nyt_d_daily', ['nyt_cleaned', 1], 'nyt_deaths', nyt_d_daily_output_file],
+              ['jhu_c_daily', ['jhu_cleaned', 0], 'jhu_cases', jhu_c_daily_output_file],
+              ['jhu_d_daily', ['jhu_cleaned', 1], 'jhu_deaths', jhu_d_daily_output_file]]
+    if run_daily:
+        prev_manifest = read_stage_manifest("daily")
+        same_options = ( (prev_manifest is not None)
+                         and ({k: v for k, v in prev_manifest['options'].items()
+                               if k != 'clean_key'}
+                              == {k: v for k, v in stage_key("daily")[2].items()
+                                  if k != 'clean_key'}) )
+        use_prev = ( incremental_daily_refresh and same_options
+                     and ("daily" not in force_stages) )
+        for [name, cleaned, datatype, filename] in series:
+            tasks[name] = [make_daily, [cleaned], (datatype, filename, use_prev)]
+    else:
+        #=== Otherwise, load the dataframes from file
+        for [name, cleaned, datatype, filename] in series:
+            tasks[name] = [read_daily, [], (filename,)]
+
+    # Combine NYT and JHU data into the (fips x date) cube, and get
+    # a single dataframe from it
+    #
+    #    * combine into single dataframe (the (fips, date) with JHU cases)
+    #
+    #           [date, fips, jhu_cases, nyt_cases, jhu_deaths, nyt_deaths]
+    #
+    #    * calculate columns for mean and geometric mean
+    #
+    #    * calculate 7/14/28-day averages (summary_windows)
+    #
+    #      (both after the cube is made, see build_summary)
+    #
+    #    * NYT/JHU consensus and divergence columns, and the table of
+    #      the places where they disagree the most (see build_divergence)
+    #
+    results = run_stage_dag(tasks, max_workers)
+    if run_clean:
+        write_stage_manifest("clean")
+    if run_daily:
+        write_stage_manifest("daily")
+    cube = make_cube(results['nyt_c_daily'], results['nyt_d_daily'],
+                     results['jhu_c_daily'], results['jhu_d_daily'], fips_registry)
+    #=== Publish the cube as a memory-mapped store
+    with profile_step("cube_store"):
+        covid19_store.write_store(cube, cube_store_dir,
+                                  cube_sources, cube_metrics, cube_fields)
+    msg_to_usr("main", "Wrote the (fips x date) cube store to " + cube_store_dir)
+    #=== Find the negative daily counts and data dumps (see find_anomalies)
+    if (warn_on_negative_daily_counts or warn_on_data_dumps):
+        with profile_step("anomalies") as prof:
+            anomalies_df = find_anomalies(cube)
+            write_dataset(anomalies_df, anomalies_output_file, "anomalies")
+            prof['rows_out'] = len(anomalies_df)
+        counts = anomalies_df.groupby(['source', 'metric', 'kind']).size()
+        for (source, metric, kind), n in counts.items():
+            msg_to_usr("main", f"{source}_{metric}: {n} {kind} entries")
+        msg_to_usr("main", "Wrote the anomaly table to "
+                   + dataset_path(anomalies_output_file))
+    #=== Summary columns (trailing averages, NYT+JHU mean and geometric mean)
+    with profile_step("summary", rows_in=int(cube['present'].any(axis=(2, 3)).sum())):
+        summary = build_summary(cube)
+    #=== Where NYT and JHU disagree (see build_divergence and rank_divergence)
+    with profile_step("divergence", rows_in=int(cube['present'].any(axis=(2, 3)).sum())) as prof:
+        divergence = build_divergence(cube)
+        divergence_df = rank_divergence(cube, divergence, fips_registry)
+        write_dataset(divergence_df, divergence_output_file, "divergence")
+        prof['rows_out'] = len(divergence_df)
+    for metric in cube_metrics:
+        worst = divergence_df[(divergence_df['metric'] == metric)
+                              & divergence_df['rank'].notna()].head(divergence_show_count)
+        msg_to_usr("main", f"NYT/JHU divergence of {metric} (worst {len(worst)}):")
+        for row in worst.itertuples():
+            msg_to_usr("main", f"   {int(row.rank):3d} {row.fips:5d} {row.stateabb} {row.county}:"
+                       f" jhu {row.jhu_cum:.0f}, nyt {row.nyt_cum:.0f}"
+                       f" ({100*row.reldiv_cum:.0f}%), lag {row.lag:+.0f}d")
+    msg_to_usr("main", "Wrote the divergence table to "
+               + dataset_path(divergence_output_file))
+    #=== All series as one dataframe, as a view of the cube, summary and
+    #    divergence (every (fips, date), see the top of this file; the
+    #    rows that any source has are cube['present'].any(axis=(2, 3)),
+    #    and those that JHU has cases for are
+    #    cube['present'][:, :, cube_sources.index('jhu'),
+    #    cube_metrics.index('c')])
+    all_df = cube_to_df(cube, summary=summary, divergence=divergence)
+
+    if write_profile_report:
+        output_profile_report(run_start)
+    return all_df
+
+if __name__ == "__main__":
+    all_df = main()
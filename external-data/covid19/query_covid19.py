@@ -0,0 +1,280 @@
+import os
+import json
+import functools
+import threading
+import http.server
+import urllib.parse
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import covid19_store
+import curate_covid19 as cc
+
+###########################################################
+# Queries over the curated (fips x date) cube             #
+#                                                         #
+#   Slices of the cube store (see covid19_store.py) by    #
+#   fips list, covering, DMA, state and date range, as a  #
+#   dataframe, JSON or Arrow, without loading all_df.     #
+#   The series of the most used fips of the open store    #
+#   are kept in an LRU cache (query_cache_size), so       #
+#   repeated queries are answered from memory.            #
+#                                                         #
+#   As a library:                                         #
+#                                                         #
+#     query = open_query()                                #
+#     df = query_df(query, [36091], "2021-01-01",         #
+#                   "2021-01-31", fields=["14davg"])      #
+#                                                         #
+#   or as a local server (python query_covid19.py):       #
+#                                                         #
+#     /series?fips=36091,36061&start=2021-01-01           #
+#             &end=2021-01-31&fields=14davg&format=json   #
+#     /series?covering=metro&sources=nyt&format=arrow     #
+#     /series?dma=1&metrics=c                             #
+#     /fips?covering=state                                #
+#                                                         #
+#   where fips/covering/dma/state select the fips (any    #
+#   given are all applied), sources/metrics/fields the    #
+#   columns (default all), and format is json or arrow.   #
+###########################################################
+
+##########################
+# Parameters and Options #
+##########################
+#=== Number of (fips) series kept in the cache
+query_cache_size = 4096
+
+#=== Server address
+query_host = "127.0.0.1"
+query_port = 8050
+
+#############
+# Filenames #
+#############
+query_store_dir = cc.cube_store_dir
+query_counties_file = cc.outfilename_statecounty_fips
+
+###########################################################
+# Opening the store and the (cached) series               #
+###########################################################
+# the open query of the server (see open_query)
+query_open = None
+# (held while a query is refreshed, see refresh_query)
+query_lock = threading.Lock()
+
+def open_query(store_dir=query_store_dir, counties_file=query_counties_file):
+    # Open the store and the fips registry (see build_fips_registry)
+    # as a dictionary with
+    #
+    #    store, series (see store_series), registry, store_dir,
+    #    counties_file, counties_mtime
+    #
+    global query_open
+    query = {'store_dir': store_dir, 'counties_file': counties_file}
+    open_query_store(query)
+    open_query_registry(query)
+    query_open = query
+    return query
+
+def open_query_store(query):
+    # (re-)open the current version of the store of a query
+    query['store'] = covid19_store.open_store(query['store_dir'])
+    query['series'] = store_series(query['store'])
+
+def open_query_registry(query):
+    # (re-)read the counties file of a query
+    query['registry'] = cc.build_fips_registry(pd.read_csv(query['counties_file']))
+    query['counties_mtime'] = os.path.getmtime(query['counties_file'])
+
+def refresh_query(query):
+    # Re-open the store of a query (in place) if a new version of it has
+    # been written since it was opened (see write_store), and the
+    # counties file if it has changed, and return a copy of the query
+    # as it is then.  (under query_lock, as the server's threads share
+    # query_open, so that one thread re-opens it, and the others only
+    # use whole copies of it, never one that is half re-opened)
+    with query_lock:
+        if (covid19_store.current_version(query['store_dir']) != query['store']['version']):
+            open_query_store(query)
+        if (os.path.getmtime(query['counties_file']) != query['counties_mtime']):
+            open_query_registry(query)
+        return dict(query)
+
+def store_series(store):
+    # fips -> the whole series of that fips in the store, [date, source,
+    # metric, field], read (once) into memory, and kept in an LRU cache
+    # that goes with this (version of the) store
+    @functools.lru_cache(maxsize=query_cache_size)
+    def series(fips):
+        return np.array(store['values'][store['fips_row'][fips]])
+    return series
+
+###########################################################
+# Selecting fips, dates and columns                       #
+###########################################################
+def select_fips(query, fips=None, covering=None, dma=None, state=None):
+    # The fips in the store matching all of the given selections:
+    #
+    #    fips: list of fips
+    #    covering: one of fips_coverings (e.g., 'regular+composite')
+    #    dma: dma number (the fips of the dma in the covering, or in
+    #         'regular+composite' if no covering is given)
+    #    state: fips_state
+    #
+    registry = query['registry']
+    selected = None
+    def keep(fipslist):
+        fipslist = [int(f) for f in fipslist]
+        if selected is None:
+            return fipslist
+        inlist = set(fipslist)
+        return [f for f in selected if f in inlist]
+    if fips is not None:
+        selected = keep(fips)
+    if covering is not None:
+        if covering not in registry['coverings']:
+            raise ValueError("unknown covering " + str(covering))
+        selected = keep(registry['coverings'][covering]['fips'])
+    if dma is not None:
+        selected = keep(cc.registry_dma_fips(registry, int(dma),
+                                             covering or 'regular+composite'))
+    if state is not None:
+        selected = keep(registry['by_state'].get(int(state), []))
+    if selected is None:
+        selected = [int(f) for f in query['store']['fips']]
+    return [f for f in selected if f in query['store']['fips_row']]
+
+def select_dates(query, first_date=None, last_date=None):
+    # [first day, last day + 1] (positions in the store dates) of the
+    # date range, clipped to the dates in the store
+    dates = query['store']['dates']
+    d0 = 0 if first_date is None else dates.searchsorted(pd.Timestamp(first_date))
+    d1 = len(dates) if last_date is None \
+        else dates.searchsorted(pd.Timestamp(last_date), side='right')
+    return [d0, max(d0, d1)]
+
+def select_axis(query, axis, names):
+    # positions of names (default all) in one of the store axes
+    # ('sources', 'metrics' or 'fields')
+    allnames = query['store']['index'][axis]
+    if names is None:
+        return list(range(len(allnames)))
+    for n in names:
+        if n not in allnames:
+            raise ValueError(f"unknown {axis[:-1]} {n} (not in {allnames})")
+    return [allnames.index(n) for n in names]
+
+###########################################################
+# Queries                                                 #
+###########################################################
+def query_df(query, fips, first_date=None, last_date=None,
+             sources=None, metrics=None, fields=None):
+    # The slice of the cube for the fips and dates, as a dataframe like
+    # the rows of all_df for them
+    #
+    #    [date, fips, <source>_<metric>_<field>...]
+    #
+    query = refresh_query(query)
+    index = query['store']['index']
+    s = select_axis(query, 'sources', sources)
+    m = select_axis(query, 'metrics', metrics)
+    f = select_axis(query, 'fields', fields)
+    d0, d1 = select_dates(query, first_date, last_date)
+    fips = [int(x) for x in fips if int(x) in query['store']['fips_row']]
+    ndates = d1 - d0
+    columns = [index['sources'][i] + "_" + index['metrics'][j] + "_" + index['fields'][k]
+               for i in s for j in m for k in f]
+    if ( (len(fips) == 0) or (ndates == 0) ):
+        values = np.empty((0, len(columns)))
+    else:
+        values = np.stack([query['series'](x)[d0:d1] for x in fips])
+        values = values[:, :, s][:, :, :, m][:, :, :, :, f]\
+            .reshape(len(fips) * ndates, len(columns))
+    df = pd.DataFrame(values, columns=columns)
+    df.insert(0, 'fips', np.repeat(np.array(fips, dtype=np.int32), ndates))
+    df.insert(0, 'date', np.tile(query['store']['dates'][d0:d1], len(fips)))
+    return df
+
+def df_to_json(df):
+    # {columns: [...], data: [[...], ...]} with dates as "YYYY-MM-DD"
+    # and nan as null
+    df = df.copy()
+    df['date'] = df['date'].dt.strftime("%Y-%m-%d")
+    data = df.astype(object).where(df.notna(), None).to_numpy().tolist()
+    return json.dumps({'columns': df.columns.to_list(), 'data': data})
+
+def df_to_arrow(df):
+    # the dataframe as an Arrow IPC stream
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+###########################################################
+# Local server                                            #
+###########################################################
+def list_param(params, name):
+    if name not in params:
+        return None
+    return [v for p in params[name] for v in p.split(",") if (v != "")]
+
+def one_param(params, name):
+    return params[name][-1] if name in params else None
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    # GET /series and /fips (see the top of this file)
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        try:
+            query = refresh_query(query_open)
+            fips = select_fips(query, fips=list_param(params, 'fips'),
+                               covering=one_param(params, 'covering'),
+                               dma=one_param(params, 'dma'),
+                               state=one_param(params, 'state'))
+            if (url.path == "/fips"):
+                self.send_body(json.dumps({'fips': fips}), "application/json")
+            elif (url.path == "/series"):
+                df = query_df(query, fips,
+                              one_param(params, 'start'), one_param(params, 'end'),
+                              list_param(params, 'sources'),
+                              list_param(params, 'metrics'),
+                              list_param(params, 'fields'))
+                if (one_param(params, 'format') == "arrow"):
+                    self.send_body(df_to_arrow(df),
+                                   "application/vnd.apache.arrow.stream")
+                else:
+                    self.send_body(df_to_json(df), "application/json")
+            else:
+                self.send_error(404, "unknown path " + url.path)
+        except (ValueError, KeyError) as err:
+            self.send_error(400, str(err))
+
+    def send_body(self, body, content_type):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        cc.msg_to_usr("query", format % args)
+
+#############
+# Main Code #
+#############
+def main():
+    open_query()
+    server = http.server.ThreadingHTTPServer((query_host, query_port), QueryHandler)
+    cc.msg_to_usr("query", f"Serving {query_store_dir} on http://{query_host}:{query_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
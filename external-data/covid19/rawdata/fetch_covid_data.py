@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import shutil
+import urllib.request
+import urllib.error
+import http.client
+import concurrent.futures as cf
+import datetime as dt
+import snapshot_archive
+
+###########################################################
+# Fetch today's raw covid19 data files                    #
+#                                                         #
+#   All sources are fetched at the same time, and each    #
+#   one only if it has changed since the last fetch       #
+#   (If-None-Match/If-Modified-Since, from the manifest), #
+#   so unchanged days cost one small request per file.    #
+#   A transfer that was cut off is resumed (Range) on the #
+#   next run, if the file hasn't changed in between.      #
+#   (the version being fetched is in <file>.part.json,    #
+#   next to the partial <file>.part)                      #
+#   Each new file is checked (size, and the sha-256       #
+#   Digest header if sent) before it replaces the old     #
+#   one, and then added to the archive of vintages (see   #
+#   snapshot_archive.py).                                 #
+#                                                         #
+#   The manifest (fetch_manifest_file) has, for each url, #
+#                                                         #
+#     {file, etag, last_modified, size, sha256, fetched,  #
+#      checked, status}                                   #
+#                                                         #
+#   e.g.,  python fetch_covid_data.py [server]            #
+#                                                         #
+#   where the optional server (e.g., a local stand-in for #
+#   testing, http://localhost:8000/) replaces the server  #
+#   in each url, keeping the rest of the path             #
+###########################################################
+
+##########################
+# Parameters and Options #
+##########################
+#=== Number of files fetched at the same time
+fetch_max_workers = 5
+
+#=== Seconds to wait for the server, and the number of retries
+#    (resuming where the transfer stopped) before giving up on a file
+fetch_timeout = 60
+fetch_retries = 3
+
+#=== Add each updated file to the archive of daily vintages
+#    (see snapshot_archive.py)
+archive_snapshots = True
+#=== Also keep the previous copy of each updated file in <dir>/old/?
+#    (not needed with the archive, which can restore any vintage)
+keep_old_copies = False
+
+#############
+# Filenames #
+#############
+fetch_manifest_file = "fetch_manifest.json"
+#=================================
+# Soucy and Berry's Covid19Canada
+#=================================
+#
+# https://opencovid.ca and https://github.com/ccodwg/Covid19Canada
+#
+# cases and deaths (daily and cumulative) by health region (no hr-uid)
+#    ["province","health_region","date_report","cases","cumulative_cases"
+# e.g.
+#    ["Ontario","Toronto","25-01-2020",1,1]
+#
+address_covid19canada_cases = "https://raw.githubusercontent.com/ccodwg/Covid19Canada/master/timeseries_hr/cases_timeseries_hr.csv"
+address_covid19canada_deaths = "https://raw.githubusercontent.com/ccodwg/Covid19Canada/master/timeseries_hr/mortality_timeseries_hr.csv"
+#======================
+# NYTimes Covid19 data
+#======================
+# https://github.com/nytimes/covid-19-data
+#
+# cumulative data (cases,deaths) by date for counties (w/ combined FIPS)
+#    [date,county,state,fips,cases,deaths]
+# e.g.,
+#    [2020-03-13,Saratoga,New York,36091,3,0]
+#
+address_nytimes_counties = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv"
+#==================
+# JHU Covid19 data
+#==================
+# https://github.com/CSSEGISandData/COVID-19
+# dashboard: https://www.arcgis.com/apps/opsdashboard/index.html#/bda7594740fd40299423467b48e9ecf6
+#
+# cumulative cases and deaths by county
+#    [UID,iso2,iso3,code3,FIPS,Admin2,Province_State,Country_Region,
+#     Lat,Long_,Combined_Key,Population,1/22/20,1/23/20,...,[today]]
+# e.g.
+#    [84036091,US,USA,840,36091.0,Saratoga,New York,US,
+#     43.10904162,-73.86653895,"Saratoga, New York, US",229863,0,...]
+#
+address_jhu_cases = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_US.csv"
+address_jhu_deaths = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_US.csv"
+
+#=== [directory, url] of each file
+fetch_sources = [
+    ["covid19canada", address_covid19canada_cases],
+    ["covid19canada", address_covid19canada_deaths],
+    ["nytimes", address_nytimes_counties],
+    ["jhu", address_jhu_cases],
+    ["jhu", address_jhu_deaths],
+]
+# (the server of all of the above, replaced by the command line argument)
+fetch_default_server = "https://raw.githubusercontent.com/"
+
+def msg_to_usr(section, msg):
+    print(section + "\t" + msg, flush=True)
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def read_manifest():
+    if not os.path.exists(fetch_manifest_file):
+        return {}
+    with open(fetch_manifest_file) as fh:
+        return json.load(fh)
+
+def write_manifest(manifest):
+    # (written to a temporary file first, so it's never half-written)
+    with open(fetch_manifest_file + ".tmp", 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(fetch_manifest_file + ".tmp", fetch_manifest_file)
+
+def read_partial(partfile):
+    # the version ({etag, last_modified}) of a partial file, or {}
+    if not ( os.path.exists(partfile) and os.path.exists(partfile + ".json") ):
+        return {}
+    with open(partfile + ".json") as fh:
+        return json.load(fh)
+
+def remove_partial(partfile):
+    for f in [partfile, partfile + ".json"]:
+        if os.path.exists(f):
+            os.remove(f)
+
+def digest_sha256(headers):
+    # the sha-256 from a "Digest: sha-256=<base64>" header (RFC 3230),
+    # as hex, or None
+    for part in (headers.get('Digest') or "").split(","):
+        name, _, value = part.strip().partition("=")
+        if (name.lower() == "sha-256"):
+            return base64.b64decode(value).hex()
+    return None
+
+###########################################################
+# Fetching one file                                       #
+###########################################################
+def fetch_one(dirname, url, entry):
+    # Fetch one url into dirname (see the top of this file), given its
+    # manifest entry (or {}), and return the new manifest entry
+    filename = os.path.join(dirname, url.rsplit("/", 1)[-1])
+    partfile = filename + ".part"
+    os.makedirs(dirname, exist_ok=True)
+    entry = dict(entry)
+    entry['file'] = filename
+    entry['checked'] = dt.datetime.now().isoformat(timespec='seconds')
+    # the file we have must still be the one in the manifest, or the
+    # conditional request would wrongly keep it
+    have_file = ( os.path.exists(filename)
+                  and (os.path.getsize(filename) == entry.get('size')) )
+    for attempt in range(fetch_retries + 1):
+        headers = {}
+        if have_file:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        # resume a partial transfer, if it's of the same version
+        partial = read_partial(partfile)
+        offset = os.path.getsize(partfile) if partial else 0
+        if ( (offset > 0) and (partial.get('etag') or partial.get('last_modified')) ):
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = partial.get('etag') or partial['last_modified']
+        else:
+            offset = 0
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=fetch_timeout) as response:
+                if (response.status == 206):
+                    total = int(response.headers['Content-Range'].rsplit("/", 1)[-1])
+                    mode = 'ab'
+                    msg_to_usr("fetch", f"Resuming {filename} at byte {offset}")
+                else:
+                    length = response.headers.get('Content-Length')
+                    total = int(length) if length is not None else None
+                    mode = 'wb'
+                    offset = 0
+                version = {'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')}
+                if (mode == 'wb'):
+                    with open(partfile + ".json", 'w') as fh:
+                        json.dump(version, fh)
+                else:
+                    version = partial
+                digest = digest_sha256(response.headers)
+                with open(partfile, mode) as fh:
+                    shutil.copyfileobj(response, fh, 1 << 20)
+        except urllib.error.HTTPError as err:
+            if (err.code == 304):
+                msg_to_usr("fetch", f"Unchanged {filename}")
+                entry['status'] = "unchanged"
+                return entry
+            if ( (err.code == 416) and (offset > 0) ):
+                # (the partial file doesn't fit the current version)
+                remove_partial(partfile)
+                continue
+            msg_to_usr("fetch", f"***Error HTTP {err.code} for {url}")
+            entry['status'] = f"error: HTTP {err.code}"
+            return entry
+        except (urllib.error.URLError, OSError, http.client.HTTPException) as err:
+            # (a cut-off transfer, e.g., an IncompleteRead of a chunked
+            #  one, is resumed by the next attempt)
+            msg_to_usr("fetch", f"Retrying {url} ({err})")
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        #=== Check the new file
+        size = os.path.getsize(partfile)
+        if ( (total is not None) and (size != total) ):
+            msg_to_usr("fetch", f"Retrying {url} (got {size} of {total} bytes)")
+            continue
+        sha256 = file_sha256(partfile)
+        if ( (digest is not None) and (digest != sha256) ):
+            msg_to_usr("fetch", f"***Error checksum of {filename} doesn't match"
+                       " the server's, fetching it again")
+            remove_partial(partfile)
+            continue
+        #=== Keep the old copy, and put the new one in place
+        if ( os.path.exists(filename) and keep_old_copies ):
+            olddir = os.path.join(dirname, "old")
+            os.makedirs(olddir, exist_ok=True)
+            fetched = entry.get('fetched', "")[:10] or "previous"
+            os.replace(filename, os.path.join(olddir, fetched + "_"
+                                              + os.path.basename(filename)))
+        os.replace(partfile, filename)
+        remove_partial(partfile)
+        if archive_snapshots:
+            snapshot_archive.add_snapshot(filename)
+        entry.update(version)
+        entry.update({'size': size, 'sha256': sha256,
+                      'fetched': dt.datetime.now().isoformat(timespec='seconds'),
+                      'status': "updated" if (entry.get('sha256') != sha256) else "same"})
+        msg_to_usr("fetch", f"Fetched {filename} ({size} bytes)")
+        return entry
+    entry['status'] = "error: gave up"
+    msg_to_usr("fetch", f"***Error gave up on {url} after {fetch_retries + 1} attempts")
+    return entry
+
+###########################################################
+# Fetching all files                                      #
+###########################################################
+def fetch_all(sources, server=None):
+    # Fetch all [dir, url] sources at the same time (optionally from
+    # another server), update the manifest, and return it
+    manifest = read_manifest()
+    jobs = {}
+    with cf.ThreadPoolExecutor(max_workers=fetch_max_workers) as pool:
+        for dirname, url in sources:
+            if server is not None:
+                url = server.rstrip("/") + "/" + url[len(fetch_default_server):]
+            jobs[pool.submit(fetch_one, dirname, url, manifest.get(url, {}))] = url
+        for fut in cf.as_completed(jobs):
+            manifest[jobs[fut]] = fut.result()
+    write_manifest(manifest)
+    return manifest
+
+#############
+# Main Code #
+#############
+def main():
+    # (run from the rawdata directory)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    server = sys.argv[1] if (len(sys.argv) > 1) else None
+    manifest = fetch_all(fetch_sources, server)
+    errors = [url for url, e in manifest.items()
+              if e.get('status', "").startswith("error")]
+    if errors:
+        print("***Error fetching (see " + fetch_manifest_file + "):", errors)
+        exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import os
+import sys
+import json
+import gzip
+import hashlib
+import datetime as dt
+
+###########################################################
+# Archive of the daily vintages of the raw data files     #
+#                                                         #
+#   Each vintage of a file is kept as a delta against the #
+#   one before it, which is small for these files:        #
+#                                                         #
+#     NYT: the same lines, plus one day of new lines      #
+#     JHU: each line plus one new column (",<count>"),    #
+#          and a few revised lines                        #
+#                                                         #
+#   A delta is a list of runs over the lines (with their  #
+#   line endings) of the new vintage, compared with the   #
+#   lines at the same place in the one before:            #
+#                                                         #
+#     ["=", n]:        n lines are the same               #
+#     ["+", [s, ...]]: each line is the old one plus s    #
+#     ["L", [l, ...]]: new lines (as they are)            #
+#                                                         #
+#   Every snapshot_keyframe_every-th vintage (and any     #
+#   delta that wouldn't be smaller) is kept in full, so   #
+#   any date is rebuilt from at most that many deltas.    #
+#                                                         #
+#   The archive of <dir>/<file> is archive_dir/<dir>/     #
+#   <file>/ with index.json and one gzipped file per      #
+#   vintage, <date>.<sha256>.full.jsonl.gz (one json      #
+#   string per line) or <date>.<sha256>.delta.jsonl.gz    #
+#   (one json run per line, of at most snapshot_max_run   #
+#   items), where sha256 is the start of the vintage's    #
+#   checksum.  (the first archives' <date>.full.json.gz   #
+#   and <date>.delta.json.gz, one json list, are read,    #
+#   too)  Vintages are read, compared and written a line  #
+#   (or run) at a time, so a file is never all in memory. #
+#                                                         #
+#   e.g.,                                                 #
+#                                                         #
+#     python snapshot_archive.py add jhu/<file>.csv       #
+#     python snapshot_archive.py list jhu/<file>.csv      #
+#     python snapshot_archive.py restore jhu/<file>.csv \ #
+#         2021-03-01 /tmp/<file>.csv                      #
+#                                                         #
+#   (restore gives the latest vintage on or before the    #
+#    date)                                                #
+###########################################################
+
+##########################
+# Parameters and Options #
+##########################
+#=== Keep a full copy of every n-th vintage
+snapshot_keyframe_every = 30
+#=== Most lines (or suffixes) in one run of a delta
+snapshot_max_run = 10000
+
+#############
+# Filenames #
+#############
+archive_dir = "archive/"
+
+def msg_to_usr(section, msg):
+    print(section + "\t" + msg, flush=True)
+
+def archive_path(filename):
+    return os.path.join(archive_dir, os.path.normpath(filename))
+
+def read_index(filename):
+    # {file, vintages: [{date, kind, file, size, sha256}, ...]} (by date)
+    indexfile = os.path.join(archive_path(filename), "index.json")
+    if not os.path.exists(indexfile):
+        return {'file': filename, 'vintages': []}
+    with open(indexfile) as fh:
+        return json.load(fh)
+
+def write_index(filename, index):
+    indexfile = os.path.join(archive_path(filename), "index.json")
+    with open(indexfile + ".tmp", 'w') as fh:
+        json.dump(index, fh, indent=1)
+    os.replace(indexfile + ".tmp", indexfile)
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def read_lines(filename):
+    # the lines of a file, with their line endings, one at a time
+    with open(filename, 'rb') as fh:
+        for line in fh:
+            yield line.decode('utf-8', errors='surrogateescape')
+
+def line_bytes(line):
+    return line.encode('utf-8', errors='surrogateescape')
+
+def read_stored(filename):
+    # the lines (of a full vintage) or runs (of a delta) of a stored
+    # vintage, one at a time
+    if filename.endswith(".jsonl.gz"):
+        with gzip.open(filename, 'rt', encoding='utf-8') as fh:
+            for line in fh:
+                yield json.loads(line)
+    else:
+        # (one json list)
+        with gzip.open(filename, 'rt', encoding='utf-8') as fh:
+            yield from json.load(fh)
+
+def write_stored(filename, items, max_size=None):
+    # Write the lines or runs of a vintage to filename, one json per
+    # line (through a temporary file, so it's never half-written).  With
+    # max_size, give up once the runs add up to that size (see
+    # delta_size), and return False.
+    size = 0
+    complete = True
+    with gzip.open(filename + ".tmp", 'wt', encoding='utf-8', compresslevel=6) as fh:
+        for item in items:
+            if (max_size is not None):
+                size += delta_size([item])
+                if (size >= max_size):
+                    complete = False
+                    break
+            fh.write(json.dumps(item, separators=(",", ":")) + "\n")
+    if not complete:
+        os.remove(filename + ".tmp")
+        return False
+    os.replace(filename + ".tmp", filename)
+    return True
+
+###########################################################
+# Deltas                                                  #
+###########################################################
+def make_delta(old, new):
+    # The runs (see the top of this file) that make the lines new from
+    # the lines old, where both are read a line at a time, and each
+    # run is given as soon as it's done
+    old = iter(old)
+    run = None
+    for line in new:
+        prev = next(old, None)
+        op, item = "L", line
+        if (prev is not None):
+            # (the line ending of the old line moves to the end)
+            body = prev.rstrip("\r\n")
+            if (line == prev):
+                op = "="
+            elif ( line.startswith(body) and (line.endswith(prev[len(body):])) ):
+                op, item = "+", line[len(body):]
+        if ( run and (run[0] == op) and (op == "=") ):
+            run[1] += 1
+        elif ( run and (run[0] == op) and (len(run[1]) < snapshot_max_run) ):
+            run[1].append(item)
+        else:
+            if run:
+                yield run
+            run = [op, 1] if (op == "=") else [op, [item]]
+    if run:
+        yield run
+    # (the rest of old is read, too, so that it's checked, see
+    #  vintage_lines)
+    for prev in old:
+        pass
+
+def apply_delta(old, delta):
+    # The lines made from the lines old by the runs of delta, where
+    # both are read (and the lines given) one at a time
+    old = iter(old)
+    for op, item in delta:
+        if (op == "="):
+            for i in range(item):
+                yield next(old)
+        elif (op == "+"):
+            for suffix in item:
+                yield next(old).rstrip("\r\n") + suffix
+        else:
+            for line in item:
+                next(old, None)
+                yield line
+
+def delta_size(delta):
+    return sum((1 if (op == "=") else sum(len(s) for s in item)) for op, item in delta)
+
+###########################################################
+# Adding and restoring vintages                           #
+###########################################################
+def vintage_lines(filename, vintages):
+    # The lines of the last of vintages (index entries, by date), one
+    # at a time, rebuilt from the last full vintage and the deltas after
+    # it, and checked against its checksum once they've all been read
+    first = max(i for i, v in enumerate(vintages) if (v['kind'] == "full"))
+    lines = read_stored(os.path.join(archive_path(filename), vintages[first]['file']))
+    for v in vintages[first+1:]:
+        lines = apply_delta(lines, read_stored(os.path.join(archive_path(filename),
+                                                            v['file'])))
+    h = hashlib.sha256()
+    for line in lines:
+        h.update(line_bytes(line))
+        yield line
+    if (h.hexdigest() != vintages[-1]['sha256']):
+        print("***Error restored", filename, "for", vintages[-1]['date'],
+              "doesn't match its checksum")
+        exit(0)
+
+def add_snapshot(filename, date=None):
+    # Add the current contents of filename as the vintage of date
+    # (default today), replacing the last vintage if it has the same
+    # date, and return its index entry
+    date = date or dt.date.today().isoformat()
+    size = os.path.getsize(filename)
+    sha256 = file_sha256(filename)
+    index = read_index(filename)
+    vintages = index['vintages']
+    if ( vintages and (vintages[-1]['date'] > date) ):
+        print("***Error can't add a vintage of", filename, "for", date,
+              "before the last one", vintages[-1]['date'])
+        exit(0)
+    # (a vintage of the same date is replaced, but its file is only
+    #  removed once the index no longer has it)
+    replaced = vintages.pop() if ( vintages and (vintages[-1]['date'] == date) ) else None
+    if ( vintages and (vintages[-1]['sha256'] == sha256) ):
+        write_index(filename, index)
+        remove_replaced(filename, replaced, vintages[-1])
+        msg_to_usr("archive", f"{filename} is the same as on {vintages[-1]['date']}")
+        return vintages[-1]
+    os.makedirs(archive_path(filename), exist_ok=True)
+    sincefull = 0
+    for v in reversed(vintages):
+        if (v['kind'] == "full"):
+            break
+        sincefull += 1
+    # (named with the checksum, so a new vintage of the same date
+    #  doesn't overwrite the file of the one the index still has)
+    stem = date + "." + sha256[:12]
+    entry = {'date': date, 'size': size, 'sha256': sha256}
+    written = False
+    if ( vintages and (sincefull + 1 < snapshot_keyframe_every) ):
+        entry.update({'kind': "delta", 'file': stem + ".delta.jsonl.gz"})
+        written = write_stored(os.path.join(archive_path(filename), entry['file']),
+                               make_delta(vintage_lines(filename, vintages),
+                                          read_lines(filename)),
+                               max_size=size)
+    if not written:
+        entry.update({'kind': "full", 'file': stem + ".full.jsonl.gz"})
+        write_stored(os.path.join(archive_path(filename), entry['file']),
+                     read_lines(filename))
+    vintages.append(entry)
+    write_index(filename, index)
+    remove_replaced(filename, replaced, entry)
+    stored = os.path.getsize(os.path.join(archive_path(filename), entry['file']))
+    msg_to_usr("archive", f"Added {filename} for {date} as {entry['kind']}"
+               f" ({stored} of {size} bytes)")
+    return entry
+
+def remove_replaced(filename, replaced, entry):
+    # remove the file of a replaced vintage (unless entry, which the
+    # index has now, is in the same file)
+    if ( (replaced is not None) and (replaced['file'] != entry['file']) ):
+        os.remove(os.path.join(archive_path(filename), replaced['file']))
+
+def restore_lines(filename, date):
+    # The lines of filename in its latest vintage on or before date
+    # (see vintage_lines)
+    vintages = [v for v in read_index(filename)['vintages'] if (v['date'] <= date)]
+    if not vintages:
+        print("***Error no vintage of", filename, "on or before", date)
+        exit(0)
+    return vintage_lines(filename, vintages)
+
+def restore_bytes(filename, date):
+    return b"".join(line_bytes(line) for line in restore_lines(filename, date))
+
+def restore_snapshot(filename, date, outfile):
+    with open(outfile + ".tmp", 'wb') as fh:
+        for line in restore_lines(filename, date):
+            fh.write(line_bytes(line))
+    os.replace(outfile + ".tmp", outfile)
+    msg_to_usr("archive", f"Restored {filename} for {date} to {outfile}")
+
+#############
+# Main Code #
+#############
+def main():
+    if ( (len(sys.argv) >= 3) and (sys.argv[1] == "add") ):
+        add_snapshot(sys.argv[2], sys.argv[3] if (len(sys.argv) > 3) else None)
+    elif ( (len(sys.argv) == 3) and (sys.argv[1] == "list") ):
+        for v in read_index(sys.argv[2])['vintages']:
+            print(v['date'], v['kind'], v['size'], v['sha256'][:12])
+    elif ( (len(sys.argv) == 5) and (sys.argv[1] == "restore") ):
+        restore_snapshot(sys.argv[2], sys.argv[3], sys.argv[4])
+    else:
+        print("usage: snapshot_archive.py add <file> [date] | list <file>"
+              " | restore <file> <date> <outfile>")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the pipeline modules are scripts in the directory above (and the
+# fetcher in rawdata/), not a package
+covid19_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, covid19_dir)
+sys.path.insert(0, os.path.join(covid19_dir, "rawdata"))
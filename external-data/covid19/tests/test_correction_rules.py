@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import curate_covid19 as cc
+
+def nyt_raw(rows):
+    # raw (long) NYT rows [date, county, state, fips] (fips nan if none),
+    # with the dtypes of read_nyt_raw
+    df = pd.DataFrame(rows, columns=['date', 'county', 'state', 'fips'])
+    df['date'] = df['date'].astype('category')
+    df['county'] = df['county'].astype('category')
+    df['state'] = df['state'].astype('category')
+    df['fips'] = df['fips'].astype('float64')
+    df['cases'] = np.arange(len(df), dtype='float64')
+    return df
+
+def jhu_raw(rows):
+    # raw (wide) JHU rows [fips, county, state], with one date column
+    df = pd.DataFrame(rows, columns=['fips', 'county', 'state'])
+    df['fips'] = df['fips'].astype('float64')
+    df['1/22/20'] = np.arange(len(df))
+    return df
+
+def apply(df, rules, dataname):
+    out = cc.apply_correction_rules(df, cc.compile_correction_rules(rules, dataname),
+                                    "test")
+    return out.reset_index(drop=True)
+
+def as_tuples(df):
+    return [(None if np.isnan(f) else int(f), c, s)
+            for f, c, s in zip(df['fips'], df['county'], df['state'])]
+
+def test_compile_keeps_rules_in_order_for_their_data():
+    compiled = cc.compile_correction_rules(cc.jhu_correction_rules, "jhu_deaths")
+    expected = [r for r in cc.jhu_correction_rules
+                if ( ("jhu_deaths" in r['data'])
+                     and (('option' not in r) or getattr(cc, r['option'])) )]
+    assert compiled['rules'] == expected
+    # every kept rule is in exactly one table, under its own number
+    numbers = sorted(n for t in compiled['tables'].values() for n in t['rule'])
+    assert numbers == list(range(len(expected)))
+    for keycols, table in compiled['tables'].items():
+        for _, entry in table.iterrows():
+            assert tuple(sorted(expected[entry['rule']]['match'])) == keycols
+
+def test_compile_option_turns_rule_off(monkeypatch):
+    monkeypatch.setattr(cc, "delete_jhu_cruise_entries", False)
+    msgs = [r['msg'] for r in
+            cc.compile_correction_rules(cc.jhu_correction_rules, "jhu_cases")['rules']]
+    assert "Deleting Grand Princess cruise ship entries" not in msgs
+    assert "Deleting Michigan prison entry (MDOC)" in msgs
+
+def test_compile_rule_without_match_is_an_error():
+    with pytest.raises(SystemExit):
+        cc.compile_correction_rules([{'data': ["nyt"], 'match': {},
+                                      'drop': True, 'msg': "bad"}], "nyt")
+
+def test_nyt_rules():
+    df = nyt_raw([["2020-04-01", "Kansas City", "Missouri", np.nan],
+                  ["2020-04-01", "Joplin", "Missouri", np.nan],
+                  ["2020-04-01", "New York City", "New York", np.nan],
+                  ["2020-04-01", "Unknown", "Guam", np.nan],
+                  ["2020-04-01", "Bristol Bay plus Lake and Peninsula", "Alaska", 2997],
+                  ["2020-04-01", "Yakutat plus Hoonah-Angoon", "Alaska", 2998],
+                  ["2020-04-01", "Valdez-Cordova Census Area", "Alaska", 2261],
+                  ["2020-04-01", "Unknown", "Puerto Rico", np.nan],
+                  ["2020-04-01", "Unknown", "Virgin Islands", np.nan],
+                  ["2020-04-01", "Unknown", "Kansas", np.nan],
+                  ["2020-04-01", "Cook", "Illinois", 17031]])
+    out = apply(df, cc.nyt_correction_rules, "nyt")
+    assert as_tuples(out) == [(29998, "Kansas City", "Missouri"),
+                              (29999, "Joplin", "Missouri"),
+                              (36901, "New York City", "New York"),
+                              (66010, "Guam", "Guam"),
+                              (2901, "Bristol Bay plus Lake and Peninsula", "Alaska"),
+                              (2902, "Yakutat plus Hoonah-Angoon", "Alaska"),
+                              (2903, "Valdez-Cordova Census Area", "Alaska"),
+                              (72000, "All", "Puerto Rico"),
+                              (78000, "All", "Virgin Islands"),
+                              (17031, "Cook", "Illinois")]
+    # the other columns go along with their rows
+    assert out['cases'].to_list() == [0, 1, 2, 3, 4, 5, 6, 7, 8, 10]
+
+@pytest.mark.parametrize("state,fips,last_day", [
+    ["Northern Mariana Islands", 69110, "2020-07-13"],
+    ["Rhode Island", 44000, "2020-05-02"],
+    ["Utah", 49000, "2020-04-15"],
+    ["Vermont", 50000, "2020-04-07"],
+    ["Virginia", 51000, "2020-04-07"]])
+def test_nyt_unknown_date_windows(state, fips, last_day):
+    # the early "Unknown" entries are kept (up to and including the
+    # last day of the window), and the later ones are dropped
+    after = (pd.Timestamp(last_day) + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+    df = nyt_raw([["2020-01-01", "Unknown", state, np.nan],
+                  [last_day, "Unknown", state, np.nan],
+                  [after, "Unknown", state, np.nan],
+                  ["2021-03-01", "Unknown", state, np.nan]])
+    out = apply(df, cc.nyt_correction_rules, "nyt")
+    assert out['date'].astype(str).to_list() == ["2020-01-01", last_day]
+    assert out['fips'].to_list() == [fips, fips]
+
+def test_nyt_guam_before_unknown_drop():
+    # Guam's county is "Unknown", so its rule must come first
+    rules = cc.nyt_correction_rules
+    msgs = [r['msg'] for r in rules]
+    assert msgs.index("Asigning FIPS to Guam") \
+        < msgs.index("Dropping all other \"Unknown\" cases and deaths")
+    out = apply(nyt_raw([["2020-04-01", "Unknown", "Guam", np.nan]]), rules, "nyt")
+    assert as_tuples(out) == [(66010, "Guam", "Guam")]
+
+def test_nyt_deaths_keep_only_pr_all():
+    df = jhu_raw([[72000, "All", "Puerto Rico"],
+                  [72001, "Adjuntas", "Puerto Rico"],
+                  [72003, "Aguada", "Puerto Rico"],
+                  [17031, "Cook", "Illinois"]])
+    out = apply(df, cc.nyt_correction_rules, "nyt_deaths")
+    assert as_tuples(out) == [(72000, "All", "Puerto Rico"),
+                              (17031, "Cook", "Illinois")]
+
+def test_jhu_rules():
+    df = jhu_raw([[80017, "Out of IL", "Illinois"],
+                  [72888, "Out of PR", "Puerto Rico"],
+                  [60, np.nan, "American Samoa"],
+                  [66, np.nan, "Guam"],
+                  [np.nan, np.nan, "Northern Mariana Islands"],
+                  [78, np.nan, "Virgin Islands"],
+                  [np.nan, np.nan, "Grand Princess"],
+                  [np.nan, np.nan, "Diamond Princess"],
+                  [np.nan, "Michigan Department of Corrections (MDOC)", "Michigan"],
+                  [np.nan, "Federal Correctional Institution (FCI)", "Michigan"],
+                  [2164, "Bristol Bay plus Lake and Peninsula", "Alaska"],
+                  [2060, "Bristol Bay", "Alaska"],
+                  [np.nan, "Dukes and Nantucket", "Massachusetts"],
+                  [25007, "Dukes", "Massachusetts"],
+                  [25019, "Nantucket", "Massachusetts"],
+                  [49005, "Cache", "Utah"],
+                  [np.nan, "Bear River", "Utah"],
+                  [np.nan, "Kansas City", "Missouri"],
+                  [90025, "Unassigned", "Massachusetts"],
+                  [90006, "Unassigned", "California"],
+                  [6037, "Los Angeles", "California"]])
+    out = apply(df, cc.jhu_correction_rules, "jhu_cases")
+    assert as_tuples(out) == [(60000, "All", "American Samoa"),
+                              (66010, "Guam", "Guam"),
+                              (69000, "All", "Northern Mariana Islands"),
+                              (78000, "All", "Virgin Islands"),
+                              (2901, "Bristol Bay plus Lake and Peninsula", "Alaska"),
+                              (25901, "Dukes and Nantucket", "Massachusetts"),
+                              (49901, "Bear River", "Utah"),
+                              (29998, "Kansas City", "Missouri"),
+                              (25000, "All", "Massachusetts"),
+                              (6037, "Los Angeles", "California")]
+
+def test_jhu_prisons_get_fake_fips_when_kept(monkeypatch):
+    monkeypatch.setattr(cc, "delete_jhu_prison_entries", False)
+    df = jhu_raw([[np.nan, "Michigan Department of Corrections (MDOC)", "Michigan"],
+                  [np.nan, "Federal Correctional Institution (FCI)", "Michigan"]])
+    out = apply(df, cc.jhu_correction_rules, "jhu_cases")
+    assert out['fips'].to_list() == [26901, 26902]
+
+def test_jhu_pr_unassigned_before_72999_drop():
+    # PR deaths are all "Unassigned" (72999), and are kept as "All",
+    # while PR's unassigned cases are dropped
+    df = jhu_raw([[72999, "Unassigned", "Puerto Rico"],
+                  [72001, "Adjuntas", "Puerto Rico"]])
+    deaths = apply(df, cc.jhu_correction_rules, "jhu_deaths")
+    assert as_tuples(deaths) == [(72000, "All", "Puerto Rico")]
+    cases = apply(df, cc.jhu_correction_rules, "jhu_cases")
+    assert as_tuples(cases) == [(72001, "Adjuntas", "Puerto Rico")]
+
+@pytest.mark.parametrize("fips,state,allfips", [[90017, "Illinois", 17000],
+                                                [90018, "Indiana", 18000],
+                                                [90047, "Tennessee", 47000]])
+def test_jhu_il_in_tn_unassigned_before_90xxx_drop(fips, state, allfips):
+    df = jhu_raw([[fips, "Unassigned", state]])
+    deaths = apply(df, cc.jhu_correction_rules, "jhu_deaths")
+    assert as_tuples(deaths) == [(allfips, "All", state)]
+    assert len(apply(df, cc.jhu_correction_rules, "jhu_cases")) == 0
+
+def test_first_matching_rule_wins():
+    rules = [{'data': ["jhu_cases"], 'match': {'state': "Utah"},
+              'change': {'fips': 49998}, 'msg': "first"},
+             {'data': ["jhu_cases"], 'match': {'fips': 49001},
+              'drop': True, 'msg': "second"},
+             {'data': ["jhu_cases"], 'match': {'fips_state': 49},
+              'change': {'county': "Other"}, 'msg': "third"}]
+    df = jhu_raw([[49001, "Beaver", "Utah"], [49001, "Beaver", "Utah2"],
+                  [49003, "Box Elder", "Utah2"]])
+    out = apply(df, rules, "jhu_cases")
+    assert as_tuples(out) == [(49998, "Beaver", "Utah"), (49003, "Other", "Utah2")]
+
+def test_counts_are_added_up():
+    compiled = cc.compile_correction_rules(cc.nyt_correction_rules, "nyt")
+    counts = np.zeros(len(compiled['rules']) + 1, dtype=int)
+    df = nyt_raw([["2020-04-01", "Unknown", "Kansas", np.nan],
+                  ["2020-04-01", "Unknown", "Iowa", np.nan],
+                  ["2020-04-01", "Cook", "Illinois", 17031]])
+    for _ in range(2):
+        cc.apply_correction_rules(df, compiled, "test", counts=counts)
+    msgs = [r['msg'] for r in compiled['rules']]
+    assert counts[msgs.index("Dropping all other \"Unknown\" cases and deaths")] == 4
+    assert counts[-1] == 2
+    assert counts.sum() == 6
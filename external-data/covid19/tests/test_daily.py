@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import curate_covid19 as cc
+
+negative_options = ["delete", "delete_and_interpolate", "delete_and_ffill",
+                    "redistribute"]
+
+def wide(fips, cum, start="2020-03-01"):
+    # cleaned (wide) dataframe [fips, county, state, <day1 data>, ...]
+    cols = pd.date_range(start, periods=cum.shape[1]).strftime("%m/%d/%y")
+    df = pd.DataFrame(cum, columns=cols)
+    df.insert(0, 'fips', fips)
+    df.insert(1, 'county', "county")
+    df.insert(2, 'state', "state")
+    return df
+
+def random_cum(seed, nfips=40, ndates=60):
+    # cumulative series with some negative daily counts and nan runs
+    rng = np.random.default_rng(seed)
+    fips = np.sort(rng.choice(np.arange(1001, 56999), nfips, replace=False))
+    inc = rng.poisson(5, (nfips, ndates)).astype(float)
+    inc[rng.random(inc.shape) < 0.05] = -3
+    cum = np.cumsum(inc, axis=1)
+    cum[rng.random(cum.shape) < 0.02] = np.nan
+    return [rng, fips, cum]
+
+def assert_same_daily(df, expected):
+    assert df['fips'].to_list() == expected['fips'].to_list()
+    assert (df['date'].to_numpy() == expected['date'].to_numpy()).all()
+    for col in ['cum', 'daily', '14davg']:
+        np.testing.assert_allclose(df[col].to_numpy(float),
+                                   expected[col].to_numpy(float),
+                                   rtol=1e-12, atol=1e-9, equal_nan=True)
+
+@pytest.mark.parametrize("option", negative_options)
+def test_incremental_with_revisions_and_a_new_day(monkeypatch, option):
+    monkeypatch.setattr(cc, "negative_daily_counts_option", option)
+    rng, fips, cum = random_cum(1)
+    prev_df = cc.get_daily_data(wide(fips, cum[:, :-1]), "test")
+    # a revised history for a few FIPS (some down, so there are new
+    # negatives), and one new day for all of them
+    revised = cum.copy()
+    for row in rng.choice(len(fips), 8, replace=False):
+        revised[row, rng.integers(1, cum.shape[1] - 1):] += rng.integers(-6, 7)
+    dfin = wide(fips, revised)
+    assert_same_daily(cc.get_daily_data(dfin, "test", prev_df),
+                      cc.get_daily_data(dfin, "test"))
+
+@pytest.mark.parametrize("option", negative_options)
+def test_incremental_with_one_new_day(monkeypatch, option):
+    monkeypatch.setattr(cc, "negative_daily_counts_option", option)
+    _, fips, cum = random_cum(2)
+    prev_df = cc.get_daily_data(wide(fips, cum[:, :-1]), "test")
+    dfin = wide(fips, cum)
+    assert_same_daily(cc.get_daily_data(dfin, "test", prev_df),
+                      cc.get_daily_data(dfin, "test"))
+
+@pytest.mark.parametrize("option", negative_options)
+def test_incremental_with_a_new_fips(monkeypatch, option):
+    monkeypatch.setattr(cc, "negative_daily_counts_option", option)
+    _, fips, cum = random_cum(3)
+    prev_df = cc.get_daily_data(wide(fips[1:], cum[1:, :-1]), "test")
+    dfin = wide(fips, cum)
+    assert_same_daily(cc.get_daily_data(dfin, "test", prev_df),
+                      cc.get_daily_data(dfin, "test"))
+
+@pytest.mark.parametrize("option", ["delete", "delete_and_interpolate",
+                                    "delete_and_ffill"])
+def test_incremental_without_changes_keeps_previous(monkeypatch, option):
+    monkeypatch.setattr(cc, "negative_daily_counts_option", option)
+    _, fips, cum = random_cum(4)
+    dfin = wide(fips, cum)
+    prev_df = cc.get_daily_data(dfin, "test")
+    assert cc.get_daily_data(dfin, "test", prev_df) is prev_df
+
+def test_incremental_with_other_dates_recomputes_all():
+    _, fips, cum = random_cum(5)
+    prev_df = cc.get_daily_data(wide(fips, cum, start="2020-02-01"), "test")
+    dfin = wide(fips, cum)
+    assert_same_daily(cc.get_daily_data(dfin, "test", prev_df),
+                      cc.get_daily_data(dfin, "test"))
+
+def recomputed_entries(monkeypatch):
+    # record the (fips row, date) entries that get_daily_matrices
+    # computes (rather than takes from the previous output) in each call
+    calls = []
+    get_daily_matrices = cc.get_daily_matrices
+    def recording(cum, seed_daily=None, seeded=None):
+        calls.append(np.ones(cum.shape, dtype=bool) if seeded is None else ~seeded)
+        return get_daily_matrices(cum, seed_daily=seed_daily, seeded=seeded)
+    monkeypatch.setattr(cc, "get_daily_matrices", recording)
+    return calls
+
+@pytest.mark.parametrize("option", ["delete", "delete_and_interpolate",
+                                    "delete_and_ffill"])
+def test_revision_only_recomputes_its_window(monkeypatch, option):
+    monkeypatch.setattr(cc, "negative_daily_counts_option", option)
+    rng = np.random.default_rng(6)
+    fips = np.arange(1001, 1021)
+    cum = np.cumsum(rng.poisson(5, (len(fips), 50)).astype(float) + 1, axis=1)
+    prev_df = cc.get_daily_data(wide(fips, cum), "test")
+    row, first = 7, 30
+    revised = cum.copy()
+    revised[row, first:] += 4
+    calls = recomputed_entries(monkeypatch)
+    df = cc.get_daily_data(wide(fips, revised), "test", prev_df)
+    # one call for the revised series (from 14 days before the
+    # revision, to seed it), which only computes the revised dates,
+    # and none for the others (nothing new)
+    [computed] = [c for c in calls if c.any()]
+    assert computed.shape == (1, cum.shape[1] - (first - 14))
+    assert (np.nonzero(computed[0])[0] + first - 14).tolist() \
+        == list(range(first, cum.shape[1]))
+    # and only those rows of the output differ from the previous one
+    changed = np.zeros(len(df), dtype=bool)
+    for col in ['cum', 'daily', '14davg']:
+        a, b = df[col].to_numpy(float), prev_df[col].to_numpy(float)
+        changed |= ~np.isclose(a, b, rtol=0, atol=0, equal_nan=True)
+    window = ((df['fips'] == fips[row])
+              & (df['date'] >= pd.Timestamp("2020-03-01") + pd.Timedelta(days=first)))
+    assert (changed == window.to_numpy()).all()
+
+def test_revision_in_filled_gap_recomputes_the_gap(monkeypatch):
+    # a revision inside a run of interpolated days re-fills the whole
+    # run, from the last good day before it
+    monkeypatch.setattr(cc, "negative_daily_counts_option", "delete_and_interpolate")
+    fips = np.arange(1001, 1004)
+    cum = np.cumsum(np.full((3, 40), 3.0), axis=1)
+    cum[1, 20:24] = np.nan
+    prev_df = cc.get_daily_data(wide(fips, cum), "test")
+    revised = cum.copy()
+    revised[1, 22] = 61.0
+    calls = recomputed_entries(monkeypatch)
+    cc.get_daily_data(wide(fips, revised), "test", prev_df)
+    [computed] = [c for c in calls if c.any()]
+    j0 = 20 - 14
+    assert (np.nonzero(computed[0])[0] + j0).tolist() == list(range(20, 40))
+
+nan = np.nan
+
+def test_fill_gaps_linear():
+    daily = np.array([[nan, nan, 1.0, nan, nan, 4.0, 2.0, nan, nan],
+                      [5.0, nan, 7.0, 7.0, nan, nan, nan, nan, 3.0],
+                      [nan, nan, nan, nan, nan, nan, nan, nan, nan]])
+    filled = cc.fill_gaps(daily, "linear")
+    # (leading and trailing nan runs are kept)
+    np.testing.assert_array_equal(
+        filled, [[nan, nan, 1.0, 2.0, 3.0, 4.0, 2.0, nan, nan],
+                 [5.0, 6.0, 7.0, 7.0, 6.2, 5.4, 4.6, 3.8, 3.0],
+                 [nan, nan, nan, nan, nan, nan, nan, nan, nan]])
+
+def test_fill_gaps_ffill():
+    daily = np.array([[nan, 2.0, nan, nan, 5.0, nan],
+                      [1.0, nan, 3.0, nan, nan, nan]])
+    filled = cc.fill_gaps(daily, "ffill")
+    np.testing.assert_array_equal(filled, [[nan, 2.0, 2.0, 2.0, 5.0, nan],
+                                           [1.0, 1.0, 3.0, nan, nan, nan]])
+
+@pytest.mark.parametrize("method", ["linear", "ffill"])
+def test_fill_gaps_matches_pandas(method):
+    rng = np.random.default_rng(7)
+    daily = rng.poisson(4, (30, 80)).astype(float)
+    daily[rng.random(daily.shape) < 0.3] = nan
+    df = pd.DataFrame(daily.T)
+    if (method == "linear"):
+        expected = df.interpolate(method="linear", limit_area="inside")
+    else:
+        expected = df.ffill().where(df.bfill().notna())
+    np.testing.assert_allclose(cc.fill_gaps(daily, method), expected.to_numpy().T,
+                               rtol=1e-12, equal_nan=True)
+
+def test_fill_gaps_unknown_method():
+    with pytest.raises(SystemExit):
+        cc.fill_gaps(np.zeros((1, 3)), "cubic")
+
+def test_negative_on_the_first_day(monkeypatch):
+    # (the first day has no daily count, so a drop on the second day is
+    #  the first negative one, and it isn't filled from before)
+    cum = np.array([[10.0, 7.0, 9.0, 12.0, 12.0]])
+    for option, expected in [["delete", [nan, nan, 2.0, 3.0, 0.0]],
+                             ["delete_and_interpolate", [nan, nan, 2.0, 3.0, 0.0]],
+                             ["delete_and_ffill", [nan, nan, 2.0, 3.0, 0.0]],
+                             ["redistribute", [nan, 0.0, 2.0, 3.0, 0.0]]]:
+        monkeypatch.setattr(cc, "negative_daily_counts_option", option)
+        daily, _ = cc.get_daily_matrices(cum)
+        np.testing.assert_array_equal(daily, [expected], err_msg=option)
+
+def test_redistribute_negatives():
+    cum = np.array([[1.0, 5.0, 3.0, 4.0, 2.0, 6.0],
+                    [nan, 2.0, nan, 1.0, 3.0, nan],
+                    [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]])
+    lowered = cc.redistribute_negatives(cum)
+    np.testing.assert_array_equal(lowered, [[1.0, 2.0, 2.0, 2.0, 2.0, 6.0],
+                                            [nan, 1.0, nan, 1.0, 3.0, nan],
+                                            [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]])
+
+def test_redistribute_keeps_the_total(monkeypatch):
+    monkeypatch.setattr(cc, "negative_daily_counts_option", "redistribute")
+    rng = np.random.default_rng(8)
+    inc = rng.poisson(5, (20, 60)).astype(float)
+    inc[rng.random(inc.shape) < 0.1] = -7
+    cum = np.cumsum(inc, axis=1)
+    daily, _ = cc.get_daily_matrices(cum)
+    lowered = cc.redistribute_negatives(cum)
+    # no negative daily counts, and the last cumulative value is kept,
+    # so the daily counts add up to the same total
+    assert (daily[:, 1:] >= 0).all()
+    np.testing.assert_array_equal(lowered[:, -1], cum[:, -1])
+    np.testing.assert_allclose(lowered[:, 0] + daily[:, 1:].sum(axis=1), cum[:, -1])
+    assert (lowered <= cum).all()
@@ -0,0 +1,229 @@
+import base64
+import hashlib
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+import fetch_covid_data as fc
+
+###########################################################
+# Local stand-in for the data server                      #
+#                                                         #
+#   Serves served[path] = {'data': bytes, ...} with an    #
+#   ETag and a sha-256 Digest, answering If-None-Match    #
+#   (304) and Range/If-Range (206, or 416 past the end),  #
+#   and with these (optional) faults, each for the first  #
+#   n responses:                                          #
+#                                                         #
+#     'cut':        send half of the body, then close     #
+#     'bad_digest': send the Digest of other data         #
+#     'bad_total':  give a too large total size in the    #
+#                   Content-Range of a 206                #
+#                                                         #
+#   Each request's headers are put in requests.           #
+###########################################################
+served = {}
+requests = []
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        requests.append(dict(self.headers))
+        if self.path not in served:
+            self.send_error(404)
+            return
+        entry = served[self.path]
+        data = entry['data']
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        if (self.headers.get('If-None-Match') == etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = 0
+        total = len(data)
+        if ( self.headers.get('Range')
+             and (self.headers.get('If-Range') in [etag, None]) ):
+            start = int(self.headers['Range'].split("=")[1].split("-")[0])
+            if (start >= len(data)):
+                self.send_response(416)
+                self.send_header('Content-Length', "0")
+                self.end_headers()
+                return
+            if fault(entry, 'bad_total'):
+                total += 10
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(data)-1}/{total}")
+        else:
+            self.send_response(200)
+        digest = hashlib.sha256(b"other" if fault(entry, 'bad_digest') else data)
+        self.send_header('ETag', etag)
+        self.send_header('Digest', "sha-256=" + base64.b64encode(digest.digest()).decode())
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if fault(entry, 'cut'):
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def fault(entry, name):
+    if (entry.get(name, 0) > 0):
+        entry[name] -= 1
+        return True
+    return False
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # the stand-in server (its url), with the fetcher working in tmp_path
+    served.clear()
+    requests.clear()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fc, "archive_snapshots", False)
+    monkeypatch.setattr(fc.time, "sleep", lambda seconds: None)
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+def serve(path, data, **faults):
+    served["/" + path] = dict(faults, data=data)
+
+def fetch(server, path):
+    # fetch one file from the stand-in, and return its manifest entry
+    # (under the stand-in's url)
+    manifest = fc.fetch_all([["data", fc.fetch_default_server + path]], server)
+    return manifest[server + path]
+
+def payload(n=300000):
+    return bytes((i * 7 + i // 1000) % 251 for i in range(n))
+
+def read(filename):
+    with open(filename, 'rb') as fh:
+        return fh.read()
+
+def test_fetch_then_unchanged(server):
+    data = payload()
+    serve("a/file.csv", data)
+    entry = fetch(server, "a/file.csv")
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+    assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+    assert entry['size'] == len(data)
+    # the second fetch is a conditional request, which gets a 304
+    entry = fetch(server, "a/file.csv")
+    assert entry['status'] == "unchanged"
+    assert requests[-1]['If-None-Match'] == entry['etag']
+    assert read("data/file.csv") == data
+    with open(fc.fetch_manifest_file) as fh:
+        assert json.load(fh)[server + "a/file.csv"]['status'] == "unchanged"
+
+def test_changed_file_is_fetched_again(server):
+    serve("a/file.csv", payload())
+    fetch(server, "a/file.csv")
+    data = payload(310000)
+    serve("a/file.csv", data)
+    entry = fetch(server, "a/file.csv")
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+
+def test_file_changed_on_disk_is_fetched_again(server):
+    # (a local copy that isn't the one in the manifest is fetched again,
+    #  not kept by a 304)
+    data = payload()
+    serve("a/file.csv", data)
+    fetch(server, "a/file.csv")
+    with open("data/file.csv", 'wb') as fh:
+        fh.write(b"edited")
+    entry = fetch(server, "a/file.csv")
+    assert 'If-None-Match' not in requests[-1]
+    assert entry['status'] == "same"
+    assert read("data/file.csv") == data
+
+def partial_download(data, etag):
+    # a transfer that was cut off after half of the data
+    os.makedirs("data", exist_ok=True)
+    with open("data/file.csv.part", 'wb') as fh:
+        fh.write(data[:len(data) // 2])
+    with open("data/file.csv.part.json", 'w') as fh:
+        json.dump({'etag': etag, 'last_modified': None}, fh)
+
+def test_resume_partial_download(server):
+    data = payload()
+    serve("a/file.csv", data)
+    etag = '"' + hashlib.md5(data).hexdigest() + '"'
+    partial_download(data, etag)
+    entry = fetch(server, "a/file.csv")
+    assert requests[0]['Range'] == f"bytes={len(data) // 2}-"
+    assert requests[0]['If-Range'] == etag
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+    assert not os.path.exists("data/file.csv.part")
+    assert not os.path.exists("data/file.csv.part.json")
+
+def test_partial_of_other_version_is_fetched_in_full(server):
+    # (If-Range doesn't match, so the server sends all of the new file)
+    data = payload()
+    serve("a/file.csv", data)
+    partial_download(payload(320000), '"old"')
+    entry = fetch(server, "a/file.csv")
+    assert requests[0]['If-Range'] == '"old"'
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+
+def test_size_mismatch_is_fetched_again(server):
+    data = payload()
+    serve("a/file.csv", data, bad_total=1)
+    etag = '"' + hashlib.md5(data).hexdigest() + '"'
+    partial_download(data, etag)
+    entry = fetch(server, "a/file.csv")
+    # the resumed file is too short for the total the server gave, so
+    # the next attempt resumes past its end (416), and then starts over
+    assert [r.get('Range') for r in requests] \
+        == [f"bytes={len(data) // 2}-", f"bytes={len(data)}-", None]
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+
+def test_digest_mismatch_is_fetched_again(server):
+    data = payload()
+    serve("a/file.csv", data, bad_digest=1)
+    entry = fetch(server, "a/file.csv")
+    assert len(requests) == 2
+    assert 'Range' not in requests[1]
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+
+def test_digest_mismatch_keeps_old_file(server):
+    old = payload()
+    serve("a/file.csv", old)
+    fetch(server, "a/file.csv")
+    serve("a/file.csv", payload(310000), bad_digest=fc.fetch_retries + 1)
+    entry = fetch(server, "a/file.csv")
+    assert entry['status'] == "error: gave up"
+    assert entry['sha256'] == hashlib.sha256(old).hexdigest()
+    assert read("data/file.csv") == old
+
+def test_incomplete_read_is_resumed(server):
+    data = payload()
+    serve("a/file.csv", data, cut=1)
+    entry = fetch(server, "a/file.csv")
+    assert len(requests) == 2
+    partsize = int(requests[1]['Range'].split("=")[1].rstrip("-"))
+    assert 0 < partsize < len(data)
+    assert requests[1]['If-Range'] == '"' + hashlib.md5(data).hexdigest() + '"'
+    assert entry['status'] == "updated"
+    assert read("data/file.csv") == data
+
+def test_http_error(server):
+    entry = fetch(server, "a/missing.csv")
+    assert entry['status'] == "error: HTTP 404"
+    assert not os.path.exists("data/missing.csv")
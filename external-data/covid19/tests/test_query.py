@@ -0,0 +1,67 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import covid19_store
+import curate_covid19 as cc
+import query_covid19 as q
+
+counties_file = os.path.join(os.path.dirname(os.path.abspath(cc.__file__)),
+                             cc.outfilename_statecounty_fips)
+
+def write_version(store_dir, value, ndates=20):
+    # a new version of a small store, with all values set to value
+    fips = np.array([1001, 1003, 1005])
+    values = np.full((len(fips), ndates, len(cc.cube_sources), len(cc.cube_metrics),
+                      len(cc.cube_fields)), float(value))
+    cube = {'fips': fips, 'dates': pd.date_range("2020-03-01", periods=ndates),
+            'values': values, 'present': np.ones(values.shape[:-1], dtype=bool)}
+    covid19_store.write_store(cube, store_dir, cc.cube_sources, cc.cube_metrics,
+                              cc.cube_fields)
+
+def test_refresh_reopens_new_version(tmp_path):
+    store_dir = str(tmp_path / "cube") + "/"
+    write_version(store_dir, 1)
+    query = q.open_query(store_dir, counties_file)
+    assert q.query_open is query
+    store = query['store']
+    # (nothing new: the same store, in a copy of the query)
+    same = q.refresh_query(query)
+    assert (same is not query) and (same['store'] is store)
+    write_version(store_dir, 2)
+    new = q.refresh_query(query)
+    assert new['store']['version'] != store['version']
+    assert query['store'] is new['store']
+    df = q.query_df(query, [1001], fields=['cum'])
+    assert (df.filter(like="_cum").to_numpy() == 2.0).all()
+
+def test_refresh_from_many_threads(tmp_path):
+    # (each request sees one whole version of the store)
+    store_dir = str(tmp_path / "cube") + "/"
+    write_version(store_dir, 0)
+    q.open_query(store_dir, counties_file)
+    errors = []
+    done = threading.Event()
+    def reader():
+        while not done.is_set():
+            try:
+                query = q.refresh_query(q.query_open)
+                df = q.query_df(query, [1001, 1005])
+                values = df.drop(columns=['date', 'fips']).to_numpy()
+                if not (values == values[0, 0]).all():
+                    errors.append("mixed versions")
+            except Exception as err:
+                errors.append(repr(err))
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for value in range(1, 6):
+        write_version(store_dir, value)
+    done.set()
+    for t in threads:
+        t.join()
+    assert errors == []
+    df = q.query_df(q.query_open, [1003])
+    assert (df.drop(columns=['date', 'fips']).to_numpy() == 5.0).all()
@@ -0,0 +1,150 @@
+import gzip
+import hashlib
+import json
+import os
+
+import pytest
+
+import snapshot_archive as sa
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("jhu")
+    return "jhu/series.csv"
+
+def write(filename, data):
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+
+def jhu_vintage(ndays, revised=None):
+    # a JHU-like file, with one more column each day (and a revised row)
+    rows = [b"fips,county" + b"".join(b",d%d" % d for d in range(ndays)) + b"\r\n"]
+    for f in range(40):
+        counts = [f * d + (7 if ( (revised == f) and (d > 2) ) else 0)
+                  for d in range(ndays)]
+        rows.append(b"%d,C\xe9 %d" % (1000 + f, f)
+                    + b"".join(b",%d" % c for c in counts) + b"\r\n")
+    return b"".join(rows)
+
+def nyt_vintage(ndays):
+    # a NYT-like file, with one more day of lines each day (and no
+    # newline at the end)
+    lines = [b"date,fips,cases"] + [b"%d,%d,%d" % (d, 1000 + f, d * f)
+                                    for d in range(ndays) for f in range(30)]
+    return b"\n".join(lines)
+
+@pytest.mark.parametrize("make", [jhu_vintage, nyt_vintage])
+def test_every_vintage_is_restored(archive, monkeypatch, make):
+    monkeypatch.setattr(sa, "snapshot_keyframe_every", 4)
+    monkeypatch.setattr(sa, "snapshot_max_run", 7)
+    datas = {}
+    for day in range(1, 11):
+        date = f"2021-03-{day:02d}"
+        datas[date] = make(5 + day)
+        write(archive, datas[date])
+        sa.add_snapshot(archive, date)
+    kinds = [v['kind'] for v in sa.read_index(archive)['vintages']]
+    assert kinds == ["full", "delta", "delta", "delta"] * 2 + ["full", "delta"]
+    for date, data in datas.items():
+        assert sa.restore_bytes(archive, date) == data
+    # (the latest on or before a date)
+    assert sa.restore_bytes(archive, "2021-03-31") == datas["2021-03-10"]
+    sa.restore_snapshot(archive, "2021-03-04", "restored.csv")
+    with open("restored.csv", 'rb') as fh:
+        assert fh.read() == datas["2021-03-04"]
+
+def test_delta_of_revised_rows(archive):
+    write(archive, jhu_vintage(10))
+    sa.add_snapshot(archive, "2021-03-01")
+    data = jhu_vintage(11, revised=5)
+    write(archive, data)
+    entry = sa.add_snapshot(archive, "2021-03-02")
+    assert entry['kind'] == "delta"
+    runs = list(sa.read_stored(os.path.join(sa.archive_path(archive), entry['file'])))
+    assert [op for op, item in runs] == ["+", "L", "+"]
+    assert sa.restore_bytes(archive, "2021-03-02") == data
+
+def test_unrelated_file_is_kept_in_full(archive):
+    write(archive, nyt_vintage(10))
+    sa.add_snapshot(archive, "2021-03-01")
+    write(archive, jhu_vintage(10))
+    assert sa.add_snapshot(archive, "2021-03-02")['kind'] == "full"
+    assert not [f for f in os.listdir(sa.archive_path(archive)) if f.endswith(".tmp")]
+
+def test_same_day_replaces_vintage(archive):
+    write(archive, jhu_vintage(10))
+    sa.add_snapshot(archive, "2021-03-01")
+    write(archive, jhu_vintage(11))
+    first = sa.add_snapshot(archive, "2021-03-02")
+    data = jhu_vintage(11, revised=3)
+    write(archive, data)
+    second = sa.add_snapshot(archive, "2021-03-02")
+    vintages = sa.read_index(archive)['vintages']
+    assert [v['date'] for v in vintages] == ["2021-03-01", "2021-03-02"]
+    assert vintages[-1] == second
+    files = os.listdir(sa.archive_path(archive))
+    assert first['file'] not in files
+    assert sorted(files) == sorted(["index.json"] + [v['file'] for v in vintages])
+    assert sa.restore_bytes(archive, "2021-03-02") == data
+    # and back to the same as the day before
+    write(archive, jhu_vintage(10))
+    entry = sa.add_snapshot(archive, "2021-03-02")
+    assert entry == vintages[0]
+    assert [v['date'] for v in sa.read_index(archive)['vintages']] == ["2021-03-01"]
+    assert second['file'] not in os.listdir(sa.archive_path(archive))
+
+def test_same_day_vintage_kept_if_index_not_written(archive, monkeypatch):
+    # (a run that stops before the new index is written leaves the old
+    #  vintage of that date in place)
+    write(archive, jhu_vintage(10))
+    sa.add_snapshot(archive, "2021-03-01")
+    old = jhu_vintage(11)
+    write(archive, old)
+    sa.add_snapshot(archive, "2021-03-02")
+    write_index = sa.write_index
+    def failing(filename, index):
+        raise OSError("disk full")
+    monkeypatch.setattr(sa, "write_index", failing)
+    write(archive, jhu_vintage(11, revised=3))
+    with pytest.raises(OSError):
+        sa.add_snapshot(archive, "2021-03-02")
+    monkeypatch.setattr(sa, "write_index", write_index)
+    assert sa.restore_bytes(archive, "2021-03-02") == old
+
+def test_reads_first_archive_format(archive):
+    # (one json list per vintage, <date>.full.json.gz)
+    old = jhu_vintage(10)
+    lines = old.decode('utf-8', errors='surrogateescape').splitlines(keepends=True)
+    os.makedirs(sa.archive_path(archive))
+    with gzip.open(os.path.join(sa.archive_path(archive), "2021-03-01.full.json.gz"),
+                   'wt', encoding='utf-8') as fh:
+        json.dump(lines, fh)
+    with open(os.path.join(sa.archive_path(archive), "index.json"), 'w') as fh:
+        json.dump({'file': archive, 'vintages': [
+            {'date': "2021-03-01", 'size': len(old),
+             'sha256': hashlib.sha256(old).hexdigest(), 'kind': "full",
+             'file': "2021-03-01.full.json.gz"}]}, fh)
+    data = jhu_vintage(11)
+    write(archive, data)
+    assert sa.add_snapshot(archive, "2021-03-02")['kind'] == "delta"
+    assert sa.restore_bytes(archive, "2021-03-01") == old
+    assert sa.restore_bytes(archive, "2021-03-02") == data
+
+def test_corrupt_vintage_is_an_error(archive):
+    write(archive, jhu_vintage(10))
+    entry = sa.add_snapshot(archive, "2021-03-01")
+    index = sa.read_index(archive)
+    index['vintages'][0]['sha256'] = "0" * 64
+    sa.write_index(archive, index)
+    with pytest.raises(SystemExit):
+        sa.restore_bytes(archive, entry['date'])
+
+def test_no_earlier_vintage_is_an_error(archive):
+    write(archive, jhu_vintage(10))
+    sa.add_snapshot(archive, "2021-03-05")
+    with pytest.raises(SystemExit):
+        sa.restore_bytes(archive, "2021-03-01")
+    write(archive, jhu_vintage(11))
+    with pytest.raises(SystemExit):
+        sa.add_snapshot(archive, "2021-03-04")
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import curate_covid19 as cc
+
+nan = np.nan
+
+@pytest.mark.parametrize("n", [1, 3, 7, 14])
+def test_trailing_means_match_rolling(n):
+    rng = np.random.default_rng(9)
+    daily = rng.poisson(6, (25, 60)).astype(float)
+    daily[rng.random(daily.shape) < 0.03] = nan
+    [mean] = cc.trailing_means(daily, [n])
+    expected = pd.DataFrame(daily.T).rolling(n).mean().to_numpy().T
+    np.testing.assert_allclose(mean, expected, rtol=1e-12, atol=1e-12,
+                               equal_nan=True)
+
+def test_trailing_means_nan_spreads_over_its_windows():
+    daily = np.ones((1, 12))
+    daily[0, 4] = nan
+    [mean3, mean5] = cc.trailing_means(daily, [3, 5])
+    # nan for the first n-1 days, and for the n days from the nan on
+    assert np.isnan(mean3[0]).tolist() == [True, True, False, False,
+                                           True, True, True] + [False] * 5
+    assert np.isnan(mean5[0]).tolist() == [True] * 9 + [False] * 3
+    np.testing.assert_array_equal(mean5[0, 9:], 1.0)
+
+def test_trailing_means_all_zero_window_is_exactly_zero():
+    # (big values before the zeros leave rounding errors in the running
+    #  sums, but a window of zeros is still exactly zero)
+    daily = np.array([[1e9 + 0.1, 3.3e8, 7.77, 0.0, 0.0, 0.0, 0.0, 0.0]])
+    [mean] = cc.trailing_means(daily, [3])
+    assert (mean[0, 5:] == 0.0).all()
+    assert (mean[0, 2:5] > 0.0).all()
+
+def test_trailing_means_window_longer_than_dates():
+    daily = np.arange(10.0).reshape(2, 5)
+    [mean5, mean6] = cc.trailing_means(daily, [5, 6])
+    np.testing.assert_array_equal(mean5[:, -1], [2.0, 7.0])
+    assert np.isnan(mean5[:, :-1]).all()
+    assert np.isnan(mean6).all()
+
+def test_trailing_means_along_other_axis():
+    rng = np.random.default_rng(10)
+    daily = rng.poisson(3, (4, 30, 2)).astype(float)
+    [mean] = cc.trailing_means(daily, [7], axis=1)
+    for i in range(daily.shape[2]):
+        [expected] = cc.trailing_means(daily[:, :, i], [7])
+        np.testing.assert_array_equal(mean[:, :, i], expected)
+
+def summary_cube(jhu_daily, nyt_daily):
+    # a cube of one fips (cases only), with the given JHU and NYT daily
+    # values (None where NYT has no row)
+    ndates = len(jhu_daily)
+    values = np.full((1, ndates, len(cc.cube_sources), len(cc.cube_metrics),
+                      len(cc.cube_fields)), nan)
+    present = np.zeros(values.shape[:-1], dtype=bool)
+    daily = cc.cube_fields.index('daily')
+    c = cc.cube_metrics.index('c')
+    for source, series in [['jhu', jhu_daily], ['nyt', nyt_daily]]:
+        s = cc.cube_sources.index(source)
+        for j, v in enumerate(series):
+            if v is not None:
+                values[0, j, s, c, daily] = v
+                present[0, j, s, c] = True
+    return {'fips': np.array([1001]),
+            'dates': pd.date_range("2020-03-01", periods=ndates).to_numpy(),
+            'values': values, 'present': present}
+
+def summary_column(summary, name):
+    return summary['values'][0, :, cc.summary_columns().index(name)]
+
+def test_geomean_of_daily_values():
+    jhu = [4.0, 0.0, -2.0, 5.0, 2.0, nan]
+    nyt = [9.0, 5.0, 3.0, None, 8.0, 4.0]
+    summary = cc.build_summary(summary_cube(jhu, nyt))
+    # (zero if either is zero, nan if either is negative, and the JHU
+    #  value where NYT has no row; a nan value doesn't count as a source)
+    np.testing.assert_allclose(summary_column(summary, "geomean_c_daily"),
+                               [6.0, 0.0, nan, 5.0, 4.0, 4.0],
+                               rtol=1e-12, equal_nan=True)
+    np.testing.assert_allclose(summary_column(summary, "mean_c_daily"),
+                               [6.5, 2.5, 0.5, 5.0, 5.0, 4.0],
+                               rtol=1e-12, equal_nan=True)
+    # (and all nan for the deaths, which have no rows)
+    assert np.isnan(summary_column(summary, "geomean_d_daily")).all()
+    assert np.isnan(summary_column(summary, "mean_d_daily")).all()
+
+def test_geomean_of_averages():
+    jhu = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0]
+    nyt = [2.0, 2.0, 2.0, 2.0, 2.0, 2.0, 2.0, None]
+    summary = cc.build_summary(summary_cube(jhu, nyt))
+    # the 7-day averages on the 7th day are 4 (JHU) and 2 (NYT), and on
+    # the 8th NYT has no row
+    geomean = summary_column(summary, "geomean_c_7davg")
+    assert np.isnan(geomean[:6]).all()
+    np.testing.assert_allclose(geomean[6:], [np.sqrt(4.0 * 2.0), 5.0], rtol=1e-12)
+    np.testing.assert_allclose(summary_column(summary, "jhu_c_7davg")[6:], [4.0, 5.0])
+    np.testing.assert_allclose(summary_column(summary, "mean_c_7davg")[6:], [3.0, 5.0])
+
+def divergence_cube(cum):
+    # a cube of cases only, with the given [fips, date, [jhu, nyt]]
+    # cumulative values (and daily values from them)
+    nfips, ndates = cum.shape[:2]
+    values = np.full((nfips, ndates, len(cc.cube_sources), len(cc.cube_metrics),
+                      len(cc.cube_fields)), nan)
+    present = np.zeros(values.shape[:-1], dtype=bool)
+    c = cc.cube_metrics.index('c')
+    for k, source in enumerate(['jhu', 'nyt']):
+        s = cc.cube_sources.index(source)
+        values[:, :, s, c, cc.cube_fields.index('cum')] = cum[..., k]
+        values[:, 1:, s, c, cc.cube_fields.index('daily')] = np.diff(cum[..., k], axis=1)
+        present[:, :, s, c] = True
+    fips = 1001 + np.arange(nfips)
+    registry = {'df': pd.DataFrame({'fips': fips, 'stateabb': "AL",
+                                    'countylong': [f"County {f}" for f in fips]})}
+    cube = {'fips': fips, 'dates': pd.date_range("2020-03-01", periods=ndates),
+            'values': values, 'present': present}
+    return [cube, registry]
+
+def test_rank_divergence(monkeypatch):
+    monkeypatch.setattr(cc, "divergence_min_count", 100)
+    last = np.array([[1000.0, 1000.0],   # the same (not ranked)
+                     [1000.0, 1100.0],   # tied with the next one
+                     [1000.0, 1100.0],
+                     [1000.0, 1500.0],   # the worst
+                     [40.0, 60.0],       # too few counts (not ranked)
+                     [2000.0, 2200.0]])  # same reldiv as 1002, more absdiv
+    cum = np.stack([last * (j + 1) / 5 for j in range(5)], axis=1)
+    cube, registry = divergence_cube(cum)
+    df = cc.rank_divergence(cube, cc.build_divergence(cube), registry)
+    df = df[df['metric'] == "c"].set_index('fips')
+    assert df.loc[[1004, 1006, 1002, 1003], 'rank'].to_list() == [1, 2, 3, 3]
+    assert df.loc[[1001, 1005], 'rank'].isna().all()
+    assert df.loc[1001, 'reldiv_cum'] == 0.0
+    # the ranked rows come first, in order
+    assert df['rank'].to_list()[:4] == [1, 2, 3, 3]